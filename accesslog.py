@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from threading import Thread, Event
+
+
+# сколько записей может ждать записи в файл, остальные отбрасываются
+BUFFER_SIZE = 65536
+FLUSH_INTERVAL = 0.5
+MAX_BYTES = 64 * 1024 * 1024
+BACKUP_COUNT = 5
+FORMATS = ('combined', 'json')
+
+
+class AccessLog:
+    """
+    Журнал доступа: по строке на запрос в Combined Log Format или JSON.
+    Цикл событий только кладет кортеж полей в deque (добавление в него потокобезопасно),
+    а форматирует и пишет пачками фоновый поток. При переполнении буфера записи
+    отбрасываются и считаются в dropped. Файл ротируется по размеру и, если задан
+    rotate_interval, по времени: path -> path.1 -> ... -> path.backup_count
+    """
+    def __init__(
+            self,
+            path,
+            log_format='combined',
+            max_bytes=MAX_BYTES,
+            backup_count=BACKUP_COUNT,
+            rotate_interval=0,
+            buffer_size=BUFFER_SIZE,
+            flush_interval=FLUSH_INTERVAL
+    ):
+        if log_format not in FORMATS:
+            raise ValueError(f'Неизвестный формат журнала доступа {log_format}')
+        self.path = path
+        self.format_record = self.format_json if log_format == 'json' else self.format_combined
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.records = deque()
+        self.written = 0
+        self.dropped = 0
+        self.file = open(path, 'ab')
+        self.opened = time.monotonic()
+        self.stop_event = Event()
+        self.writer = Thread(target=self.run, name='access-log', daemon=True)
+        self.writer.start()
+
+    def log(self, record):
+        """
+        record - (время, адрес, строка запроса, статус, размер, referer, user-agent, длительность)
+        """
+        if len(self.records) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self.records.append(record)
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        records = self.records
+        lines = []
+        while records:
+            try:
+                lines.append(self.format_record(records.popleft()))
+            except Exception as e:
+                logging.error(f'Не удалось сформировать запись журнала доступа: {e}')
+        try:
+            if lines:
+                self.file.write(''.join(lines).encode('utf-8', 'backslashreplace'))
+                self.file.flush()
+                self.written += len(lines)
+            if self.need_rotation():
+                self.rotate()
+        except OSError as e:
+            logging.error(f'Ошибка записи журнала доступа {self.path}: {e}')
+
+    def need_rotation(self):
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.monotonic() - self.opened >= self.rotate_interval \
+            and self.file.tell() > 0
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count:
+            for number in range(self.backup_count - 1, 0, -1):
+                source = f'{self.path}.{number}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.path}.{number + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.truncate(self.path, 0)
+        self.file = open(self.path, 'ab')
+        self.opened = time.monotonic()
+
+    @staticmethod
+    def format_combined(record):
+        timestamp, host, request_line, status, size, referer, user_agent, duration = record
+        local_time = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(timestamp))
+        return (
+            f'{host} - - [{local_time}] "{escape(request_line)}" {status} {size} '
+            f'"{escape(referer or "-")}" "{escape(user_agent or "-")}" {duration:.6f}\n'
+        )
+
+    @staticmethod
+    def format_json(record):
+        timestamp, host, request_line, status, size, referer, user_agent, duration = record
+        return json.dumps({
+            'time': timestamp,
+            'remote_addr': host,
+            'request': request_line,
+            'status': status,
+            'bytes': size,
+            'referer': referer,
+            'user_agent': user_agent,
+            'request_time': round(duration, 6),
+        }, ensure_ascii=False) + '\n'
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'pending': len(self.records)}
+
+    def close(self):
+        self.stop_event.set()
+        self.writer.join()
+        self.file.close()
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
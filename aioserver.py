@@ -0,0 +1,388 @@
+import asyncio
+import logging
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from response import RequestSlot, FileBody, StreamBody, clock
+from filecache import CACHE_SIZE, CACHE_MAX_FILE_SIZE, CACHE_REVALIDATE_INTERVAL
+from routecache import ROUTE_CACHE_SIZE
+from mmapcache import MMAP_BUDGET
+from compression import Compressor, COMPRESS_LEVEL, COMPRESS_MIN_SIZE, COMPRESS_CACHE_SIZE
+from constants import DEFAULT_HTTP_PROTOCOL
+from constants import OLD_HTTP_PROTOCOL
+from httpparser import RequestParser, ParseError
+from httpd import Server, ResponseCaches, SERVER_NAME, KEEPALIVE_TIMEOUT, DRAIN_TIMEOUT, WRITE_HIGH_WATER, MAX_PIPELINE
+from httpd import create_listen_socket, LISTEN_BACKLOG, HEADER_TIMEOUT
+import tls
+import handoff
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class HttpProtocol(asyncio.Protocol):
+    """
+    Соединение клиента: разбирает конвейер запросов и отвечает на них по порядку
+    """
+    def __init__(self, server):
+        self.server = server
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.addr = None
+        self.parser = RequestParser()
+        self.parse_failed = False
+        self.requests = deque()
+        self.task = None
+        self.idle_handle = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.closed = False
+        self.reading = True
+        # запросов еще не было: при остановке не закрываем, первый запрос может быть уже в пути
+        self.fresh = True
+        # объекты Response для следующих запросов соединения
+        self.responses = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.server.write_high_water)
+        self.addr = transport.get_extra_info('peername')
+        if self.server.debug:
+            logging.debug(f"accepted connection from {self.addr}")
+        self.server.protocols.add(self)
+        self.set_idle_timer()
+
+    def connection_lost(self, exc):
+        if self.server.debug:
+            logging.debug(f"closing connection to {self.addr}")
+        self.closed = True
+        self.cancel_idle_timer()
+        self.can_write.set()
+        self.server.protocols.discard(self)
+        for slot in self.requests:
+            if slot.resp:
+                Server.release_response(slot)
+        self.requests.clear()
+
+    def data_received(self, data):
+        if self.parse_failed:
+            return
+        self.parser.feed(data)
+        self.parse_requests()
+
+    def parse_requests(self):
+        while not self.parse_failed and len(self.requests) < self.server.max_pipeline:
+            try:
+                request = self.parser.next_request()
+            except ParseError as e:
+                if self.server.debug:
+                    logging.debug(f'Ошибка разбора запроса от {self.addr}: {e}')
+                slot = RequestSlot(None)
+                self.server.make_response().form_error_response(slot, e.status)
+                self.requests.append(slot)
+                self.parse_failed = True
+                break
+            if request is None:
+                break
+            self.fresh = False
+            self.requests.append(RequestSlot(request))
+
+        if self.reading and len(self.requests) >= self.server.max_pipeline:
+            # остальное дочитаем, когда очередь разгрузится
+            self.transport.pause_reading()
+            self.reading = False
+        if self.requests and self.task is None:
+            self.cancel_idle_timer()
+            self.task = self.loop.create_task(self.process())
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def process(self):
+        try:
+            while self.requests and not self.closed:
+                slot = self.requests[0]
+                if slot.resp is None:
+                    await self.server.form_response(slot, self)
+                await self.send_response(slot)
+                self.requests.popleft()
+                if not slot.keep_alive or self.server.stopping:
+                    self.transport.close()
+                    return
+                if not self.reading and len(self.requests) < self.server.max_pipeline:
+                    self.reading = True
+                    self.transport.resume_reading()
+                    self.parse_requests()
+        except (ConnectionError, RuntimeError) as e:
+            logging.info(f'Connection to {self.addr} lost: {e}')
+            self.transport.close()
+            return
+        except Exception as e:
+            # иначе задача завершится молча, а соединение так и останется открытым
+            logging.error(f'Ошибка обработки запроса от {self.addr}: {e!r}')
+            self.transport.close()
+            return
+        finally:
+            self.task = None
+        if not self.closed:
+            self.set_idle_timer()
+
+    async def send_response(self, slot):
+        """
+        Заголовки и тело из памяти пишем в транспорт, файл отдаем через loop.sendfile,
+        который сам выбирает между os.sendfile и чтением в буфер (под TLS - всегда буфер)
+        """
+        while slot.resp:
+            segment = slot.resp.pop(0)
+            if isinstance(segment, FileBody):
+                try:
+                    await self.loop.sendfile(self.transport, segment.file, segment.offset, segment.length)
+                finally:
+                    segment.close()
+            elif isinstance(segment, StreamBody):
+                try:
+                    await self.send_stream(segment)
+                finally:
+                    await segment.aclose()
+            else:
+                await self.can_write.wait()
+                if self.closed:
+                    raise ConnectionResetError()
+                self.transport.write(segment)
+
+    async def send_stream(self, body):
+        """
+        Потоковое тело пишем по куску, дожидаясь, пока транспорт разгрузит буфер
+        """
+        while not body.finished:
+            try:
+                buffers = await self.server.next_stream_segments(body)
+            except Exception as e:
+                logging.error(f'Ошибка формирования тела ответа для {self.addr}: {e}')
+                raise ConnectionAbortedError() from e
+            await self.can_write.wait()
+            if self.closed:
+                raise ConnectionResetError()
+            self.transport.writelines(buffers)
+
+    def set_idle_timer(self):
+        self.cancel_idle_timer()
+        self.idle_handle = self.loop.call_later(self.server.keepalive_timeout, self.close_idle)
+
+    def cancel_idle_timer(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+
+    def close_idle(self):
+        if self.server.debug:
+            logging.debug(f"closing idle connection to {self.addr}")
+        self.transport.close()
+
+    def is_idle(self):
+        return self.task is None and not self.requests and not self.fresh and not len(self.parser)
+
+
+class AsyncServer(ResponseCaches):
+    """
+    Сервер на asyncio: тот же разбор и формирование ответов, что и у Server,
+    но ответы из кешей формируются прямо в цикле событий без передачи в пул потоков
+    """
+    def __init__(
+            self,
+            host='localhost',
+            port=8080,
+            root_dir='',
+            workers=1,
+            server_name=SERVER_NAME,
+            protocol=DEFAULT_HTTP_PROTOCOL,
+            keep_alive=True,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            cache_size=CACHE_SIZE,
+            cache_max_file_size=CACHE_MAX_FILE_SIZE,
+            cache_revalidate=CACHE_REVALIDATE_INTERVAL,
+            route_cache_size=ROUTE_CACHE_SIZE,
+            manifest=None,
+            mmap_max_size=0,
+            mmap_budget=MMAP_BUDGET,
+            autoindex=False,
+            compress=True,
+            compress_level=COMPRESS_LEVEL,
+            compress_min_size=COMPRESS_MIN_SIZE,
+            compress_cache_size=COMPRESS_CACHE_SIZE,
+            reuse_port=False,
+            backlog=LISTEN_BACKLOG,
+            listen_sockets=(),
+            drain_timeout=DRAIN_TIMEOUT,
+            write_high_water=WRITE_HIGH_WATER,
+            max_pipeline=MAX_PIPELINE,
+            tls_context=None,
+            reload_on_sighup=False,
+            use_uvloop=True
+    ):
+        self.host = host
+        self.port = port
+        self.root_dir = root_dir
+        self.server_name = server_name
+        self.protocol = protocol
+        self.allowed_http_protocols = [DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL]
+        self.allowed_methods = ['GET', 'HEAD']
+        self.keep_alive = keep_alive
+        self.keepalive_timeout = keepalive_timeout
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.listen_sockets = list(listen_sockets)
+        self.drain_timeout = drain_timeout
+        self.write_high_water = write_high_water
+        self.max_pipeline = max_pipeline
+        # HTTPS: рукопожатие и шифрование делает транспорт asyncio, HTTP/2 здесь нет
+        self.tls_context = tls_context
+        if tls_context is not None:
+            tls.set_alpn(tls_context)
+        self.use_uvloop = use_uvloop and uvloop is not None
+        self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        # ответы из кешей формируются в цикле событий, а все, что может пойти на диск, - в потоках
+        self.executor = ThreadPoolExecutor(workers)
+        # сжатие нагружает процессор, поэтому всегда уходит из цикла событий в фоновые потоки
+        self.compress_executor = None
+        compressor = None
+        if compress:
+            self.compress_executor = ThreadPoolExecutor(workers)
+            compressor = Compressor(compress_level, compress_min_size, compress_cache_size,
+                                    executor=self.compress_executor)
+        # транспорт копирует недоотправленное тело в свой буфер, и копирование отображения
+        # укороченного файла убило бы процесс SIGBUS, поэтому mmap здесь не используется
+        if mmap_max_size:
+            logging.warning('mmap недоступен в движке asyncio, большие файлы отдаются через sendfile')
+            mmap_max_size = 0
+        # асинхронные итераторы тела отдаются прямо из цикла событий
+        self.setup_responses(
+            route_cache_size, cache_size, cache_max_file_size, cache_revalidate, manifest,
+            mmap_max_size, mmap_budget, autoindex, compressor, async_streams=True
+        )
+        self.protocols = set()
+        self.stopping = False
+        self.stop_event = None
+        # по SIGHUP запускаем новый процесс на тех же сокетах и уступаем ему, когда он готов
+        self.reload_on_sighup = reload_on_sighup
+        self.successor = None
+
+    def serve_forever(self):
+        if self.use_uvloop:
+            logging.info('using uvloop')
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logging.info("caught keyboard interrupt, exiting")
+        finally:
+            self.executor.shutdown(wait=False)
+            if self.compress_executor is not None:
+                self.compress_executor.shutdown(wait=False)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop_event.set)
+        if self.reload_on_sighup:
+            loop.add_signal_handler(signal.SIGHUP, self.start_reload)
+
+        if not self.listen_sockets:
+            self.listen_sockets.append(
+                create_listen_socket(self.host, self.port, reuse_port=self.reuse_port, backlog=self.backlog)
+            )
+        servers = [
+            await loop.create_server(
+                lambda: HttpProtocol(self), sock=lsock, ssl=self.tls_context,
+                ssl_handshake_timeout=HEADER_TIMEOUT if self.tls_context is not None else None
+            )
+            for lsock in self.listen_sockets
+        ]
+        self.tick_clock()
+        try:
+            await self.stop_event.wait()
+            for server in servers:
+                server.close()
+            await self.drain()
+        finally:
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+
+    def start_reload(self):
+        """
+        Перезагрузка без простоя: новый процесс наследует слушающие сокеты,
+        а мы останавливаемся, когда он сообщит о готовности
+        """
+        if self.stopping or self.successor is not None:
+            return
+        logging.info('получен SIGHUP, перезапускаемся')
+        try:
+            self.successor = handoff.Successor(self.listen_sockets)
+        except OSError as e:
+            logging.error(f'Не удалось запустить новый процесс: {e}')
+            return
+        asyncio.get_running_loop().add_reader(self.successor.ready_fd, self.check_successor)
+
+    def check_successor(self):
+        ready = self.successor.check()
+        if ready is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.successor.ready_fd)
+        self.successor.close()
+        if ready:
+            logging.info(f'новый процесс {self.successor.process.pid} готов, завершаем работу')
+            self.stop_event.set()
+        else:
+            logging.error('новый процесс завершился, не начав работу, продолжаем обслуживание')
+            self.successor = None
+
+    def tick_clock(self):
+        """
+        Обновляем Date в начале каждой секунды
+        """
+        clock.tick()
+        loop = asyncio.get_running_loop()
+        loop.call_at(loop.time() + 1 - time.time() % 1, self.tick_clock)
+
+    async def drain(self):
+        """
+        Плавная остановка: закрываем простаивающие соединения
+        и ждем активные не дольше drain_timeout
+        """
+        logging.info(f"graceful shutdown, draining {len(self.protocols)} connections")
+        self.stopping = True
+        deadline = asyncio.get_running_loop().time() + self.drain_timeout
+        while self.protocols and asyncio.get_running_loop().time() < deadline:
+            for proto in list(self.protocols):
+                if proto.is_idle():
+                    proto.transport.close()
+            await asyncio.sleep(0.05)
+        for proto in list(self.protocols):
+            proto.transport.abort()
+        self.close_caches()
+
+    async def next_stream_segments(self, body):
+        """
+        Синхронный генератор тела может ходить на диск, поэтому вызываем его в пуле потоков
+        """
+        if body.is_async:
+            return await body.anext_segments()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, body.next_segments)
+
+    async def form_response(self, slot, conn=None):
+        resp = self.make_response(conn)
+        if resp.in_memory(slot.request):
+            resp.form_response_no_return(slot)
+        else:
+            await asyncio.get_running_loop().run_in_executor(self.executor, resp.form_response_no_return, slot)
+        # при отмене задачи воркер может еще формировать ответ, такой объект не возвращаем
+        if conn is not None:
+            self.recycle_response(conn, resp)
@@ -0,0 +1,234 @@
+import heapq
+import html
+import itertools
+import json
+import os
+import stat
+import time
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import parse_qs, quote, unquote, urlencode
+
+
+AUTOINDEX_PAGE_SIZE = 100
+AUTOINDEX_MAX_PAGE_SIZE = 1000
+AUTOINDEX_CACHE_SIZE = 4 * 1024 * 1024
+# листинги больше этого не кешируются
+AUTOINDEX_MAX_CACHED = 256 * 1024
+# отрендеренные строки отдаются кусками примерно такого размера
+AUTOINDEX_CHUNK_SIZE = 16 * 1024
+SORT_KEYS = {
+    # каталоги перед файлами
+    'name': lambda record: (not record[1], record[0]),
+    'size': lambda record: (record[2], record[0]),
+    'mtime': lambda record: (record[3], record[0]),
+}
+HTML_TYPE = 'text/html; charset=utf-8'
+JSON_TYPE = 'application/json'
+
+
+class ListingParams:
+    """
+    Параметры листинга из строки запроса: sort=name|size|mtime|none, order=asc|desc,
+    page, per_page и format=html|json (по умолчанию по заголовку Accept)
+    """
+    __slots__ = ('sort', 'reverse', 'page', 'per_page', 'format')
+
+    def __init__(self, query, accept='', page_size=AUTOINDEX_PAGE_SIZE):
+        params = parse_qs(query)
+        self.sort = first(params, 'sort', 'name')
+        if self.sort not in SORT_KEYS:
+            self.sort = 'none'
+        self.reverse = first(params, 'order', 'asc') == 'desc'
+        self.page = max(1, to_int(first(params, 'page'), 1))
+        self.per_page = min(max(1, to_int(first(params, 'per_page'), page_size)), AUTOINDEX_MAX_PAGE_SIZE)
+        self.format = first(params, 'format', 'json' if 'application/json' in accept else 'html')
+        if self.format != 'json':
+            self.format = 'html'
+
+    def key(self):
+        return self.sort, self.reverse, self.page, self.per_page, self.format
+
+    def query(self, **changes):
+        params = {
+            'sort': self.sort,
+            'order': 'desc' if self.reverse else 'asc',
+            'page': self.page,
+            'per_page': self.per_page,
+        }
+        params.update(changes)
+        return '?' + urlencode(params)
+
+
+class AutoIndex:
+    """
+    Листинг каталога без index.html в HTML или JSON. Каталог читается через os.scandir
+    без построения полного списка: без сортировки записи отдаются по мере чтения,
+    с сортировкой в памяти держатся только записи до конца запрошенной страницы.
+    Готовые листинги кешируются по mtime каталога, поэтому изменения только
+    размера или времени файлов внутри него видны после истечения записи в LRU
+    """
+    def __init__(
+            self,
+            cache_size=AUTOINDEX_CACHE_SIZE,
+            max_cached=AUTOINDEX_MAX_CACHED,
+            page_size=AUTOINDEX_PAGE_SIZE
+    ):
+        self.cache_size = cache_size
+        self.max_cached = min(max_cached, cache_size)
+        self.page_size = page_size
+        self.listings = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def listing(self, path, st, target, accept=''):
+        """
+        Возвращаем (тело, Content-Type): тело - байты из кеша или генератор кусков листинга
+        """
+        url, _, query = target.partition('?')
+        params = ListingParams(query, accept, self.page_size)
+        content_type = JSON_TYPE if params.format == 'json' else HTML_TYPE
+        key = (path, st.st_mtime_ns, st.st_ino) + params.key()
+        with self.lock:
+            body = self.listings.get(key)
+            if body is not None:
+                self.listings.move_to_end(key)
+                self.hits += 1
+                return body, content_type
+            self.misses += 1
+        # страница выбирается сразу (и без сортировки тоже), чтобы обход каталога и stat записей
+        # шли в воркере, а не в цикле событий, который будет забирать куски
+        entries = self.select(path, params)
+        return self.render(key, unquote(url), params, entries), content_type
+
+    @staticmethod
+    def select(path, params):
+        """
+        Список записей страницы и одной следующей за ней, по которой видно, есть ли еще страницы
+        """
+        offset = (params.page - 1) * params.per_page
+        if params.sort == 'none':
+            return list(itertools.islice(scan(path), offset, offset + params.per_page + 1))
+        choose = heapq.nlargest if params.reverse else heapq.nsmallest
+        return choose(offset + params.per_page + 1, scan(path), key=SORT_KEYS[params.sort])[offset:]
+
+    def render(self, key, url, params, entries):
+        parts = self.render_json(url, params, entries) if params.format == 'json' \
+            else self.render_html(url, params, entries)
+        rendered = []
+        cached_size = 0
+        buffer = []
+        buffered = 0
+        for part in itertools.chain(parts, [None]):
+            if part is not None:
+                buffer.append(part)
+                buffered += len(part)
+                if buffered < AUTOINDEX_CHUNK_SIZE:
+                    continue
+            if not buffer:
+                continue
+            chunk = ''.join(buffer).encode('utf-8', 'surrogateescape')
+            buffer = []
+            buffered = 0
+            cached_size += len(chunk)
+            if rendered is not None and cached_size <= self.max_cached:
+                rendered.append(chunk)
+            else:
+                rendered = None
+            yield chunk
+        # сюда доходим, только если листинг отправлен целиком
+        if rendered is not None:
+            self.store(key, b''.join(rendered))
+
+    @staticmethod
+    def render_html(url, params, entries):
+        title = html.escape(url)
+        yield (
+            f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Index of {title}</title></head>\n'
+            f'<body><h1>Index of {title}</h1>\n<table>\n<tr>'
+        )
+        for column in ('name', 'size', 'mtime'):
+            order = 'desc' if params.sort == column and not params.reverse else 'asc'
+            link = html.escape(params.query(sort=column, order=order, page=1))
+            yield f'<th><a href="{link}">{column}</a></th>'
+        yield '</tr>\n'
+        if url != '/':
+            yield '<tr><td><a href="../">../</a></td><td></td><td></td></tr>\n'
+        more = False
+        for number, (name, is_dir, size, mtime) in enumerate(entries):
+            if number == params.per_page:
+                more = True
+                break
+            name = name + '/' if is_dir else name
+            yield (
+                f'<tr><td><a href="{html.escape(quote(name))}">{html.escape(name)}</a></td>'
+                f'<td>{"-" if is_dir else size}</td><td>{format_mtime(mtime)}</td></tr>\n'
+            )
+        yield '</table>\n<p>'
+        if params.page > 1:
+            yield f'<a href="{html.escape(params.query(page=params.page - 1))}">&larr; prev</a> '
+        if more:
+            yield f'<a href="{html.escape(params.query(page=params.page + 1))}">next &rarr;</a>'
+        yield '</p>\n</body></html>\n'
+
+    @staticmethod
+    def render_json(url, params, entries):
+        yield '{"path": %s, "page": %d, "per_page": %d, "entries": [' % (
+            json.dumps(url, ensure_ascii=False), params.page, params.per_page
+        )
+        more = False
+        for number, (name, is_dir, size, mtime) in enumerate(entries):
+            if number == params.per_page:
+                more = True
+                break
+            entry = {'name': name, 'type': 'directory' if is_dir else 'file', 'size': size, 'mtime': mtime}
+            yield (', ' if number else '') + json.dumps(entry, ensure_ascii=False)
+        yield '], "next_page": %s}\n' % (params.page + 1 if more else 'null')
+
+    def store(self, key, body):
+        with self.lock:
+            if key in self.listings:
+                return
+            self.listings[key] = body
+            self.size += len(body)
+            while self.size > self.cache_size:
+                _, old = self.listings.popitem(last=False)
+                self.size -= len(old)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.listings), 'size': self.size}
+
+
+def scan(path):
+    """
+    Записи каталога (имя, каталог ли, размер, mtime), скрытые файлы не показываем
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                # битая символическая ссылка
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            yield entry.name, is_dir, 0 if is_dir else st.st_size, int(st.st_mtime)
+
+
+def format_mtime(mtime):
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(mtime))
+
+
+def first(params, name, default=None):
+    values = params.get(name)
+    return values[0] if values else default
+
+
+def to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,243 @@
+"""
+Нагрузочный бенчмарк сервера: для каждой конфигурации (число воркеров, кеш, keep-alive)
+запускает httpd.Server в отдельном процессе и нагружает его встроенным генератором
+на asyncio смесью запросов к httptest/. Результаты (req/s, задержки p50/p99/p999, байт/с)
+пишутся в JSON и сравниваются с сохраненной базовой линией
+"""
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+from collections import Counter
+from optparse import OptionParser
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from httpd import Server  # noqa: E402
+from filecache import CACHE_SIZE  # noqa: E402
+
+
+# (метод, путь, вес) - мелкие флаги, jquery, большая страница, 404 и HEAD
+MIX = (
+    ('GET', '/httptest/wikipedia_russia_files/22px-Flag_of_Russia.png', 4),
+    ('GET', '/httptest/wikipedia_russia_files/22px-Flag_of_Estonia.png', 4),
+    ('GET', '/httptest/wikipedia_russia_files/22px-Flag_of_Macedonia.png', 4),
+    ('GET', '/httptest/jquery-1.9.1.js', 2),
+    ('GET', '/httptest/wikipedia_russia.html', 1),
+    ('GET', '/httptest/no_such_file.html', 2),
+    ('HEAD', '/httptest/wikipedia_russia.html', 2),
+)
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+# насколько результат может быть хуже базовой линии, прежде чем считать это регрессией
+TOLERANCE = 0.1
+
+
+def make_configs(workers_list, status_path=None):
+    configs = []
+    for workers, cache, keep_alive in itertools.product(workers_list, (True, False), (True, False)):
+        name = f'w{workers}-{"cache" if cache else "nocache"}-{"ka" if keep_alive else "noka"}'
+        configs.append((name, dict(
+            workers=workers,
+            cache_size=CACHE_SIZE if cache else 0,
+            keep_alive=keep_alive,
+            status_path=status_path,
+        )))
+    return configs
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port, options):
+    # сервер не пишет в журнал на каждый запрос, оставляем предупреждения и ошибки
+    logging.basicConfig(level=logging.WARNING)
+    Server(host='localhost', port=port, root_dir=str(ROOT_DIR), **options).serve_forever()
+
+
+def wait_listening(port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'сервер на порту {port} не запустился')
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.statuses = Counter()
+        self.errors = 0
+
+
+async def read_response(reader, method):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('iso-8859-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    length = 0
+    close = False
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            close = value.strip().lower() == 'close'
+    if method != 'HEAD' and length:
+        await reader.readexactly(length)
+    return status, len(head) + (length if method != 'HEAD' else 0), close
+
+
+async def client(port, requests, keep_alive, deadline, stats):
+    reader = writer = None
+    try:
+        for method, path in requests:
+            if time.monotonic() >= deadline:
+                break
+            connection = 'keep-alive' if keep_alive else 'close'
+            started = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection('localhost', port)
+            writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: {connection}\r\n\r\n'.encode())
+            try:
+                status, size, close = await read_response(reader, method)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                stats.errors += 1
+                close = True
+            else:
+                stats.latencies.append(time.perf_counter() - started)
+                stats.bytes += size
+                stats.statuses[status] += 1
+            if close or not keep_alive:
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def request_stream(offset):
+    weighted = [(method, path) for method, path, weight in MIX for _ in range(weight)]
+    # каждому клиенту свой сдвиг, чтобы в каждый момент запрашивались разные файлы
+    return itertools.islice(itertools.cycle(weighted), offset % len(weighted), None)
+
+
+async def generate_load(port, connections, duration, keep_alive):
+    stats = Stats()
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(port, request_stream(number), keep_alive, deadline, stats)
+        for number in range(connections)
+    ))
+    return stats, time.perf_counter() - started
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_config(name, options, connections, duration, warmup):
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(port, options), daemon=True)
+    process.start()
+    try:
+        wait_listening(port)
+        if warmup:
+            asyncio.run(generate_load(port, connections, warmup, options['keep_alive']))
+        stats, elapsed = asyncio.run(generate_load(port, connections, duration, options['keep_alive']))
+    finally:
+        process.terminate()
+        process.join(5)
+
+    latencies = sorted(stats.latencies)
+    ms = 1000
+    result = {
+        'requests': len(latencies),
+        'errors': stats.errors,
+        'statuses': {str(status): count for status, count in sorted(stats.statuses.items())},
+        'rps': len(latencies) / elapsed,
+        'bytes_per_sec': stats.bytes / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * ms if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * ms if latencies else None,
+        'p999_ms': percentile(latencies, 0.999) * ms if latencies else None,
+    }
+    print(f'{name:<20} {result["rps"]:>9,.0f} req/s {result["bytes_per_sec"] / 2 ** 20:>8,.1f} MiB/s '
+          f'p50 {result["p50_ms"] or 0:>7.2f} ms p99 {result["p99_ms"] or 0:>7.2f} ms '
+          f'p999 {result["p999_ms"] or 0:>7.2f} ms errors {stats.errors}')
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Возвращаем список регрессий: меньше запросов в секунду или большие задержки,
+    чем в базовой линии с учетом допуска
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{name}: rps {result["rps"]:,.0f} < {base["rps"]:,.0f}')
+        for key in ('p50_ms', 'p99_ms'):
+            if result[key] and base.get(key) and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{name}: {key} {result[key]:.2f} > {base[key]:.2f}')
+        if result['errors'] > base.get('errors', 0):
+            regressions.append(f'{name}: errors {result["errors"]} > {base.get("errors", 0)}')
+    return regressions
+
+
+def main():
+    op = OptionParser()
+    op.add_option("--workers", default="1,4", help="comma separated worker counts")
+    op.add_option("-c", "--connections", type=int, default=32)
+    op.add_option("-d", "--duration", type=float, default=5.0)
+    op.add_option("--warmup", type=float, default=1.0)
+    op.add_option("--status_path", default=None, help="enable server metrics to measure their overhead")
+    op.add_option("--only", default=None, help="run only configurations containing this substring")
+    op.add_option("-o", "--output", default=None, help="write results to this JSON file")
+    op.add_option("--baseline", default=str(BASELINE))
+    op.add_option("--tolerance", type=float, default=TOLERANCE)
+    op.add_option("--save_baseline", action="store_true", default=False)
+    (opts, args) = op.parse_args()
+
+    results = {}
+    for name, options in make_configs([int(w) for w in opts.workers.split(',')], opts.status_path):
+        if opts.only and opts.only not in name:
+            continue
+        results[name] = run_config(name, options, opts.connections, opts.duration, opts.warmup)
+
+    if opts.output:
+        Path(opts.output).write_text(json.dumps(results, indent=2))
+    baseline_path = Path(opts.baseline)
+    if opts.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2))
+        print(f'базовая линия сохранена в {baseline_path}')
+        return
+    if not baseline_path.exists():
+        print(f'базовой линии {baseline_path} нет, сравнение пропущено')
+        return
+    regressions = compare(results, json.loads(baseline_path.read_text()), opts.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
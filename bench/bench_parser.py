@@ -0,0 +1,70 @@
+"""
+Микро-бенчмарк разборщика запросов: сколько запросов в секунду разбирает RequestParser
+при подаче запроса целиком, мелкими кусками и конвейером из нескольких запросов
+"""
+import sys
+import time
+from optparse import OptionParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from httpparser import RequestParser  # noqa: E402
+
+
+REQUEST = (
+    b'GET /httptest/wikipedia_russia_files/22px-Flag_of_Russia.png HTTP/1.1\r\n'
+    b'Host: localhost:8080\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+    b'Accept: image/avif,image/webp,*/*\r\n'
+    b'Accept-Language: ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Connection: keep-alive\r\n'
+    b'Referer: http://localhost:8080/httptest/wikipedia_russia.html\r\n'
+    b'\r\n'
+)
+
+
+def whole(count):
+    parser = RequestParser()
+    for _ in range(count):
+        parser.feed(REQUEST)
+        parser.next_request()
+
+
+def chunked(count, chunk_size=64):
+    chunks = [REQUEST[i:i + chunk_size] for i in range(0, len(REQUEST), chunk_size)]
+    parser = RequestParser()
+    for _ in range(count):
+        for chunk in chunks:
+            parser.feed(chunk)
+            parser.next_request()
+
+
+def pipelined(count, depth=16):
+    batch = REQUEST * depth
+    parser = RequestParser()
+    for _ in range(count // depth):
+        parser.feed(batch)
+        while parser.next_request() is not None:
+            pass
+
+
+def run(name, func, count):
+    started = time.perf_counter()
+    func(count)
+    elapsed = time.perf_counter() - started
+    print(f'{name:<10} {count / elapsed:>12,.0f} parses/sec')
+    return count / elapsed
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count", type=int, default=100000)
+    (opts, args) = op.parse_args()
+    for name, func in (('whole', whole), ('chunked', chunked), ('pipelined', pipelined)):
+        run(name, func, opts.count)
+
+
+if __name__ == '__main__':
+    main()
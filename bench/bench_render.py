@@ -0,0 +1,88 @@
+"""
+Микро-бенчмарк формирования заголовков ответа: сколько ответов в секунду рендерит Response
+для частых случаев - файл из кеша, файл через sendfile, 304 и 404
+"""
+import os
+import sys
+import time
+from http import HTTPStatus
+from optparse import OptionParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from response import RequestSlot, Response, ResponseSettings, make_etag, clock  # noqa: E402
+from filecache import FileCache  # noqa: E402
+
+
+SETTINGS = ResponseSettings(server_name='Python server', allowed_methods=['GET', 'HEAD'])
+STAT = os.stat(__file__)
+ENTRY = FileCache().store(__file__, b'x' * STAT.st_size, STAT, 'text/x-python')
+
+
+def finish(resp):
+    slot = RequestSlot(None)
+    resp.finish(slot)
+    return slot.resp
+
+
+def cached(count):
+    for _ in range(count):
+        resp = Response(SETTINGS)
+        resp.keep_alive = True
+        resp.use_cache_entry(ENTRY, 'GET')
+        resp.status = HTTPStatus.OK
+        finish(resp)
+
+
+def sendfile(count):
+    etag = make_etag(STAT)
+    for _ in range(count):
+        resp = Response(SETTINGS)
+        resp.keep_alive = True
+        resp.content_type = 'text/x-python'
+        resp.set_validators(STAT, etag)
+        resp.content_length = STAT.st_size
+        resp.status = HTTPStatus.OK
+        finish(resp)
+
+
+def not_modified(count):
+    etag = make_etag(STAT)
+    for _ in range(count):
+        resp = Response(SETTINGS)
+        resp.keep_alive = True
+        resp.content_length = None
+        resp.headers.append(('ETag', etag))
+        resp.status = HTTPStatus.NOT_MODIFIED
+        finish(resp)
+
+
+def not_found(count):
+    for _ in range(count):
+        resp = Response(SETTINGS)
+        resp.keep_alive = True
+        resp.status = HTTPStatus.NOT_FOUND
+        finish(resp)
+
+
+def run(name, func, count):
+    started = time.perf_counter()
+    func(count)
+    elapsed = time.perf_counter() - started
+    print(f'{name:<13} {count / elapsed:>12,.0f} renders/sec {elapsed / count * 1e6:>8.2f} us')
+    return count / elapsed
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count", type=int, default=100000)
+    (opts, args) = op.parse_args()
+    clock.tick()
+    for name, func in (('cached', cached), ('sendfile', sendfile), ('not_modified', not_modified),
+                       ('not_found', not_found)):
+        run(name, func, opts.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Бенчмарк HTTPS: скорость полных рукопожатий, рукопожатий с возобновлением сессии
+и отдачи большого файла через TLS. Самоподписанный сертификат создается утилитой openssl
+во временном каталоге при каждом запуске, сервер запускается в отдельном процессе
+"""
+import logging
+import multiprocessing
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from httpd import Server  # noqa: E402
+from tls import make_server_context  # noqa: E402
+from bench_load import free_port, wait_listening  # noqa: E402
+
+
+KEY_TYPES = {
+    'ec': ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'],
+    'rsa': ['-newkey', 'rsa:2048'],
+}
+TLS_VERSIONS = {'1.2': ssl.TLSVersion.TLSv1_2, '1.3': ssl.TLSVersion.TLSv1_3}
+LARGE_FILE = '/httptest/wikipedia_russia.html'
+
+
+def make_certificate(directory, key_type):
+    cert = Path(directory) / 'cert.pem'
+    key = Path(directory) / 'key.pem'
+    subprocess.run(
+        ['openssl', 'req', '-x509', *KEY_TYPES[key_type], '-nodes', '-subj', '/CN=localhost',
+         '-days', '1', '-keyout', str(key), '-out', str(cert)],
+        check=True, capture_output=True
+    )
+    return str(cert), str(key)
+
+
+def serve(port, cert, key, cache_size):
+    logging.basicConfig(level=logging.WARNING)
+    Server(host='localhost', port=port, root_dir=str(ROOT_DIR), cache_size=cache_size,
+           tls_context=make_server_context(cert, key)).serve_forever()
+
+
+def client_context(version):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.minimum_version = context.maximum_version = TLS_VERSIONS[version]
+    context.set_alpn_protocols(['http/1.1'])
+    return context
+
+
+def request(sock, path, method='GET'):
+    """
+    Запрос с Connection: close, читаем ответ до закрытия. Возвращаем размер ответа
+    """
+    sock.sendall(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode())
+    size = 0
+    while True:
+        chunk = sock.recv(256 * 1024)
+        if not chunk:
+            return size
+        size += len(chunk)
+
+
+def fetch_session(context, port):
+    """
+    Билеты TLS 1.3 приходят после рукопожатия, поэтому сессию берем после ответа
+    """
+    with context.wrap_socket(socket.create_connection(('localhost', port))) as sock:
+        request(sock, '/', 'HEAD')
+        return sock.session
+
+
+def handshakes(context, port, count, session=None):
+    resumed = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        with socket.create_connection(('localhost', port)) as raw:
+            with context.wrap_socket(raw, session=session) as sock:
+                resumed += sock.session_reused
+    return time.perf_counter() - started, resumed
+
+
+def download(context, port, count):
+    total = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        with context.wrap_socket(socket.create_connection(('localhost', port))) as sock:
+            total += request(sock, LARGE_FILE)
+    return time.perf_counter() - started, total
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count", type=int, default=500, help="handshakes per scenario")
+    op.add_option("--downloads", type=int, default=20)
+    op.add_option("--key_type", type="choice", choices=list(KEY_TYPES), default="ec")
+    op.add_option("--tls_version", type="choice", choices=list(TLS_VERSIONS), default="1.3")
+    op.add_option("--cache_size", type=int, default=0, help="0 - large file goes through the TLS file buffer")
+    (opts, args) = op.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(directory, opts.key_type)
+        port = free_port()
+        process = multiprocessing.Process(target=serve, args=(port, cert, key, opts.cache_size), daemon=True)
+        process.start()
+        try:
+            wait_listening(port)
+            context = client_context(opts.tls_version)
+            elapsed, _ = handshakes(context, port, opts.count)
+            print(f'full handshakes    {opts.count / elapsed:>10,.0f} /sec {elapsed / opts.count * 1e3:>8.3f} ms')
+            elapsed, resumed = handshakes(context, port, opts.count, fetch_session(context, port))
+            print(f'resumed handshakes {opts.count / elapsed:>10,.0f} /sec {elapsed / opts.count * 1e3:>8.3f} ms '
+                  f'(resumed {resumed} of {opts.count})')
+            elapsed, total = download(context, port, opts.downloads)
+            print(f'large file         {total / elapsed / 2 ** 20:>10,.1f} MiB/s')
+        finally:
+            process.terminate()
+            process.join(5)
+
+
+if __name__ == '__main__':
+    main()
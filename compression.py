@@ -0,0 +1,240 @@
+import gzip
+import logging
+import os
+import stat
+import time
+from collections import OrderedDict
+from threading import Lock
+from routecache import under
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 1024
+# файлы больше не сжимаем на лету, чтобы не держать их целиком в памяти
+COMPRESS_MAX_SIZE = 4 * 1024 * 1024
+COMPRESS_CACHE_SIZE = 16 * 1024 * 1024
+# учетный размер записи кеша сверх тела: без него записи "сжатие не помогло" ничего
+# не стоили бы, не вытеснялись и копились бы без ограничения
+ENTRY_OVERHEAD = 256
+# stat соседнего .gz/.br запоминается не больше чем для стольких файлов и на столько секунд
+SIBLING_CACHE_ENTRIES = 10000
+SIBLING_REVALIDATE_INTERVAL = 1.0
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+# порядок предпочтения кодировок при равном q
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+SIBLING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+class Variant:
+    """
+    Сжатое представление файла: готовые байты или путь к заранее сжатому соседнему файлу
+    """
+    def __init__(self, encoding, etag, body=None, path=None, size=None):
+        self.encoding = encoding
+        self.etag = etag
+        self.body = body
+        self.path = path
+        self.size = len(body) if body is not None else size
+
+
+class Compressor:
+    """
+    Выбор и подготовка сжатого варианта ответа по Accept-Encoding.
+    Сначала ищется соседний .br/.gz файл не старше исходного, иначе файл сжимается
+    и результат кладется в ограниченный по объему LRU-кеш, поэтому каждая версия
+    файла сжимается один раз. Если задан executor, сжатие выполняется в нем в фоне,
+    а до его окончания клиенты получают несжатый файл. Результат поиска соседнего файла
+    запоминается вместе с версией исходного, чтобы не делать лишний stat на каждый запрос
+    """
+    def __init__(
+            self,
+            level=COMPRESS_LEVEL,
+            min_size=COMPRESS_MIN_SIZE,
+            cache_size=COMPRESS_CACHE_SIZE,
+            executor=None
+    ):
+        self.level = level
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.executor = executor
+        self.variants = OrderedDict()
+        self.size = 0
+        # (путь, кодировка) -> (mtime_ns и размер исходного файла, время проверки, (путь, размер) соседа или None)
+        self.siblings = OrderedDict()
+        self.in_progress = set()
+        self.lock = Lock()
+
+    @staticmethod
+    def compressible(content_type):
+        return content_type is not None and (
+            content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+        )
+
+    def applies(self, request, content_type, st):
+        """
+        Будет ли select искать сжатый вариант (в том числе проверять соседние .gz/.br)
+        """
+        return (
+            self.compressible(content_type) and st.st_size >= self.min_size
+            and negotiate(request.get_all('Accept-Encoding')) is not None
+        )
+
+    def select(self, request, path, st, content_type, etag, entry=None):
+        """
+        Возвращаем Variant для ответа или None, если отдавать надо исходный файл
+        """
+        if not self.compressible(content_type) or st.st_size < self.min_size:
+            return None
+        encoding = negotiate(request.get_all('Accept-Encoding'))
+        if encoding is None:
+            return None
+        variant_etag = f'{etag[:-1]}-{encoding}"'
+
+        sibling = self.sibling(path, st, encoding, variant_etag)
+        if sibling is not None:
+            return sibling
+
+        if st.st_size > COMPRESS_MAX_SIZE:
+            return None
+        key = (path, st.st_mtime_ns, st.st_size, encoding)
+        with self.lock:
+            cached = self.variants.get(key)
+            if cached is not None:
+                self.variants.move_to_end(key)
+                return cached[0]
+            if self.executor is not None:
+                if key not in self.in_progress:
+                    self.in_progress.add(key)
+                    self.executor.submit(self.compress, key, variant_etag, entry)
+                return None
+        return self.compress(key, variant_etag, entry)
+
+    def sibling(self, path, st, encoding, etag):
+        key = (path, encoding)
+        version = (st.st_mtime_ns, st.st_size)
+        now = time.monotonic()
+        with self.lock:
+            cached = self.siblings.get(key)
+            if cached is not None and cached[0] == version and now - cached[1] < SIBLING_REVALIDATE_INTERVAL:
+                self.siblings.move_to_end(key)
+                found = cached[2]
+            else:
+                cached = None
+        if cached is None:
+            found = self.find_sibling(path, st, encoding)
+            with self.lock:
+                self.siblings[key] = (version, now, found)
+                self.siblings.move_to_end(key)
+                if len(self.siblings) > SIBLING_CACHE_ENTRIES:
+                    self.siblings.popitem(last=False)
+        if found is None:
+            return None
+        return Variant(encoding, etag, path=found[0], size=found[1])
+
+    @staticmethod
+    def find_sibling(path, st, encoding):
+        sibling_path = path + SIBLING_SUFFIXES[encoding]
+        try:
+            sibling_st = os.stat(sibling_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(sibling_st.st_mode) or sibling_st.st_mtime < st.st_mtime:
+            return None
+        return sibling_path, sibling_st.st_size
+
+    def invalidate(self, paths=None):
+        """
+        Забываем найденные соседние файлы в измененных paths, None - все
+        """
+        with self.lock:
+            stale = [
+                key for key in self.siblings
+                if paths is None or under(key[0] + SIBLING_SUFFIXES[key[1]], paths)
+            ]
+            for key in stale:
+                del self.siblings[key]
+
+    def compress(self, key, etag, entry=None):
+        path, mtime_ns, size, encoding = key
+        try:
+            if entry is not None and entry.mtime_ns == mtime_ns:
+                data = entry.body
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            if len(data) != size:
+                return None
+            if encoding == 'br':
+                body = brotli.compress(data, quality=min(self.level, 11))
+            else:
+                body = gzip.compress(data, compresslevel=min(self.level, 9), mtime=0)
+        except Exception as e:
+            logging.error(f'не удалось сжать {path}: {e}')
+            return None
+        finally:
+            with self.lock:
+                self.in_progress.discard(key)
+
+        variant = Variant(encoding, etag, body=body)
+        if variant.size >= size:
+            # сжатие не помогло, но запоминаем это, чтобы не сжимать повторно
+            variant = None
+        self.store(key, variant)
+        return variant
+
+    def store(self, key, variant):
+        size = ENTRY_OVERHEAD + (0 if variant is None else variant.size)
+        if size > self.cache_size:
+            return
+        with self.lock:
+            old = self.variants.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.variants[key] = (variant, size)
+            self.size += size
+            while self.size > self.cache_size:
+                _, (_, evicted_size) = self.variants.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self):
+        return {'entries': len(self.variants), 'size': self.size, 'siblings': len(self.siblings)}
+
+
+def negotiate(accept_encoding):
+    """
+    Выбираем кодировку из Accept-Encoding с наибольшим q среди поддерживаемых
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for value in accept_encoding:
+        for item in value.split(','):
+            coding, *params = item.strip().split(';')
+            q = 1.0
+            for param in params:
+                name, _, number = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        q = float(number)
+                    except ValueError:
+                        q = 0.0
+            if coding:
+                weights[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
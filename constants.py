@@ -1,2 +1,3 @@
 DEFAULT_HTTP_PROTOCOL = 'HTTP/1.1'
-OLD_HTTP_PROTOCOL = 'HTTP/1.0'
\ No newline at end of file
+OLD_HTTP_PROTOCOL = 'HTTP/1.0'
+HTTP2_PROTOCOL = 'HTTP/2'
@@ -0,0 +1,161 @@
+import logging
+import os
+import stat
+import time
+from collections import OrderedDict
+from threading import Lock
+from response import make_etag, http_date
+
+
+CACHE_SIZE = 32 * 1024 * 1024
+CACHE_MAX_FILE_SIZE = 256 * 1024
+CACHE_REVALIDATE_INTERVAL = 1.0
+
+
+class CacheEntry:
+    """
+    Закешированный файл: содержимое, заранее отрендеренные заголовки
+    (включая Last-Modified и ETag) и данные stat
+    """
+    def __init__(self, path, body, headers, st, checked_at):
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.inode = st.st_ino
+        self.stat = st
+        self.checked_at = checked_at
+
+    def matches(self, st):
+        return (st.st_mtime_ns, st.st_ino, st.st_size) == (self.mtime_ns, self.inode, self.size)
+
+
+class FileCache:
+    """
+    Общий для всех воркеров кеш горячих файлов по разрешенному пути.
+    Вытеснение LRU по суммарному объему, актуальность файла проверяется
+    по mtime/inode не чаще раза в revalidate_interval секунд
+    """
+    def __init__(
+            self,
+            max_size=CACHE_SIZE,
+            max_file_size=CACHE_MAX_FILE_SIZE,
+            revalidate_interval=CACHE_REVALIDATE_INTERVAL
+    ):
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.revalidate_interval = revalidate_interval
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, path, content_type, st=None):
+        """
+        Возвращаем запись для файла, при промахе читаем файл и кладем в кеш.
+        None - файл не подходит для кеширования и его надо отдавать с диска.
+        st - уже известный stat файла: по нему большие файлы отсекаются, не открывая их
+        """
+        if st is not None and not self.cacheable(st):
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+        if entry is not None and now - entry.checked_at >= self.revalidate_interval:
+            entry = self.revalidate(entry, now)
+        with self.lock:
+            if entry is not None:
+                self.hits += 1
+                return entry
+        return self.load(path, content_type, now)
+
+    def peek(self, path):
+        """
+        Запись из кеша, если ее не надо перепроверять, иначе None. Без обращения к диску
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and time.monotonic() - entry.checked_at < self.revalidate_interval:
+            return entry
+        return None
+
+    def cacheable(self, st):
+        return stat.S_ISREG(st.st_mode) and st.st_size <= self.max_file_size
+
+    def revalidate(self, entry, now):
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            self.discard(entry)
+            raise
+        if not entry.matches(st):
+            logging.info(f'файл {entry.path} изменился, удаляем из кеша')
+            self.discard(entry)
+            return None
+        entry.checked_at = now
+        return entry
+
+    def load(self, path, content_type, now):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not self.cacheable(st):
+                return None
+            body = f.read()
+        with self.lock:
+            self.misses += 1
+        if len(body) != st.st_size:
+            # файл меняется прямо сейчас, не кешируем
+            return None
+        return self.store(path, body, st, content_type, now)
+
+    def store(self, path, body, st, content_type, now=None):
+        """
+        Кладем в кеш уже прочитанное содержимое файла, body может быть memoryview
+        """
+        if now is None:
+            now = time.monotonic()
+        headers = (
+            (f'Content-Type: {content_type}\r\n' if content_type else '') +
+            f'Content-Length: {st.st_size}\r\n'
+            f'Last-Modified: {http_date(st.st_mtime)}\r\n'
+            f'ETag: {make_etag(st)}\r\n'
+            f'Accept-Ranges: bytes\r\n'
+        ).encode('iso-8859-1')
+        entry = CacheEntry(path, body, headers, st, now)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[path] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+        return entry
+
+    def forget(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def discard(self, entry):
+        with self.lock:
+            if self.entries.get(entry.path) is entry:
+                del self.entries[entry.path]
+                self.size -= entry.size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'size': self.size,
+        }
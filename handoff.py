@@ -0,0 +1,91 @@
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+
+# номера дескрипторов унаследованных слушающих сокетов через запятую
+LISTEN_FDS_ENV = 'HTTPD_LISTEN_FDS'
+# дескриптор канала, по которому новый процесс сообщает о готовности
+READY_FD_ENV = 'HTTPD_READY_FD'
+READY = b'ready'
+# сколько ждем готовности нового процесса
+RELOAD_TIMEOUT = 60.0
+
+
+def inherited_sockets():
+    """
+    Слушающие сокеты, переданные процессом, который нас запустил при перезагрузке
+    """
+    fds = os.environ.pop(LISTEN_FDS_ENV, '')
+    return [socket.socket(fileno=int(fd)) for fd in fds.split(',') if fd]
+
+
+def notify_ready():
+    """
+    Сообщаем старому процессу, что мы уже принимаем соединения и он может останавливаться
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    fd = int(fd)
+    try:
+        os.write(fd, READY)
+    except OSError as e:
+        logging.error(f'Не удалось сообщить о готовности старому процессу: {e}')
+    finally:
+        os.close(fd)
+
+
+class Successor:
+    """
+    Новый процесс сервера при перезагрузке: запускается с теми же аргументами
+    (конфигурация и код читаются заново) и наследует слушающие сокеты, поэтому
+    соединения не отвергаются ни в какой момент - пока оба процесса живы, их принимают оба.
+    Канал ready_fd становится читаемым, когда новый процесс готов или завершился, не успев
+    """
+    def __init__(self, listeners, timeout=RELOAD_TIMEOUT):
+        fds = [lsock.fileno() for lsock in listeners]
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FDS_ENV] = ','.join(map(str, fds))
+        env[READY_FD_ENV] = str(ready_w)
+        try:
+            self.process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=fds + [ready_w])
+        except OSError:
+            os.close(ready_r)
+            raise
+        finally:
+            os.close(ready_w)
+        os.set_blocking(ready_r, False)
+        self.ready_fd = ready_r
+        self.deadline = time.monotonic() + timeout
+        logging.info(f'запущен новый процесс сервера pid {self.process.pid}')
+
+    def check(self):
+        """
+        True - новый процесс готов, False - завершился без готовности, None - еще запускается
+        """
+        try:
+            answer = os.read(self.ready_fd, len(READY))
+        except BlockingIOError:
+            return None
+        if answer == READY:
+            return True
+        # EOF: процесс упал, например из-за ошибки в конфигурации
+        self.process.wait()
+        return False
+
+    def abort(self):
+        """
+        Новый процесс не стал готовым вовремя или мы останавливаемся: завершаем его, чтобы не остались оба
+        """
+        self.process.terminate()
+        self.process.wait()
+        self.close()
+
+    def close(self):
+        os.close(self.ready_fd)
@@ -0,0 +1,334 @@
+import base64
+import binascii
+import logging
+import os
+import re
+from collections import deque
+from constants import HTTP2_PROTOCOL
+from httpparser import Request
+from response import RequestSlot, FileBody, FileTruncatedError, MappedBody, StreamBody
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import hyperframe.frame
+except ImportError:
+    h2 = None
+
+
+# начало клиентской преамбулы, которое разборщик HTTP/1 принимает за запрос PRI
+PREFACE_REQUEST_LINE = b'PRI * HTTP/2.0\r\n\r\n'
+# сколько байт кадров DATA формируем за раз, когда выходной буфер соединения пуст
+SEND_BUDGET = 256 * 1024
+DEFAULT_WEIGHT = 16
+# сколько байт за раунд получает поток на единицу веса
+WEIGHT_QUANTUM = 1024
+# HTTP2-Settings - base64url без выравнивания, одна настройка SETTINGS занимает 6 байт
+SETTINGS_HEADER = re.compile(r'[A-Za-z0-9_-]*={0,2}')
+SETTING_SIZE = 6
+
+
+class Http2Error(Exception):
+    """
+    Клиент нарушил протокол: GOAWAY уже поставлен в отправку, соединение надо закрыть
+    """
+    pass
+
+
+def upgrade_settings(values):
+    """
+    Заголовок HTTP2-Settings запроса Upgrade: h2c в виде, который принимает h2 (base64url
+    с выравниванием), или None, если заголовок не единственный или не кодирует кадр SETTINGS
+    """
+    if len(values) != 1 or not SETTINGS_HEADER.fullmatch(values[0]):
+        return None
+    value = values[0].rstrip('=')
+    try:
+        payload = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    except binascii.Error:
+        return None
+    if len(payload) % SETTING_SIZE:
+        return None
+    return base64.urlsafe_b64encode(payload)
+
+
+class Http2Stream:
+    """
+    Ответ, который отправляется по потоку: оставшиеся части тела и вес приоритета
+    """
+    __slots__ = ('stream_id', 'parts', 'holders', 'weight')
+
+    def __init__(self, stream_id, parts, weight):
+        self.stream_id = stream_id
+        self.parts = deque(parts)
+        # срезы отображений, которые отпускаются после отправки потока
+        self.holders = []
+        self.weight = weight
+
+    def read(self, limit):
+        """
+        Следующий кусок тела не длиннее limit или None, если тело закончилось
+        """
+        parts = self.parts
+        while parts:
+            part = parts[0]
+            if isinstance(part, FileBody):
+                if not part.length:
+                    part.close()
+                    parts.popleft()
+                    continue
+                chunk = os.pread(part.fileno(), min(limit, part.length), part.offset)
+                if not chunk:
+                    raise FileTruncatedError('файл укоротился во время отправки')
+                part.advance(len(chunk))
+                return chunk
+            if isinstance(part, MappedBody):
+                parts[0] = part.view
+                self.holders.append(part)
+                continue
+            if isinstance(part, StreamBody):
+                if part.finished:
+                    part.close()
+                    parts.popleft()
+                    continue
+                for segment in reversed(part.next_segments()):
+                    parts.appendleft(segment)
+                continue
+            view = memoryview(part)
+            if len(view) <= limit:
+                parts.popleft()
+                if view:
+                    return view
+                continue
+            parts[0] = view[limit:]
+            return view[:limit]
+        return None
+
+    def close(self):
+        for part in self.parts:
+            if isinstance(part, (FileBody, MappedBody, StreamBody)):
+                part.close()
+        self.parts.clear()
+        for holder in self.holders:
+            holder.close()
+        self.holders = []
+
+
+class Http2Session:
+    """
+    HTTP/2 без TLS (h2c) поверх одного соединения: кадры разбирает и формирует библиотека h2
+    (включая HPACK и учет окон управления потоком), а сессия превращает запросы потоков
+    в слоты для воркеров и отправляет ответы. Тела отдаются по кругу между потоками
+    с долей, пропорциональной весу приоритета, и только в пределах окна потока
+    """
+    def __init__(self, addr):
+        config = h2.config.H2Configuration(client_side=False, header_encoding='iso-8859-1')
+        self.conn = h2.connection.H2Connection(config=config)
+        self.addr = addr
+        # запросы, которые формируются в воркерах или отправляются
+        self.streams = set()
+        self.sending = {}
+        self.requests = {}
+        self.weights = {}
+        self.terminated = False
+        # после GOAWAY - последний поток, который еще обслуживаем
+        self.last_stream_id = None
+
+    def start(self):
+        self.conn.initiate_connection()
+
+    def start_upgrade(self, settings_header, request):
+        """
+        Переход с HTTP/1.1 по Upgrade: h2c, запрос становится потоком 1.
+        Недопустимые значения настроек - Http2Error, тогда переход не делаем
+        """
+        try:
+            self.conn.initiate_upgrade_connection(settings_header)
+        except h2.exceptions.ProtocolError as e:
+            raise Http2Error(str(e) or type(e).__name__) from e
+        self.streams.add(1)
+        return self.make_slot(1, Request(request.method, request.target, HTTP2_PROTOCOL, request.headers))
+
+    @staticmethod
+    def make_slot(stream_id, request):
+        return RequestSlot(request, stream_id=stream_id)
+
+    def receive(self, data):
+        """
+        Разбираем пришедшие кадры, возвращаем слоты запросов, готовых к обработке.
+        При нарушении протокола выбрасываем Http2Error
+        """
+        ready = []
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError as e:
+            raise Http2Error(str(e) or type(e).__name__) from e
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.request_received(event, ready)
+            elif isinstance(event, h2.events.DataReceived):
+                # тела запросов не нужны (GET и HEAD), но окно надо вернуть клиенту
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                request = self.requests.pop(event.stream_id, None)
+                if request is not None:
+                    ready.append(self.make_slot(event.stream_id, request))
+            elif isinstance(event, h2.events.PriorityUpdated):
+                self.set_weight(event.stream_id, event.weight)
+            elif isinstance(event, h2.events.StreamReset):
+                self.drop(event.stream_id)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.terminated = True
+        return ready
+
+    def request_received(self, event, ready):
+        headers = {}
+        pseudo = {}
+        for name, value in event.headers:
+            if name.startswith(':'):
+                pseudo[name] = value
+            else:
+                headers.setdefault(name, []).append(value)
+        if ':authority' in pseudo:
+            headers.setdefault('host', [pseudo[':authority']])
+        if event.priority_updated is not None:
+            self.set_weight(event.stream_id, event.priority_updated.weight)
+        if self.last_stream_id is not None and event.stream_id > self.last_stream_id:
+            # поток открыт после GOAWAY, клиент может повторить его на новом соединении
+            self.conn.reset_stream(event.stream_id, h2.errors.ErrorCodes.REFUSED_STREAM)
+            return
+        request = Request(pseudo.get(':method', ''), pseudo.get(':path', '/'), HTTP2_PROTOCOL, headers)
+        self.streams.add(event.stream_id)
+        if event.stream_ended is not None:
+            ready.append(self.make_slot(event.stream_id, request))
+        else:
+            self.requests[event.stream_id] = request
+
+    def set_weight(self, stream_id, weight):
+        self.weights[stream_id] = weight
+        stream = self.sending.get(stream_id)
+        if stream is not None:
+            stream.weight = weight
+
+    def respond(self, slot):
+        """
+        Отправляем заголовки ответа, тело ставим в очередь на отправку.
+        slot.resp - заголовки списком пар и части тела
+        """
+        stream_id = slot.stream_id
+        headers, parts = slot.resp[0], slot.resp[1:]
+        slot.resp = None
+        stream = Http2Stream(stream_id, parts, self.weights.pop(stream_id, DEFAULT_WEIGHT))
+        if stream_id not in self.streams:
+            # клиент уже сбросил поток
+            stream.close()
+            return False
+        try:
+            self.conn.send_headers(stream_id, headers, end_stream=not parts)
+        except h2.exceptions.ProtocolError:
+            # клиент сбросил поток или закрыл соединение GOAWAY
+            self.drop(stream_id)
+            stream.close()
+            return False
+        if parts:
+            self.sending[stream_id] = stream
+        else:
+            self.streams.discard(stream_id)
+        return True
+
+    def pump(self, budget=SEND_BUDGET):
+        """
+        Формируем кадры DATA по кругу для потоков с открытым окном
+        и возвращаем байты для отправки. После GOAWAY клиента h2 не дает отправлять кадры,
+        поэтому недоотправленные тела бросаем, а соединение закрывается
+        """
+        conn = self.conn
+        if self.terminated:
+            self.close()
+            return conn.data_to_send()
+        produced = 0
+        while produced < budget and self.sending:
+            progress = False
+            for stream in sorted(self.sending.values(), key=lambda s: -s.weight):
+                quantum = stream.weight * WEIGHT_QUANTUM
+                while quantum > 0 and stream.stream_id in self.sending:
+                    try:
+                        window = conn.local_flow_control_window(stream.stream_id)
+                    except h2.exceptions.StreamClosedError:
+                        self.drop(stream.stream_id)
+                        break
+                    limit = min(window, quantum, conn.max_outbound_frame_size)
+                    if limit <= 0:
+                        break
+                    try:
+                        chunk = stream.read(limit)
+                    except Exception as e:
+                        logging.error(f'Ошибка отправки тела потока {stream.stream_id} для {self.addr}: {e}')
+                        self.reset(stream.stream_id)
+                        break
+                    try:
+                        if chunk is None:
+                            conn.end_stream(stream.stream_id)
+                        else:
+                            conn.send_data(stream.stream_id, chunk)
+                    except h2.exceptions.StreamClosedError:
+                        # клиент сбросил поток
+                        self.drop(stream.stream_id)
+                        break
+                    except h2.exceptions.ProtocolError as e:
+                        logging.error(f'Ошибка отправки HTTP/2 для {self.addr}: {e}')
+                        self.terminated = True
+                        self.close()
+                        return conn.data_to_send()
+                    if chunk is None:
+                        self.finish_stream(stream.stream_id)
+                        progress = True
+                        break
+                    quantum -= len(chunk)
+                    produced += len(chunk)
+                    progress = True
+            if not progress:
+                # все потоки ждут WINDOW_UPDATE
+                break
+        return conn.data_to_send()
+
+    def finish_stream(self, stream_id):
+        stream = self.sending.pop(stream_id, None)
+        if stream is not None:
+            stream.close()
+        self.streams.discard(stream_id)
+
+    def reset(self, stream_id):
+        try:
+            self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+        except h2.exceptions.ProtocolError:
+            pass
+        self.drop(stream_id)
+
+    def drop(self, stream_id):
+        self.requests.pop(stream_id, None)
+        self.weights.pop(stream_id, None)
+        self.finish_stream(stream_id)
+
+    def shutdown(self):
+        """
+        Плавная остановка: GOAWAY, уже начатые потоки дорабатывают. Возвращаем байты для отправки.
+        Кадр формируем сами, потому что после close_connection h2 считает соединение закрытым
+        и отвергает WINDOW_UPDATE, без которых большие ответы не дойдут
+        """
+        if self.last_stream_id is not None:
+            return self.conn.data_to_send()
+        self.last_stream_id = self.conn.highest_inbound_stream_id
+        frame = hyperframe.frame.GoAwayFrame(0)
+        frame.last_stream_id = self.last_stream_id
+        return self.conn.data_to_send() + frame.serialize()
+
+    def close(self):
+        for stream in self.sending.values():
+            stream.close()
+        self.sending.clear()
+        self.streams.clear()
+        self.requests.clear()
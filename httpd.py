@@ -1,19 +1,174 @@
+import errno
+import heapq
+import itertools
 import logging
+import math
+import os
+import shlex
+import signal
+import sys
+import threading
+import time
+from collections import deque
 from pathlib import Path
+from urllib.parse import parse_qs
 import socket
 import selectors
+import ssl
 import types
+from contextlib import contextmanager
 from optparse import OptionParser
-from response import Response
-from threadpool import ThreadPool
+from http import HTTPStatus
+from queue import SimpleQueue, Empty, Full
+from response import Response, ResponseSettings, RequestSlot, FileBody, MappedBody, StreamBody, clock
+from httpparser import RequestParser, ParseError
+from filecache import FileCache, CACHE_SIZE, CACHE_MAX_FILE_SIZE, CACHE_REVALIDATE_INTERVAL
+from routecache import RouteCache, ROUTE_CACHE_SIZE, log_files
+from manifest import Manifest
+from mmapcache import MmapCache, MMAP_BUDGET
+from autoindex import AutoIndex
+from ratelimit import RateLimiter
+from compression import Compressor, COMPRESS_LEVEL, COMPRESS_MIN_SIZE, COMPRESS_CACHE_SIZE
+from threadpool import ThreadPool, QUEUE_SIZE
+from metrics import Metrics
+from accesslog import AccessLog, MAX_BYTES, BACKUP_COUNT
+from prefork import Master
 from constants import DEFAULT_HTTP_PROTOCOL
 from constants import OLD_HTTP_PROTOCOL
+import http2
+import tls
+import handoff
+from profiling import Profiler, StackSampler, PROFILE_SECONDS, PROFILE_MAX_SECONDS
 
 
 SERVER_NAME = 'Python server'
+SENDFILE_CHUNK_SIZE = 256 * 1024
+RECV_SIZE = 64 * 1024
+KEEPALIVE_TIMEOUT = 15.0
+# за сколько секунд клиент должен прислать заголовки запроса целиком, иначе соединение закрывается
+HEADER_TIMEOUT = 10.0
+# сколько секунд может занимать отправка выходного буфера соединения
+SEND_TIMEOUT = 300.0
+# при таком числе соединений прием новых приостанавливается до закрытия одного из них
+MAX_CONNECTIONS = 10000
+LISTEN_BACKLOG = 1024
+# сколько соединений принимаем за одно событие готовности слушающего сокета
+ACCEPT_BATCH = 64
+DRAIN_TIMEOUT = 30.0
+# сколько байт ответов из памяти может ждать отправки, прежде чем перестанем читать запросы
+WRITE_HIGH_WATER = 1024 * 1024
+MAX_PIPELINE = 32
+IOV_MAX = 64
+# через сколько секунд предлагаем повторить запрос, отклоненный из-за перегрузки
+RETRY_AFTER = 1
+# неблокирующий сокет, в том числе SSL, просит дождаться готовности
+WOULD_BLOCK = (BlockingIOError,) + tls.WANT_IO
+# метки гистограммы времени по фазам обработки запроса
+PARSE_PHASE = (('phase', 'parse'),)
+FILE_IO_PHASE = (('phase', 'file_io'),)
+SEND_PHASE = (('phase', 'send'),)
+# метка служебного сокета пробуждения цикла в селекторе
+WAKEUP = 'wakeup'
+# канал готовности нового процесса при перезагрузке
+RELOAD = 'reload'
+# сколько готовых к повторному использованию объектов Response держит соединение
+RESPONSES_PER_CONNECTION = 4
+SWITCHING_PROTOCOLS = b'HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n'
+# опции, которые реализованы только в движке selectors: с asyncio они не должны молча пропадать
+SELECTORS_ONLY_OPTIONS = (
+    'max_workers', 'queue_size', 'header_timeout', 'send_timeout', 'max_connections',
+    'limit_rate', 'limit_burst', 'limit_connections', 'limit_ipv4_prefix', 'limit_ipv6_prefix',
+    'http2', 'slow_request_threshold', 'profile_path', 'status_path', 'access_log', 'access_log_format',
+    'access_log_max_bytes', 'access_log_backups', 'access_log_rotate', 'mmap_max_size',
+)
 
 
-class Server:
+class ResponseCaches:
+    """
+    Кеши и настройки ответов, общие для движков selectors и asyncio.
+    Перед setup_responses у сервера должны быть protocol, server_name, root_dir, keep_alive,
+    allowed_methods и allowed_http_protocols
+    """
+    def setup_responses(
+            self,
+            route_cache_size,
+            cache_size,
+            cache_max_file_size,
+            cache_revalidate,
+            manifest,
+            mmap_max_size,
+            mmap_budget,
+            autoindex,
+            compressor,
+            log_paths=(),
+            async_streams=False
+    ):
+        # разбор путей кешируется отдельно от содержимого, в том числе для отсутствующих файлов
+        self.route_cache = None
+        if route_cache_size > 0:
+            self.route_cache = RouteCache(self.root_dir, route_cache_size, ignore=log_files(*log_paths))
+        self.file_cache = None
+        if cache_size > 0:
+            self.file_cache = FileCache(cache_size, cache_max_file_size, cache_revalidate)
+        if manifest is not None:
+            manifest.warm(self.route_cache, self.file_cache)
+        # файлы больше лимита кеша и не больше mmap_max_size отдаются срезами общего mmap
+        self.mmap_cache = MmapCache(mmap_budget) if mmap_max_size > 0 else None
+        if self.mmap_cache is not None and self.route_cache is not None:
+            self.route_cache.add_listener(self.mmap_cache.invalidate)
+        self.mmap_min_size = cache_max_file_size + 1 if self.file_cache is not None else 0
+        self.mmap_max_size = mmap_max_size
+        # листинг каталогов без index.html
+        self.autoindex = AutoIndex() if autoindex else None
+        self.compressor = compressor
+        if compressor is not None and self.route_cache is not None:
+            self.route_cache.add_listener(compressor.invalidate)
+        # настройки и заготовки заголовков, общие для всех ответов
+        self.response_settings = ResponseSettings(
+            protocol=self.protocol,
+            server_name=self.server_name,
+            allowed_methods=self.allowed_methods,
+            allowed_http_protocols=self.allowed_http_protocols,
+            root_dir=self.root_dir,
+            keep_alive=self.keep_alive,
+            file_cache=self.file_cache,
+            compressor=self.compressor,
+            route_cache=self.route_cache,
+            mmap_cache=self.mmap_cache,
+            mmap_min_size=self.mmap_min_size,
+            mmap_max_size=self.mmap_max_size,
+            autoindex=self.autoindex,
+            async_streams=async_streams
+        )
+
+    def make_response(self, conn=None):
+        """
+        Объекты ответов переиспользуются между запросами соединения conn. Запас у каждого
+        соединения свой и на несколько объектов, т.к. конвейерные запросы и потоки HTTP/2
+        одного соединения формируются воркерами одновременно
+        """
+        if conn is not None and conn.responses:
+            return conn.responses.pop()
+        return Response(self.response_settings)
+
+    @staticmethod
+    def recycle_response(conn, resp):
+        # вызывается и из воркеров: append и pop у списка атомарны
+        if len(conn.responses) < RESPONSES_PER_CONNECTION:
+            resp.reset()
+            conn.responses.append(resp)
+
+    def close_caches(self):
+        if self.file_cache is not None:
+            logging.info(f"file cache stats: {self.file_cache.stats()}")
+        if self.route_cache is not None:
+            logging.info(f"route cache stats: {self.route_cache.stats()}")
+            self.route_cache.close()
+        if self.mmap_cache is not None:
+            logging.info(f"mmap stats: {self.mmap_cache.stats()}")
+
+
+class Server(ResponseCaches):
     def __init__(
             self,
             host='localhost',
@@ -22,13 +177,60 @@ class Server:
             workers=1,
             server_name=SERVER_NAME,
             protocol=DEFAULT_HTTP_PROTOCOL,
-            autorun=True
+            autorun=True,
+            keep_alive=True,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            header_timeout=HEADER_TIMEOUT,
+            send_timeout=SEND_TIMEOUT,
+            max_connections=MAX_CONNECTIONS,
+            limit_rate=0,
+            limit_burst=None,
+            limit_connections=0,
+            limit_ipv4_prefix=32,
+            limit_ipv6_prefix=128,
+            backlog=LISTEN_BACKLOG,
+            cache_size=CACHE_SIZE,
+            cache_max_file_size=CACHE_MAX_FILE_SIZE,
+            cache_revalidate=CACHE_REVALIDATE_INTERVAL,
+            route_cache_size=ROUTE_CACHE_SIZE,
+            manifest=None,
+            mmap_max_size=0,
+            mmap_budget=MMAP_BUDGET,
+            autoindex=False,
+            compress=True,
+            compress_level=COMPRESS_LEVEL,
+            compress_min_size=COMPRESS_MIN_SIZE,
+            compress_cache_size=COMPRESS_CACHE_SIZE,
+            reuse_port=False,
+            listen_sockets=(),
+            drain_timeout=DRAIN_TIMEOUT,
+            write_high_water=WRITE_HIGH_WATER,
+            max_pipeline=MAX_PIPELINE,
+            max_workers=None,
+            queue_size=QUEUE_SIZE,
+            status_path=None,
+            http2_enabled=False,
+            tls_context=None,
+            reload_on_sighup=False,
+            slow_request_threshold=None,
+            profile_path=None,
+            access_log=None,
+            access_log_format='combined',
+            access_log_max_bytes=MAX_BYTES,
+            access_log_backups=BACKUP_COUNT,
+            access_log_rotate=0
     ):
         self.sel = selectors.DefaultSelector()
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.listeners = []
+        self.accept_paused = False
 
-        if autorun:
+        for lsock in listen_sockets:
+            self.register_listener(lsock)
+        if not listen_sockets and autorun:
             self.run_server()
 
         self.root_dir = root_dir
@@ -36,111 +238,1204 @@ class Server:
         self.protocol = protocol
         self.allowed_http_protocols = [DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL]
         self.allowed_methods = ['GET', 'HEAD']
+        # HTTP/2 без TLS: по преамбуле (prior knowledge) и по Upgrade: h2c
+        self.http2 = http2_enabled
+        if http2_enabled and http2.h2 is None:
+            logging.error('Пакет h2 не установлен, HTTP/2 выключен')
+            self.http2 = False
         self.count_workers = workers
-        self.thread_pool = ThreadPool(workers)
+        self.thread_pool = ThreadPool(workers, max_workers, queue_size)
+        self.use_sendfile = hasattr(os, 'sendfile')
+        self.use_sendmsg = hasattr(socket.socket, 'sendmsg')
+        # HTTPS: sendmsg и sendfile у SSL-сокета недоступны, файлы идут через общий буфер
+        self.tls_context = tls_context
+        self.file_sender = None
+        if tls_context is not None:
+            tls.set_alpn(tls_context, self.http2)
+            self.use_sendmsg = False
+            self.file_sender = tls.FileSender()
+        self.write_high_water = write_high_water
+        self.write_low_water = write_high_water // 4
+        self.max_pipeline = max_pipeline
+        self.keep_alive = keep_alive
+        self.keepalive_timeout = keepalive_timeout
+        self.timeouts = {'header': header_timeout, 'idle': keepalive_timeout, 'send': send_timeout}
+        self.max_connections = max_connections
+        # ограничения на клиента проверяются в цикле событий до разбора и до пула
+        self.limiter = None
+        if limit_rate or limit_connections:
+            self.limiter = RateLimiter(limit_rate, limit_burst, limit_connections,
+                                       limit_ipv4_prefix, limit_ipv6_prefix)
+        # ответы формируются в воркерах пула, поэтому сжимаем прямо в них
+        compressor = None
+        if compress:
+            compressor = Compressor(compress_level, compress_min_size, compress_cache_size)
+        # срезы mmap отдаем только через sendmsg: если файл укоротили, ядро вернет EFAULT,
+        # а копирование отображения в запись TLS убило бы процесс SIGBUS
+        if mmap_max_size and not self.use_sendmsg:
+            logging.warning('mmap работает только без TLS и с sendmsg, большие файлы отдаются через sendfile')
+            mmap_max_size = 0
+        self.setup_responses(
+            route_cache_size, cache_size, cache_max_file_size, cache_revalidate, manifest,
+            mmap_max_size, mmap_budget, autoindex, compressor, log_paths=[access_log]
+        )
+        # единственная куча таймеров всех соединений (срок, порядковый номер, сокет, данные);
+        # устаревшие записи не удаляются, а пропускаются при извлечении
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.connections = {}
+        self.stop_requested = False
+        self.stopping = False
+        self.drain_timeout = drain_timeout
+        self.drain_deadline = None
+        # по SIGHUP запускаем новый процесс на тех же сокетах и уступаем ему, когда он готов
+        self.reload_on_sighup = reload_on_sighup
+        self.reload_requested = False
+        self.successor = None
+        # ответы, сформированные воркерами и еще не забранные циклом
+        self.completed = SimpleQueue()
+        # сокет, через который воркеры и обработчики сигналов будят select
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        # поштучное отладочное логирование соединений и запросов включается только на уровне DEBUG
+        self.debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.access_log = None
+        if access_log:
+            self.access_log = AccessLog(access_log, access_log_format, access_log_max_bytes,
+                                        access_log_backups, access_log_rotate)
+        # замеры фаз запросов заводятся, только если у профилировщика есть хуки: журнал медленных
+        # запросов, гистограмма фаз на странице статуса или добавленные через profiler.add_hook
+        self.profiler = Profiler(slow_request_threshold)
+        # семплирующий профилировщик запускается запросом к profile_path на ?seconds=N
+        self.profile_path = profile_path
+        self.sampler = None
+        # метрики собираются, только если включена страница статуса
+        self.status_path = status_path
+        self.metrics = None
+        if status_path:
+            self.metrics = self.make_metrics()
+            self.profiler.add_hook(self.observe_phases)
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.sel.register(self.wakeup_r, selectors.EVENT_READ, data=WAKEUP)
 
     def run_server(self, host=None, port=None):
-        host = self.host if host is None else host
-        port = self.port if port is None else port
-        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lsock.bind((host, port))
-        lsock.listen(5)
-        logging.info(f"listening on {host} {port}")
+        self.register_listener(create_listen_socket(
+            self.host if host is None else host,
+            self.port if port is None else port,
+            reuse_port=self.reuse_port,
+            backlog=self.backlog
+        ))
+
+    def register_listener(self, lsock):
         lsock.setblocking(False)
+        self.listeners.append(lsock)
         self.sel.register(lsock, selectors.EVENT_READ, data=None)
 
     def serve_forever(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.handle_sigterm)
+            if self.reload_on_sighup:
+                signal.signal(signal.SIGHUP, self.handle_sighup)
         try:
-            while True:
-                events = self.sel.select(timeout=None)
+            while not self.stopping or self.connections:
+                if self.stopping and time.monotonic() >= self.drain_deadline:
+                    logging.info(f"drain timeout, dropping {len(self.connections)} connections")
+                    break
+                events = self.sel.select(timeout=self.timers_timeout())
+                clock.tick()
                 for socket_with_data, mask in events:
+                    # начало плавной остановки или предыдущее событие могли уже закрыть сокет
                     if socket_with_data.data is None:
-                        self.accept_wrapper(socket_with_data.fileobj)
-                    else:
+                        if socket_with_data.fileobj in self.listeners:
+                            self.accept_wrapper(socket_with_data.fileobj)
+                    elif socket_with_data.data is WAKEUP:
+                        self.handle_wakeup()
+                    elif socket_with_data.data is RELOAD:
+                        self.check_successor()
+                    elif not socket_with_data.data.closed:
                         self.service_connection(socket_with_data, mask)
+                self.expire_timers()
+            if self.stopping:
+                # задачи соединений, уже закрытых клиентами, еще могут работать с файлами
+                remaining = max(0.0, self.drain_deadline - time.monotonic())
+                if not self.thread_pool.wait_completion(remaining):
+                    logging.warning('drain timeout, thread pool tasks left unfinished')
         except KeyboardInterrupt:
             logging.info("caught keyboard interrupt, exiting")
         finally:
             self.close()
 
+    def handle_sigterm(self, signum, frame):
+        self.stop_requested = True
+        self.wakeup()
+
+    def handle_sighup(self, signum, frame):
+        self.reload_requested = True
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            # буфер сокета полон - цикл и так будет разбужен
+            pass
+
+    def handle_wakeup(self):
+        try:
+            while self.wakeup_r.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                sock, data, slot = self.completed.get_nowait()
+            except Empty:
+                break
+            if data.closed:
+                if slot.resp:
+                    self.release_response(slot)
+                continue
+            with self.connection_errors(sock, data):
+                if data.h2 is not None:
+                    self.respond_http2(sock, data, slot)
+                else:
+                    self.write_responses(sock, data)
+        if self.reload_requested:
+            self.reload_requested = False
+            self.start_reload()
+        if self.stop_requested and not self.stopping:
+            self.start_drain()
+
+    def start_reload(self):
+        """
+        Перезагрузка без простоя: новый процесс наследует слушающие сокеты и сразу
+        начинает принимать соединения, а мы обслуживаем свои, пока он не сообщит о готовности
+        """
+        if self.stopping or self.successor is not None:
+            return
+        logging.info('получен SIGHUP, перезапускаемся')
+        try:
+            self.successor = handoff.Successor(self.listeners)
+        except OSError as e:
+            logging.error(f'Не удалось запустить новый процесс: {e}')
+            return
+        self.sel.register(self.successor.ready_fd, selectors.EVENT_READ, data=RELOAD)
+
+    def check_successor(self):
+        ready = self.successor.check()
+        if ready is None:
+            return
+        self.sel.unregister(self.successor.ready_fd)
+        self.successor.close()
+        if ready:
+            logging.info(f'новый процесс {self.successor.process.pid} готов, завершаем работу')
+            self.start_drain()
+        else:
+            logging.error('новый процесс завершился, не начав работу, продолжаем обслуживание')
+            self.successor = None
+
+    def start_drain(self):
+        """
+        Плавная остановка: перестаем принимать соединения, закрываем простаивающие
+        и дожидаемся отправки уже принятых запросов, но не дольше drain_timeout
+        """
+        logging.info(f"graceful shutdown, draining {len(self.connections)} connections")
+        self.stopping = True
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        for lsock in self.listeners:
+            if not self.accept_paused:
+                self.sel.unregister(lsock)
+            lsock.close()
+        self.listeners = []
+        for sock, data in list(self.connections.items()):
+            if data.h2 is not None:
+                # GOAWAY: новые потоки клиент не откроет, начатые дорабатывают
+                self.queue_output(data, data.h2.shutdown())
+                with self.connection_errors(sock, data):
+                    self.flush(sock, data)
+            elif not data.requests and not data.out and not data.fresh and not len(data.parser):
+                self.close_connection(sock, data)
+
     def accept_wrapper(self, sock):
-        conn, addr = sock.accept()
-        logging.info(f"accepted connection from {addr}")
+        """
+        Принимаем за одно событие все ожидающие соединения, но не больше ACCEPT_BATCH,
+        чтобы не задерживать обслуживание уже принятых
+        """
+        for _ in range(ACCEPT_BATCH):
+            if len(self.connections) >= self.max_connections:
+                logging.warning(f'Достигнут предел {self.max_connections} соединений, прием приостановлен')
+                self.pause_accepting()
+                return
+            try:
+                conn, addr = sock.accept()
+            except BlockingIOError:
+                # очередь пуста или соединение уже забрал другой процесс, слушающий тот же сокет
+                return
+            except OSError as e:
+                if e.errno == errno.ECONNABORTED:
+                    continue
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # соединения остаются в очереди ядра до закрытия одного из наших
+                    logging.error(f'Не удалось принять соединение: {e}, прием приостановлен')
+                    self.pause_accepting()
+                    return
+                raise
+            self.add_connection(conn, addr)
+
+    def pause_accepting(self):
+        if self.accept_paused:
+            return
+        for lsock in self.listeners:
+            self.sel.unregister(lsock)
+        self.accept_paused = True
+
+    def resume_accepting(self):
+        for lsock in self.listeners:
+            self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        self.accept_paused = False
+        logging.info('Прием соединений возобновлен')
+
+    def add_connection(self, conn, addr):
+        client = None
+        if self.limiter is not None:
+            client = self.limiter.connect(addr[0])
+            if client is None:
+                if self.debug:
+                    logging.debug(f"too many connections from {addr[0]}, closing")
+                if self.metrics:
+                    self.metrics.inc('ratelimit_rejected_total', (('reason', 'connections'),))
+                conn.close()
+                return
+        if self.debug:
+            logging.debug(f"accepted connection from {addr}")
+        if self.metrics:
+            self.metrics.inc('connections_accepted_total')
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", resp=None)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.sel.register(conn, events, data=data)
+        # заголовки и файл уходят разными вызовами, без этого второй ждет задержанного ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls_context is not None:
+            # рукопожатие идет в цикле событий по готовности сокета
+            conn = self.tls_context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+        data = types.SimpleNamespace(
+            addr=addr,
+            parser=RequestParser(),
+            requests=deque(),
+            deadline=None,
+            # какой таймаут сейчас отсчитывается: header, idle, send или None
+            timer_kind=None,
+            # учет соединения и запросов клиента в RateLimiter
+            client=client,
+            # Http2Session после перехода соединения на HTTP/2
+            h2=None,
+            handshaking=self.tls_context is not None,
+            closing=False,
+            # выходной буфер: memoryview и FileBody, отправляемые по EVENT_WRITE,
+            # и MappedBody после своего среза, отпускающий отображение файла
+            out=deque(),
+            out_size=0,
+            close_after=False,
+            read_paused=False,
+            send_started=None,
+            # ответы с замерами фаз, отправка которых еще не закончилась
+            profiled=[],
+            # объекты Response для следующих запросов соединения
+            responses=[],
+            events=selectors.EVENT_READ,
+            # запросов еще не было: при остановке такое соединение не закрываем как простаивающее,
+            # первый запрос клиента может быть уже в пути
+            fresh=True,
+            closed=False
+        )
+        self.sel.register(conn, selectors.EVENT_READ, data=data)
+        self.connections[conn] = data
+        self.schedule(conn, data)
 
     def service_connection(self, socket_with_data, mask):
         sock: socket.socket = socket_with_data.fileobj
         data = socket_with_data.data
-        if mask & selectors.EVENT_READ:
-            while True:
-                recv_data = self.recv(sock, 1024)
-                logging.info(f"get {recv_data}")
+        with self.connection_errors(sock, data):
+            if data.handshaking:
+                self.handshake(sock, data)
+                return
+            if mask & selectors.EVENT_READ:
+                recv_data = self.recv(sock, RECV_SIZE)
+                if self.debug:
+                    logging.debug(f"get {len(recv_data)} bytes from {data.addr}")
                 if not recv_data:
-                    logging.info(f"closing connection to {data.addr}")
-                    self.sel.unregister(sock)
-                    sock.close()
+                    if self.debug:
+                        logging.debug(f"closing connection to {data.addr}")
+                    self.close_connection(sock, data)
                     return
 
-                data.inb += recv_data
-                if recv_data.decode('utf-8').replace('\r\n', '\n').find('\n\n') != -1:
-                    logging.info('find end of headers')
+                if data.closing:
+                    pass
+                elif data.h2 is not None:
+                    self.receive_http2(sock, data, recv_data)
+                else:
+                    data.parser.feed(recv_data)
+                    self.read_requests(sock, data)
+
+            if mask & selectors.EVENT_WRITE and not data.closed:
+                self.flush(sock, data)
+
+    @contextmanager
+    def connection_errors(self, sock, data):
+        try:
+            yield
+        except WOULD_BLOCK:
+            pass
+        except ConnectionError:
+            if self.debug:
+                logging.debug('Connection reset by peer')
+            self.close_connection(sock, data)
+        except ssl.SSLError as e:
+            if self.debug:
+                logging.debug(f'TLS error from {data.addr}: {e}')
+            self.close_connection(sock, data)
+        except OSError as e:
+            # например, EFAULT у sendmsg, если отображенный файл укоротили во время отправки
+            logging.error(f'Ошибка отправки для {data.addr}: {e}')
+            self.close_connection(sock, data)
+
+    def handshake(self, sock, data):
+        """
+        Очередной шаг рукопожатия TLS: SSL сам говорит, чтения или записи ждать дальше.
+        После него по ALPN соединение сразу становится HTTP/2 или остается HTTP/1.1
+        """
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.set_events(sock, data, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.set_events(sock, data, selectors.EVENT_WRITE)
+            return
+        except OSError as e:
+            # в том числе ssl.SSLError: неподдерживаемая версия, шифры, чужой протокол
+            if self.debug:
+                logging.debug(f'TLS handshake with {data.addr} failed: {e}')
+            if self.metrics:
+                self.metrics.inc('tls_handshake_errors_total')
+            self.close_connection(sock, data)
+            return
+        data.handshaking = False
+        if self.metrics:
+            self.metrics.inc('tls_handshakes_total', (('resumed', int(sock.session_reused)),))
+        if sock.selected_alpn_protocol() == tls.ALPN_HTTP2:
+            session = http2.Http2Session(data.addr)
+            session.start()
+            self.switch_to_http2(sock, data, session)
+            return
+        self.schedule(sock, data)
+        self.update_interest(sock, data)
+
+    def read_requests(self, sock, data):
+        """
+        Выделяем из буфера все пришедшие целиком запросы (их может быть несколько
+        при конвейерной передаче) и ставим их в очередь соединения в порядке поступления
+        """
+        metrics = self.metrics
+        while not data.closing and len(data.requests) < self.max_pipeline:
+            started = time.perf_counter()
+            try:
+                request = data.parser.next_request()
+            except ParseError as e:
+                # после ошибки разбора границы запросов потеряны, дальнейший ввод игнорируем
+                if self.debug:
+                    logging.debug(f'Ошибка разбора запроса от {data.addr}: {e}')
+                slot = RequestSlot(None, started)
+                data.requests.append(slot)
+                self.make_response().form_error_response(slot, e.status)
+                data.closing = True
+                self.write_responses(sock, data)
+                break
+            if request is None:
+                break
+            data.fresh = False
+            if metrics:
+                metrics.observe('phase_seconds', time.perf_counter() - started, PARSE_PHASE)
+            if self.debug:
+                logging.debug(f'get request {request.request_line}')
+            # по TLS HTTP/2 согласуется только через ALPN
+            if self.http2 and self.tls_context is None and not data.requests \
+                    and self.start_http2(sock, data, request):
+                return
+            slot = RequestSlot(request, started)
+            if self.profiler.hooks:
+                slot.timings = self.profiler.timings(started)
+                slot.timings.mark('parse')
+            data.requests.append(slot)
+            if self.dispatch(sock, data, slot):
+                self.write_responses(sock, data)
+                if not slot.keep_alive:
+                    # отказ из-за переполненной очереди закрывает соединение
+                    data.closing = True
                     break
-            resp = Response(
-                protocol=self.protocol,
-                server_name=self.server_name,
-                allowed_methods=self.allowed_methods,
-                allowed_http_protocols=self.allowed_http_protocols,
-                root_dir=self.root_dir
+
+        if not data.closed:
+            self.schedule(sock, data)
+            self.update_interest(sock, data)
+
+    def dispatch(self, sock, data, slot):
+        """
+        Отдаем запрос воркерам. Служебную страницу и отказы формируем сразу в цикле
+        и возвращаем True - ответ уже в слоте
+        """
+        request = slot.request
+        path = request.target.partition('?')[0]
+        if self.status_path and path == self.status_path:
+            self.serve_status(slot)
+            return True
+        if self.profile_path and path == self.profile_path:
+            return self.start_profile(sock, data, slot)
+        if data.client is not None:
+            wait = self.limiter.take(data.client)
+            if wait:
+                # отказываем без обращения к файлам, соединение не закрываем
+                if self.metrics:
+                    self.metrics.inc('ratelimit_rejected_total', (('reason', 'rate'),))
+                self.make_response().form_error_response(
+                    slot, HTTPStatus.TOO_MANY_REQUESTS, {'Retry-After': math.ceil(wait)}, keep_alive=True
+                )
+                return True
+        resp = self.make_response(data)
+        try:
+            self.thread_pool.add_task(self.form_response, resp, slot, sock, data)
+        except Full:
+            # все воркеры заняты и очередь полна: отказываем сразу, не блокируя цикл.
+            # При перегрузке не пишем в журнал на каждый отказ, их считает пул (rejected)
+            if self.debug:
+                logging.debug(f'Очередь задач переполнена, отклоняем запрос от {data.addr}')
+            resp.form_error_response(slot, HTTPStatus.SERVICE_UNAVAILABLE, {'Retry-After': RETRY_AFTER})
+            self.recycle_response(data, resp)
+            return True
+        return False
+
+    def start_http2(self, sock, data, request):
+        """
+        Переводим соединение на HTTP/2 без TLS: по преамбуле клиента (prior knowledge)
+        или по Upgrade: h2c, тогда сам запрос становится потоком 1.
+        Возвращаем False, если запрос остается запросом HTTP/1
+        """
+        if request.method == 'PRI' and request.version == 'HTTP/2.0':
+            session = http2.Http2Session(data.addr)
+            session.start()
+            slots = []
+            # разборщик уже съел начало преамбулы как запрос PRI
+            rest = http2.PREFACE_REQUEST_LINE + data.parser.take_rest()
+        elif (
+                request.version == DEFAULT_HTTP_PROTOCOL
+                and request.method in self.allowed_methods
+                and 'h2c' in request.tokens('Upgrade')
+        ):
+            # с некорректным HTTP2-Settings соединение не переключаем, запрос обслуживается по HTTP/1.1
+            settings = http2.upgrade_settings(request.get_all('HTTP2-Settings'))
+            if settings is None:
+                return False
+            session = http2.Http2Session(data.addr)
+            try:
+                slots = [session.start_upgrade(settings, request)]
+            except http2.Http2Error as e:
+                if self.debug:
+                    logging.debug(f'upgrade to HTTP/2 from {data.addr} refused: {e}')
+                return False
+            self.queue_output(data, SWITCHING_PROTOCOLS)
+            rest = data.parser.take_rest()
+        else:
+            return False
+        self.switch_to_http2(sock, data, session, rest, slots)
+        return True
+
+    def switch_to_http2(self, sock, data, session, rest=b'', slots=()):
+        if self.debug:
+            logging.debug(f'connection from {data.addr} switched to HTTP/2')
+        if self.metrics:
+            self.metrics.inc('http2_connections_total')
+        data.h2 = session
+        self.receive_http2(sock, data, rest, slots)
+
+    def receive_http2(self, sock, data, recv_data, slots=()):
+        session = data.h2
+        slots = list(slots)
+        try:
+            slots.extend(session.receive(recv_data))
+        except http2.Http2Error as e:
+            logging.error(f'Ошибка протокола HTTP/2 от {data.addr}: {e}')
+            data.closing = True
+            data.close_after = True
+            slots = []
+        for slot in slots:
+            if self.debug:
+                logging.debug(f'get request {slot.request.request_line} on stream {slot.stream_id}')
+            if self.profiler.hooks:
+                slot.timings = self.profiler.timings(slot.started)
+                slot.timings.mark('parse')
+            if self.dispatch(sock, data, slot):
+                self.record_response(data, slot)
+                session.respond(slot)
+        if session.terminated:
+            # клиент прислал GOAWAY
+            data.close_after = True
+        self.queue_output(data, session.conn.data_to_send())
+        self.flush(sock, data)
+
+    def respond_http2(self, sock, data, slot):
+        """
+        Ответ воркера отправляем по своему потоку, порядок потоков не важен
+        """
+        self.record_response(data, slot)
+        if self.metrics and not data.out:
+            data.send_started = time.perf_counter()
+        if slot.timings is not None:
+            # кадры потока перемежаются с другими потоками, поэтому отправку не замеряем
+            slot.timings.mark('wait')
+            self.profiler.finish(slot)
+        data.h2.respond(slot)
+        self.queue_output(data, data.h2.conn.data_to_send())
+        self.flush(sock, data)
+
+    def pump_http2(self, data):
+        """
+        Формируем следующую порцию кадров DATA, когда выходной буфер опустел
+        """
+        self.queue_output(data, data.h2.pump())
+        if data.h2.terminated:
+            # после GOAWAY клиента тела не досылаются
+            data.close_after = True
+        return bool(data.out)
+
+    @staticmethod
+    def queue_output(data, payload):
+        if payload:
+            view = memoryview(payload)
+            data.out.append(view)
+            data.out_size += len(view)
+
+    def form_response(self, resp, slot, sock, data):
+        """
+        Выполняется в воркере: формируем ответ и будим цикл событий,
+        чтобы он забрал ответ в выходной буфер соединения
+        """
+        started = time.perf_counter()
+        if slot.timings is not None:
+            slot.timings.mark('queue')
+        try:
+            resp.form_response_no_return(slot)
+        finally:
+            self.recycle_response(data, resp)
+            if self.metrics:
+                self.metrics.observe('phase_seconds', time.perf_counter() - started, FILE_IO_PHASE)
+            self.completed.put((sock, data, slot))
+            self.wakeup()
+
+    def log_access(self, data, slot, body_size):
+        request = slot.request
+        if request is not None:
+            record = (time.time(), data.addr[0], request.request_line, slot.status.value, body_size,
+                      request.get('Referer'), request.get('User-Agent'), time.perf_counter() - slot.started)
+        else:
+            record = (time.time(), data.addr[0], '-', slot.status.value, body_size,
+                      None, None, time.perf_counter() - slot.started)
+        self.access_log.log(record)
+
+    def make_metrics(self):
+        metrics = Metrics()
+        metrics.add_gauge('connections_active', lambda: len(self.connections))
+        metrics.add_gauge('thread_pool', self.thread_pool_stats)
+        if self.file_cache is not None:
+            metrics.add_gauge('file_cache', self.file_cache.stats)
+        if self.compressor is not None:
+            metrics.add_gauge('compress_cache', self.compressor.stats)
+        if self.route_cache is not None:
+            metrics.add_gauge('route_cache', self.route_cache.stats)
+        if self.mmap_cache is not None:
+            metrics.add_gauge('mmap', self.mmap_cache.stats)
+        if self.limiter is not None:
+            metrics.add_gauge('rate_limiter', self.limiter.stats)
+        if self.autoindex is not None:
+            metrics.add_gauge('autoindex', self.autoindex.stats)
+        if self.access_log is not None:
+            metrics.add_gauge('access_log', self.access_log.stats)
+        if self.tls_context is not None:
+            metrics.add_gauge('tls_sessions', self.tls_context.session_stats)
+        if self.profiler.slow_threshold is not None:
+            metrics.add_gauge('profiler', self.profiler.stats)
+        return metrics
+
+    def thread_pool_stats(self):
+        stats = self.thread_pool.stats()
+        stats['busy'] = stats['workers'] - stats['idle']
+        return stats
+
+    def serve_status(self, slot):
+        """
+        Страница статуса формируется прямо в цикле: метрики в формате Prometheus,
+        а при ?format=json или Accept: application/json - в JSON
+        """
+        request = slot.request
+        if 'format=json' in request.target or 'application/json' in request.get('Accept', ''):
+            body, content_type = self.metrics.render_json(), 'application/json'
+        else:
+            body, content_type = self.metrics.render_prometheus(), 'text/plain; version=0.0.4'
+        self.make_response().form_content_response(slot, body, content_type)
+
+    def start_profile(self, sock, data, slot):
+        """
+        Запускаем семплирующий профилировщик на ?seconds=N (с idle=1 - вместе со стеками
+        ожидания), ответ с collapsed stacks отдается по его окончании.
+        Возвращаем True, если ответ уже сформирован
+        """
+        params = parse_qs(slot.request.target.partition('?')[2])
+        try:
+            seconds = float(params.get('seconds', [PROFILE_SECONDS])[0])
+        except ValueError:
+            seconds = -1
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            self.make_response().form_error_response(slot, HTTPStatus.BAD_REQUEST, keep_alive=True)
+            return True
+        if self.sampler is not None:
+            self.make_response().form_error_response(slot, HTTPStatus.CONFLICT, keep_alive=True)
+            return True
+        logging.info(f'профилирование на {seconds} сек по запросу от {data.addr}')
+        self.sampler = StackSampler(
+            seconds, lambda sampler: self.finish_profile(sock, data, slot, sampler),
+            include_idle=params.get('idle', ['0'])[0] == '1'
+        )
+        self.sampler.start()
+        return False
+
+    def finish_profile(self, sock, data, slot, sampler):
+        """
+        Выполняется в потоке профилировщика: отдаем результат так же, как воркер
+        """
+        try:
+            self.make_response().form_content_response(slot, sampler.collapsed(), 'text/plain; charset=utf-8')
+        finally:
+            logging.info(f'профилирование завершено: {sampler.samples} замеров, {len(sampler.stacks)} стеков')
+            self.sampler = None
+            self.completed.put((sock, data, slot))
+            self.wakeup()
+
+    def observe_phases(self, slot, timings):
+        for phase, duration in timings.phases:
+            self.metrics.observe('request_phase_seconds', duration, (('phase', phase),))
+
+    def write_responses(self, sock, data):
+        """
+        Переносим готовые ответы в выходной буфер строго в порядке запросов,
+        после ответа без keep-alive остальные запросы отбрасываются
+        """
+        metrics = self.metrics
+        if metrics and not data.out and data.requests and data.requests[0].resp is not None:
+            data.send_started = time.perf_counter()
+        while data.requests and data.requests[0].resp is not None and not data.close_after:
+            slot = data.requests.popleft()
+            if slot.timings is not None:
+                slot.timings.mark('wait')
+                data.profiled.append(slot)
+            body_size = 0
+            for segment in slot.resp:
+                if isinstance(segment, FileBody):
+                    body_size += segment.length
+                    data.out.append(segment)
+                    continue
+                if isinstance(segment, StreamBody):
+                    # длина потокового тела заранее неизвестна и в журнал не попадает
+                    data.out.append(segment)
+                    continue
+                if isinstance(segment, MappedBody):
+                    data.out.append(segment.view)
+                    data.out_size += len(segment.view)
+                    body_size += len(segment.view)
+                else:
+                    segment = memoryview(segment)
+                    data.out_size += len(segment)
+                    body_size += len(segment)
+                data.out.append(segment)
+            self.record_response(data, slot, body_size - len(slot.resp[0]))
+            slot.resp = None
+            if not slot.keep_alive:
+                data.close_after = True
+                self.release_requests(data)
+        self.flush(sock, data)
+
+    def record_response(self, data, slot, body_size=None):
+        """
+        Учитываем ответ в метриках и журнале доступа
+        """
+        if self.metrics:
+            method = slot.request.method if slot.request is not None else '-'
+            self.metrics.inc('requests_total', (('method', method), ('status', slot.status.value)))
+        if self.access_log is not None:
+            if body_size is None:
+                # тело ответа HTTP/2 - все части после списка заголовков
+                body_size = sum(
+                    part.length if isinstance(part, FileBody) else len(part)
+                    for part in slot.resp[1:] if not isinstance(part, StreamBody)
+                )
+            self.log_access(data, slot, body_size)
+
+    def flush(self, sock, data):
+        """
+        Отправляем выходной буфер, сколько позволяет сокет: подряд идущие сегменты
+        из памяти одним sendmsg без склейки, файлы через sendfile
+        """
+        try:
+            while data.out or data.h2 is not None and self.pump_http2(data):
+                segment = data.out[0]
+                if isinstance(segment, FileBody):
+                    while segment.length:
+                        self.send_file(sock, segment)
+                    segment.close()
+                    data.out.popleft()
+                    continue
+                if isinstance(segment, MappedBody):
+                    # срез отображения отправлен целиком
+                    segment.close()
+                    data.out.popleft()
+                    continue
+                if isinstance(segment, StreamBody):
+                    # следующий кусок берем, только когда предыдущий уже отправлен
+                    if not self.next_stream_segments(data, segment):
+                        self.close_connection(sock, data)
+                        return
+                    continue
+                buffers = list(itertools.islice(
+                    itertools.takewhile(lambda s: isinstance(s, memoryview), data.out), IOV_MAX
+                ))
+                if self.use_sendmsg:
+                    sent = sock.sendmsg(buffers)
+                elif self.tls_context is not None:
+                    sent = sock.send(tls.coalesce(buffers))
+                else:
+                    sent = sock.send(buffers[0])
+                self.consume_output(data, sent)
+                if self.metrics:
+                    self.metrics.inc('bytes_sent_total', value=sent)
+        except WOULD_BLOCK:
+            pass
+
+        if self.metrics and not data.out and data.send_started is not None:
+            self.metrics.observe('phase_seconds', time.perf_counter() - data.send_started, SEND_PHASE)
+            data.send_started = None
+        if data.profiled and not data.out:
+            for slot in data.profiled:
+                slot.timings.mark('send')
+                self.profiler.finish(slot)
+            data.profiled.clear()
+
+        if not data.out:
+            if data.close_after:
+                if self.debug:
+                    logging.debug(f"closing connection to {data.addr}")
+                self.close_connection(sock, data)
+                return
+            if self.stopping and not self.busy(data):
+                self.close_connection(sock, data)
+                return
+        self.schedule(sock, data)
+        self.update_interest(sock, data)
+
+    def next_stream_segments(self, data, body):
+        """
+        Ставим в начало выходного буфера следующий кусок потокового тела.
+        False - генератор тела упал, и ответ остается оборванным
+        """
+        try:
+            buffers = body.next_segments()
+        except Exception as e:
+            logging.error(f'Ошибка формирования тела ответа для {data.addr}: {e}')
+            return False
+        if body.finished:
+            body.close()
+            data.out.popleft()
+        for buffer in reversed(buffers):
+            buffer = memoryview(buffer)
+            data.out.appendleft(buffer)
+            data.out_size += len(buffer)
+        return True
+
+    @staticmethod
+    def consume_output(data, sent):
+        data.out_size -= sent
+        while sent:
+            segment = data.out[0]
+            if sent < len(segment):
+                data.out[0] = segment[sent:]
+                return
+            sent -= len(segment)
+            data.out.popleft()
+
+    def update_interest(self, sock, data):
+        """
+        EVENT_WRITE нужен только пока есть что отправлять, а чтение приостанавливается,
+        когда выходной буфер или очередь запросов выше порога, и возобновляется ниже нижнего
+        """
+        was_paused = data.read_paused
+        if was_paused:
+            data.read_paused = (
+                data.out_size > self.write_low_water or len(data.requests) >= self.max_pipeline
+            )
+        else:
+            data.read_paused = (
+                data.out_size > self.write_high_water or len(data.requests) >= self.max_pipeline
             )
-            self.thread_pool.add_task(resp.form_response_no_return, socket_with_data.data)
 
-        if mask & selectors.EVENT_WRITE:
-            if data.resp:
-                logging.info(f"try send {data.resp} to {data.addr}")
-                self.sendall(sock, data.resp)
+        events = 0 if data.read_paused else selectors.EVENT_READ
+        if data.out:
+            events |= selectors.EVENT_WRITE
+        self.set_events(sock, data, events)
 
-                self.sel.unregister(sock)
-                sock.close()
+        if was_paused and not data.read_paused:
+            # в буфере разборщика могли остаться запросы, пришедшие до паузы
+            self.read_requests(sock, data)
+
+    def set_events(self, sock, data, events):
+        if events == data.events:
+            return
+        if not data.events:
+            self.sel.register(sock, events, data=data)
+        elif not events:
+            self.sel.unregister(sock)
+        else:
+            self.sel.modify(sock, events, data=data)
+        data.events = events
 
     def recv(self, sock, size):
         try:
             return sock.recv(size)
         except ConnectionResetError:
-            logging.info('Connection reset by peer')
-            self.sel.unregister(sock)
-            sock.close()
+            if self.debug:
+                logging.debug('Connection reset by peer')
+            return b''
 
-    def sendall(self, sock, data):
-        try:
-            return sock.sendall(data)
-        except ConnectionResetError:
-            logging.info('Connection reset by peer')
+    def send_file(self, sock, body):
+        """
+        Отправляем очередной кусок файла через sendfile, под TLS - через общий буфер цикла,
+        а где sendfile нет - через чтение в буфер
+        """
+        size = min(body.length, SENDFILE_CHUNK_SIZE)
+        if self.file_sender is not None:
+            sent = self.file_sender.send(sock, body)
+        elif self.use_sendfile:
+            try:
+                sent = os.sendfile(sock.fileno(), body.fileno(), body.offset, size)
+            except OSError as e:
+                if isinstance(e, (BlockingIOError, ConnectionError)):
+                    raise
+                logging.info(f'sendfile недоступен ({e}), переходим на чтение в буфер')
+                self.use_sendfile = False
+                return
+        else:
+            sent = sock.send(body.read(size))
+        if not sent:
+            raise BrokenPipeError()
+        body.advance(sent)
+        if self.metrics:
+            self.metrics.inc('bytes_sent_total', value=sent)
+
+    def close_connection(self, sock, data):
+        data.deadline = None
+        data.closed = True
+        if data.client is not None:
+            self.limiter.disconnect(data.client)
+            data.client = None
+        self.release_requests(data)
+        data.profiled.clear()
+        if data.h2 is not None:
+            data.h2.close()
+        # срезы отображений выбрасываем раньше, чем отпускаем сами отображения
+        bodies = [segment for segment in data.out if not isinstance(segment, memoryview)]
+        data.out.clear()
+        for body in bodies:
+            body.close()
+        data.out_size = 0
+        self.connections.pop(sock, None)
+        if data.events:
             self.sel.unregister(sock)
-            sock.close()
+        sock.close()
+        if self.accept_paused and not self.stopping and len(self.connections) < self.max_connections:
+            self.resume_accepting()
+
+    def release_requests(self, data):
+        for slot in data.requests:
+            if slot.resp:
+                self.release_response(slot)
+        data.requests.clear()
+
+    @staticmethod
+    def release_response(data):
+        for segment in data.resp:
+            if isinstance(segment, (FileBody, MappedBody, StreamBody)):
+                segment.close()
+        data.resp = None
+
+    @staticmethod
+    def busy(data):
+        """
+        Есть ли запросы, ответы на которые еще формируются или отправляются
+        """
+        return bool(data.requests or data.h2 is not None and data.h2.streams)
+
+    def schedule(self, sock, data):
+        """
+        Выбираем таймаут по состоянию соединения: отправка ответа, ожидание заголовков
+        начатого запроса или простой между запросами; пока запросы обрабатываются
+        воркерами, таймера нет. Срок переставляется только при смене состояния,
+        поэтому клиент, присылающий заголовки по байту, не продлевает его
+        """
+        if data.handshaking:
+            # рукопожатие TLS ограничено тем же сроком, что и заголовки запроса
+            kind = 'header'
+        elif data.out or data.h2 is not None and data.h2.sending:
+            # потоки HTTP/2, ждущие WINDOW_UPDATE, тоже ограничены таймаутом отправки
+            kind = 'send'
+        elif self.busy(data):
+            kind = None
+        elif len(data.parser):
+            kind = 'header'
+        else:
+            kind = 'idle'
+        if kind == data.timer_kind:
+            return
+        data.timer_kind = kind
+        if kind is None:
+            data.deadline = None
+        else:
+            self.set_timer(sock, data, self.timeouts[kind])
+
+    def set_timer(self, sock, data, timeout):
+        data.deadline = time.monotonic() + timeout
+        heapq.heappush(self.timers, (data.deadline, next(self.timer_seq), sock, data))
+        if len(self.timers) > 2 * len(self.connections) + 64:
+            # устаревших записей стало больше живых - перестраиваем кучу, чтобы она не росла
+            self.timers = [entry for entry in self.timers if entry[3].deadline == entry[0]]
+            heapq.heapify(self.timers)
+
+    def timers_timeout(self):
+        """
+        Сколько можно ждать в select до ближайшего таймера
+        """
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - time.monotonic())
+
+    def expire_timers(self):
+        """
+        Закрываем соединения, у которых истек таймаут, проверяя только вершину кучи
+        """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, sock, data = heapq.heappop(self.timers)
+            if data.deadline != deadline:
+                continue
+            if data.timer_kind == 'idle':
+                if self.debug:
+                    logging.debug(f"closing idle connection to {data.addr}")
+            else:
+                logging.info(f'Истек таймаут {data.timer_kind} соединения {data.addr}, закрываем')
+            if self.metrics:
+                self.metrics.inc('timeouts_total', (('kind', data.timer_kind),))
+            self.close_connection(sock, data)
 
     def close(self):
+        self.close_caches()
+        logging.info(f"thread pool stats: {self.thread_pool.stats()}")
+        if self.limiter is not None:
+            logging.info(f"rate limiter stats: {self.limiter.stats()}")
+        if self.access_log is not None:
+            logging.info(f"access log stats: {self.access_log.stats()}")
+            self.access_log.close()
+        for sock in list(self.connections):
+            sock.close()
+        self.connections.clear()
+        for lsock in self.listeners:
+            lsock.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
         self.sel.close()
 
 
+def create_listen_socket(host, port, reuse_port=False, backlog=LISTEN_BACKLOG):
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # каждый процесс слушает свой сокет, ядро само распределяет соединения
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind((host, port))
+    lsock.listen(backlog)
+    logging.info(f"listening on {host} {port}")
+    return lsock
+
+
+def read_config(path):
+    """
+    Файл конфигурации - те же опции, что и в командной строке, можно по нескольку в строке,
+    после # - комментарий. Перечитывается новым процессом при перезагрузке по SIGHUP
+    """
+    args = []
+    with open(path) as f:
+        for line in f:
+            args.extend(shlex.split(line, comments=True))
+    return args
+
+
 def main():
     op = OptionParser()
+    op.add_option("--config", default=None, help="file with options, command line options override it")
     op.add_option("-p", "--port", type=int, default=8080)
     op.add_option("-l", "--log", default=None)
+    op.add_option("--debug", action="store_true", default=False, help="log every connection and request")
+    op.add_option("--access_log", default=None, help="write an access log to this file")
+    op.add_option("--access_log_format", type="choice", choices=["combined", "json"], default="combined")
+    op.add_option("--access_log_max_bytes", type=int, default=MAX_BYTES, help="rotate at this size, 0 - never")
+    op.add_option("--access_log_backups", type=int, default=BACKUP_COUNT)
+    op.add_option("--access_log_rotate", type=float, default=0, help="rotate every N seconds, 0 - never")
     op.add_option("-w", "--workers", type=int, default=1)
+    op.add_option("--max_workers", type=int, default=None,
+                  help="the pool grows up to this many workers under load, default - fixed size")
+    op.add_option("--queue_size", type=int, default=QUEUE_SIZE,
+                  help="pending tasks above this are answered with 503")
     op.add_option("-r", "--root_dir", type=str, default=str(Path(__file__).parent))
+    op.add_option("--keepalive_timeout", type=float, default=KEEPALIVE_TIMEOUT, help="idle timeout between requests")
+    op.add_option("--header_timeout", type=float, default=HEADER_TIMEOUT,
+                  help="seconds to receive the complete request headers")
+    op.add_option("--send_timeout", type=float, default=SEND_TIMEOUT,
+                  help="seconds to send a response that does not fit into the socket buffer")
+    op.add_option("--max_connections", type=int, default=MAX_CONNECTIONS,
+                  help="stop accepting while this many connections are open")
+    op.add_option("--limit_rate", type=float, default=0,
+                  help="requests per second per client, above it 429; 0 - unlimited")
+    op.add_option("--limit_burst", type=float, default=None, help="requests allowed in a burst, default - limit_rate")
+    op.add_option("--limit_connections", type=int, default=0,
+                  help="concurrent connections per client, 0 - unlimited")
+    op.add_option("--limit_ipv4_prefix", type=int, default=32, help="group IPv4 clients by this prefix, e.g. 24")
+    op.add_option("--limit_ipv6_prefix", type=int, default=128, help="group IPv6 clients by this prefix, e.g. 64")
+    op.add_option("--slow_request_threshold", type=float, default=None,
+                  help="log requests slower than this many seconds with their phase timings")
+    op.add_option("--profile_path", default=None,
+                  help="run the sampling profiler for ?seconds=N on requests to this path, e.g. /_profile")
+    op.add_option("--tls_cert", default=None, help="serve HTTPS with this PEM certificate chain")
+    op.add_option("--tls_key", default=None, help="private key for --tls_cert, if not in the same file")
+    op.add_option("--http2", action="store_true", default=False,
+                  help="serve HTTP/2 over cleartext (h2c: prior knowledge and Upgrade), requires h2")
+    op.add_option("--backlog", type=int, default=LISTEN_BACKLOG, help="listen queue length")
+    op.add_option("--no_keep_alive", action="store_false", dest="keep_alive", default=True)
+    op.add_option("--cache_size", type=int, default=CACHE_SIZE, help="bytes, 0 disables the file cache")
+    op.add_option("--cache_max_file_size", type=int, default=CACHE_MAX_FILE_SIZE)
+    op.add_option("--cache_revalidate", type=float, default=CACHE_REVALIDATE_INTERVAL)
+    op.add_option("--route_cache_size", type=int, default=ROUTE_CACHE_SIZE, help="0 disables the route cache")
+    op.add_option("--mmap_max_size", type=int, default=0,
+                  help="files above the cache limit and up to this size are served from a shared mmap, "
+                       "larger ones with sendfile; 0 disables mmap")
+    op.add_option("--mmap_budget", type=int, default=MMAP_BUDGET, help="max bytes mapped at once")
+    op.add_option("--autoindex", action="store_true", default=False,
+                  help="list directories without index.html")
+    op.add_option("--preload", action="store_true", default=False,
+                  help="index root_dir at startup and load small files into memory")
+    op.add_option("--no_compress", action="store_false", dest="compress", default=True)
+    op.add_option("--compress_level", type=int, default=COMPRESS_LEVEL)
+    op.add_option("--compress_min_size", type=int, default=COMPRESS_MIN_SIZE)
+    op.add_option("--compress_cache_size", type=int, default=COMPRESS_CACHE_SIZE)
+    op.add_option("--write_high_water", type=int, default=WRITE_HIGH_WATER)
+    op.add_option("--max_pipeline", type=int, default=MAX_PIPELINE)
+    op.add_option("--status_path", default=None, help="serve metrics at this path, e.g. /_status")
+    op.add_option("--processes", type=int, default=0, help="number of worker processes, 0 - single process")
+    op.add_option("--shared_socket", action="store_true", default=False,
+                  help="share one inherited listening socket instead of SO_REUSEPORT")
+    op.add_option("--drain_timeout", type=float, default=DRAIN_TIMEOUT)
+    op.add_option("--engine", type="choice", choices=["selectors", "asyncio"], default="selectors")
+    op.add_option("--no_uvloop", action="store_false", dest="use_uvloop", default=True)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
+    if opts.config:
+        (opts, args) = op.parse_args(read_config(opts.config) + sys.argv[1:])
+    logging.basicConfig(filename=opts.log, level=logging.DEBUG if opts.debug else logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = Server(
+    server_options = dict(
         host='localhost',
         port=opts.port,
         root_dir=opts.root_dir,
-        workers=opts.workers)
+        workers=opts.workers,
+        keep_alive=opts.keep_alive,
+        keepalive_timeout=opts.keepalive_timeout,
+        backlog=opts.backlog,
+        cache_size=opts.cache_size,
+        cache_max_file_size=opts.cache_max_file_size,
+        cache_revalidate=opts.cache_revalidate,
+        route_cache_size=opts.route_cache_size,
+        mmap_max_size=opts.mmap_max_size,
+        mmap_budget=opts.mmap_budget,
+        autoindex=opts.autoindex,
+        compress=opts.compress,
+        compress_level=opts.compress_level,
+        compress_min_size=opts.compress_min_size,
+        compress_cache_size=opts.compress_cache_size,
+        drain_timeout=opts.drain_timeout,
+        write_high_water=opts.write_high_water,
+        max_pipeline=opts.max_pipeline)
     logging.info("Starting server at %s" % opts.port)
+    if opts.preload:
+        # строим до запуска процессов, чтобы дочерние разделяли буфер с мастером
+        server_options['manifest'] = Manifest(
+            opts.root_dir, opts.cache_max_file_size, opts.cache_size
+        ).build()
+    if opts.tls_cert:
+        # до запуска процессов, чтобы у всех были одни ключи билетов сессий
+        server_options['tls_context'] = tls.make_server_context(opts.tls_cert, opts.tls_key)
+    server_class = Server
+    if opts.engine == 'asyncio':
+        unsupported = [name for name in SELECTORS_ONLY_OPTIONS if getattr(opts, name) != op.defaults[name]]
+        if unsupported:
+            op.error('--engine asyncio does not support ' + ', '.join('--' + name for name in unsupported))
+        # импортируем здесь, т.к. aioserver сам использует httpd
+        from aioserver import AsyncServer
+        server_class = AsyncServer
+        server_options['use_uvloop'] = opts.use_uvloop
+    else:
+        server_options['max_workers'] = opts.max_workers
+        server_options['header_timeout'] = opts.header_timeout
+        server_options['send_timeout'] = opts.send_timeout
+        server_options['max_connections'] = opts.max_connections
+        server_options['limit_rate'] = opts.limit_rate
+        server_options['limit_burst'] = opts.limit_burst
+        server_options['limit_connections'] = opts.limit_connections
+        server_options['limit_ipv4_prefix'] = opts.limit_ipv4_prefix
+        server_options['limit_ipv6_prefix'] = opts.limit_ipv6_prefix
+        server_options['http2_enabled'] = opts.http2
+        server_options['slow_request_threshold'] = opts.slow_request_threshold
+        server_options['profile_path'] = opts.profile_path
+        server_options['queue_size'] = opts.queue_size
+        server_options['status_path'] = opts.status_path
+        server_options['access_log'] = opts.access_log
+        server_options['access_log_format'] = opts.access_log_format
+        server_options['access_log_max_bytes'] = opts.access_log_max_bytes
+        server_options['access_log_backups'] = opts.access_log_backups
+        server_options['access_log_rotate'] = opts.access_log_rotate
+    # при перезагрузке по SIGHUP слушающий сокет достается от старого процесса
+    inherited = handoff.inherited_sockets()
+    if opts.processes > 0:
+        # сокеты открывает мастер и передает новому мастеру при перезагрузке, поэтому соединения
+        # в их очередях не теряются, даже когда старые процессы закрывают свои копии
+        shared = opts.shared_socket or not hasattr(socket, 'SO_REUSEPORT') or not all(
+            lsock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT) for lsock in inherited
+        )
+        if shared:
+            listeners = inherited or [create_listen_socket('localhost', opts.port, backlog=opts.backlog)]
+        else:
+            # по сокету SO_REUSEPORT на процесс, ядро само распределяет соединения
+            listeners = inherited + [
+                create_listen_socket('localhost', opts.port, reuse_port=True, backlog=opts.backlog)
+                for _ in range(opts.processes - len(inherited))
+            ]
+        Master(
+            opts.processes, lambda sockets: server_class(listen_sockets=sockets, **server_options), listeners, shared
+        ).run()
+        return
+
+    server_options['listen_sockets'] = inherited
+    server_options['reload_on_sighup'] = True
+    server = server_class(**server_options)
+    handoff.notify_ready()
     server.serve_forever()
 
 
@@ -0,0 +1,169 @@
+from http import HTTPStatus
+from constants import OLD_HTTP_PROTOCOL
+
+
+MAX_REQUEST_LINE = 8190
+MAX_HEADERS_SIZE = 16384
+MAX_HEADERS = 100
+# конец заголовков - перевод строки, за которым идет пустая строка;
+# допускаются переносы как через \r\n, так и через один \n
+HEAD_TERMINATORS = (b'\n\r\n', b'\n\n')
+
+
+class ParseError(Exception):
+    """
+    Запрос не удалось разобрать, status - код ответа клиенту
+    """
+    def __init__(self, status: HTTPStatus, message=''):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class Request:
+    """
+    Разобранный запрос: метод, цель, версия протокола и заголовки,
+    заголовки хранятся по имени в нижнем регистре списком значений
+    """
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def get(self, name, default=None):
+        values = self.headers.get(name.lower())
+        return values[-1] if values else default
+
+    def get_all(self, name):
+        return self.headers.get(name.lower(), [])
+
+    def tokens(self, name):
+        """
+        Значения заголовка-списка (Connection, Accept-Encoding...) в нижнем регистре
+        """
+        return [token.strip().lower() for value in self.get_all(name) for token in value.split(',')]
+
+    def wants_keep_alive(self):
+        """
+        В HTTP/1.1 соединение постоянное, если клиент не прислал Connection: close,
+        в HTTP/1.0 - только если клиент явно попросил Connection: keep-alive
+        """
+        connection = self.tokens('Connection')
+        if self.version == OLD_HTTP_PROTOCOL:
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    @property
+    def request_line(self):
+        return f'{self.method} {self.target} {self.version}'
+
+
+class RequestParser:
+    """
+    Инкрементальный разборщик запросов: данные копятся в bytearray,
+    поиск конца заголовков продолжается с места, где остановился на прошлом куске,
+    а декодируется только целиком пришедший блок заголовков
+    """
+    def __init__(self, max_request_line=MAX_REQUEST_LINE, max_headers_size=MAX_HEADERS_SIZE):
+        self.buffer = bytearray()
+        # начало неразобранных данных: разобранные запросы вырезаются из буфера
+        # не сразу, а когда их накопится больше половины, чтобы не сдвигать его на каждом запросе
+        self.start = 0
+        self.scan_from = 0
+        self.max_request_line = max_request_line
+        self.max_headers_size = max_headers_size
+
+    def feed(self, data):
+        self.buffer += data
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def next_request(self):
+        """
+        Возвращаем очередной запрос из буфера или None, если он еще не пришел целиком
+        """
+        buffer = self.buffer
+        size = len(buffer)
+        start = self.start
+        # пустые строки перед запросом игнорируем
+        while start < size and buffer[start] in b'\r\n':
+            start += 1
+        if start != self.start:
+            self.start = start
+            self.scan_from = start
+
+        end = -1
+        for terminator in HEAD_TERMINATORS:
+            pos = buffer.find(terminator, self.scan_from)
+            if pos != -1 and (end == -1 or pos + len(terminator) < end):
+                end = pos + len(terminator)
+
+        if end == -1:
+            self.check_limits(size - start)
+            # терминатор мог разрезаться между кусками, поэтому отступаем на его длину
+            self.scan_from = max(start, size - 2)
+            self.compact()
+            return None
+
+        self.check_limits(end - start)
+        with memoryview(buffer) as view:
+            head = str(view[start:end], 'iso-8859-1')
+        self.start = self.scan_from = end
+        self.compact()
+        return parse_head(head)
+
+    def take_rest(self):
+        """
+        Забираем неразобранный остаток буфера при переходе на другой протокол
+        """
+        rest = bytes(self.buffer[self.start:])
+        self.buffer.clear()
+        self.start = self.scan_from = 0
+        return rest
+
+    def compact(self):
+        if self.start and self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.scan_from -= self.start
+            self.start = 0
+
+    def check_limits(self, head_size):
+        """
+        Строку запроса и блок заголовков после нее проверяем каждый по своему лимиту
+        """
+        start = self.start
+        line_end = self.buffer.find(b'\n', start, start + min(head_size, self.max_request_line + 1))
+        if line_end == -1:
+            if head_size > self.max_request_line:
+                raise ParseError(HTTPStatus.REQUEST_URI_TOO_LONG)
+            return
+        if start + head_size - line_end - 1 > self.max_headers_size:
+            raise ParseError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+
+def parse_head(head):
+    lines = head.split('\n')
+    request_line = lines[0].rstrip('\r')
+
+    # цель запроса может содержать пробелы, поэтому метод и версию отделяем по краям
+    method, _, rest = request_line.partition(' ')
+    target, _, version = rest.rpartition(' ')
+    if not method or not target or not version.startswith('HTTP/'):
+        raise ParseError(HTTPStatus.BAD_REQUEST, f'Некорректная строка запроса {request_line!r}')
+
+    headers = {}
+    count = 0
+    for line in lines[1:]:
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep or not name or name != name.strip():
+            raise ParseError(HTTPStatus.BAD_REQUEST, f'Некорректный заголовок {line!r}')
+        count += 1
+        if count > MAX_HEADERS:
+            raise ParseError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+        headers.setdefault(name.lower(), []).append(value.strip())
+
+    return Request(method, target, version, headers)
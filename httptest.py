@@ -4,8 +4,16 @@ import sys
 
 v3 = sys.version_info[0] == 3
 
+import gzip
+import os
 import re
+import shutil
 import socket
+import subprocess
+import tempfile
+import threading
+import time
+from signal import SIGHUP, SIGKILL, SIGTERM
 
 if v3:
     import http.client as httplib
@@ -13,6 +21,17 @@ else:
     import httplib
 import unittest
 
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+    import hyperframe.frame
+except ImportError:
+    h2 = None
+
+HTTPD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "httpd.py")
+
 
 class HttpServer(unittest.TestCase):
     host = "localhost"
@@ -223,6 +242,141 @@ class HttpServer(unittest.TestCase):
         else:
             self.assertIn(int(code), (400, 405))
 
+    def test_keep_alive(self):
+        """persistent connection serves several requests"""
+        for _ in range(3):
+            self.conn.request("GET", "/httptest/dir2/page.html")
+            r = self.conn.getresponse()
+            data = r.read()
+            self.assertEqual(int(r.status), 200)
+            self.assertEqual(len(data), 38)
+            self.assertFalse(r.will_close)
+
+    def test_pipelining(self):
+        """pipelined requests answered in order"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((self.host, self.port))
+        request = ("GET /httptest/dir2/page.html HTTP/1.1\r\n\r\n"
+                   "GET /httptest/text..txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+        if v3:
+            s.sendall(request.encode())
+            data = b""
+        else:
+            s.sendall(request)
+            data = ""
+        while 1:
+            buf = s.recv(1024)
+            if not buf: break
+            data += buf
+        s.close()
+
+        if v3:
+            first = data.find(b"Page Sample")
+            second = data.find(b"hello")
+        else:
+            first = data.find("Page Sample")
+            second = data.find("hello")
+        self.assertTrue(0 < first < second, "responses are out of order")
+
+    def test_http2_request_line(self):
+        """HTTP/2 in an HTTP/1 request line gets an HTTP/1.1 error"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((self.host, self.port))
+        request = "GET /httptest/dir2/ HTTP/2\r\n\r\n"
+        if v3:
+            s.sendall(request.encode())
+            data = b""
+        else:
+            s.sendall(request)
+            data = ""
+        while 1:
+            buf = s.recv(1024)
+            if not buf: break
+            data += buf
+        s.close()
+
+        if v3:
+            self.assertTrue(data.startswith(b"HTTP/1.1 403 "))
+        else:
+            self.assertTrue(data.startswith("HTTP/1.1 403 "))
+
+    def test_conditional_get(self):
+        """conditional get returns 304"""
+        self.conn.request("GET", "/httptest/splash.css")
+        r = self.conn.getresponse()
+        r.read()
+        etag = r.getheader("ETag")
+        last_modified = r.getheader("Last-Modified")
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(last_modified)
+
+        self.conn.request("GET", "/httptest/splash.css", headers={"If-None-Match": etag})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 304)
+        self.assertEqual(len(data), 0)
+
+        self.conn.request("GET", "/httptest/splash.css", headers={"If-Modified-Since": last_modified})
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 304)
+
+    def test_range(self):
+        """single byte range returns 206"""
+        self.conn.request("GET", "/httptest/wikipedia_russia.html", headers={"Range": "bytes=100-199"})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 206)
+        self.assertEqual(r.getheader("Content-Range"), "bytes 100-199/954824")
+        self.assertEqual(len(data), 100)
+
+        self.conn.request("GET", "/httptest/text..txt", headers={"Range": "bytes=-3"})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 206)
+        if v3:
+            self.assertEqual(data, b"llo")
+        else:
+            self.assertEqual(data, "llo")
+
+    def test_multiple_ranges(self):
+        """multiple byte ranges return multipart/byteranges"""
+        self.conn.request("GET", "/httptest/text..txt", headers={"Range": "bytes=0-0,4-4"})
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 206)
+        self.assertTrue(r.getheader("Content-Type").startswith("multipart/byteranges"))
+        self.assertEqual(int(r.getheader("Content-Length")), len(data))
+        if v3:
+            self.assertIn(b"Content-Range: bytes 0-0/5\r\n\r\nh\r\n", data)
+            self.assertIn(b"Content-Range: bytes 4-4/5\r\n\r\no\r\n", data)
+        else:
+            self.assertIn("Content-Range: bytes 0-0/5\r\n\r\nh\r\n", data)
+            self.assertIn("Content-Range: bytes 4-4/5\r\n\r\no\r\n", data)
+
+    def test_range_not_satisfiable(self):
+        """unsatisfiable range returns 416"""
+        self.conn.request("GET", "/httptest/text..txt", headers={"Range": "bytes=100-"})
+        r = self.conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 416)
+
+    def test_gzip_encoding(self):
+        """gzip content encoding for text files"""
+        # сжатие может выполняться в фоне, поэтому первые ответы бывают несжатыми
+        for _ in range(20):
+            self.conn.request("GET", "/httptest/jquery-1.9.1.js", headers={"Accept-Encoding": "gzip"})
+            r = self.conn.getresponse()
+            data = r.read()
+            self.assertEqual(int(r.status), 200)
+            self.assertEqual(r.getheader("Vary"), "Accept-Encoding")
+            self.assertEqual(int(r.getheader("Content-Length")), len(data))
+            if r.getheader("Content-Encoding") == "gzip":
+                break
+            time.sleep(0.05)
+        self.assertEqual(r.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(len(gzip.decompress(data)), 268381)
+
     def test_filetype_html(self):
         """Content-Type for .html"""
         self.conn.request("GET", "/httptest/dir2/page.html")
@@ -320,10 +474,453 @@ class HttpServer(unittest.TestCase):
         self.assertEqual(ctype, "application/x-shockwave-flash")
 
 
+class StartedServer(unittest.TestCase):
+    """Base for tests that need a server with special options: httpd.py is started on a free port"""
+    host = "localhost"
+    options = []
+
+    @classmethod
+    def setUpClass(cls):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind((cls.host, 0))
+        cls.port = s.getsockname()[1]
+        s.close()
+        cls.process = subprocess.Popen(
+            [sys.executable, HTTPD, "-p", str(cls.port)] + cls.options,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection((cls.host, cls.port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or cls.process.poll() is not None:
+                    cls.tearDownClass()
+                    raise
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        try:
+            cls.process.wait(10)
+        except subprocess.TimeoutExpired:
+            cls.process.kill()
+            cls.process.wait()
+
+    def connect(self):
+        s = socket.create_connection((self.host, self.port), timeout=10)
+        self.addCleanup(s.close)
+        return s
+
+
+def read_until_closed(s):
+    data = b""
+    while True:
+        buf = s.recv(65536)
+        if not buf:
+            return data
+        data += buf
+
+
+class Timeouts(StartedServer):
+    options = ["--header_timeout", "0.5", "--keepalive_timeout", "1.5"]
+
+    def test_header_timeout(self):
+        """connection closed when headers do not arrive in time"""
+        s = self.connect()
+        started = time.time()
+        s.sendall(b"GET /httptest/dir2/page.html HTTP/1.1\r\n")
+        closed = False
+        # присланные по байту заголовки не продлевают срок
+        while time.time() - started < 5:
+            try:
+                s.sendall(b"X")
+            except OSError:
+                closed = True
+                break
+            s.settimeout(0.1)
+            try:
+                if s.recv(1024) == b"":
+                    closed = True
+                    break
+            except socket.timeout:
+                pass
+        self.assertTrue(closed, "connection is still open")
+        self.assertLess(time.time() - started, 1.4)
+
+    def test_idle_timeout(self):
+        """idle keep-alive connection closed after keepalive timeout"""
+        s = self.connect()
+        s.sendall(b"GET /httptest/dir2/page.html HTTP/1.1\r\n\r\n")
+        data = b""
+        while b"Page Sample" not in data:
+            data += s.recv(1024)
+        started = time.time()
+        self.assertEqual(read_until_closed(s), b"")
+        elapsed = time.time() - started
+        self.assertGreater(elapsed, 1.0)
+        self.assertLess(elapsed, 5)
+
+
+class RateLimit(StartedServer):
+    options = ["--limit_rate", "0.5", "--limit_burst", "2"]
+
+    def test_rate_limit(self):
+        """requests over the client rate return 429 with Retry-After"""
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+        self.addCleanup(conn.close)
+        statuses = []
+        for _ in range(3):
+            conn.request("GET", "/httptest/dir2/page.html")
+            r = conn.getresponse()
+            r.read()
+            statuses.append(int(r.status))
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertGreaterEqual(int(r.getheader("Retry-After")), 1)
+        # отказ не закрывает соединение, а ограничение действует и на новые соединения клиента
+        self.assertFalse(r.will_close)
+        conn.request("GET", "/httptest/dir2/page.html")
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 429)
+        other = httplib.HTTPConnection(self.host, self.port, timeout=10)
+        self.addCleanup(other.close)
+        other.request("GET", "/httptest/dir2/page.html")
+        r = other.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 429)
+
+
+class Overload(StartedServer):
+    """
+    The only worker is kept busy by reading a FIFO, so a second request fills
+    the one-slot task queue and the third one is shed
+    """
+    options = ["-w", "1", "--max_workers", "1", "--queue_size", "1", "--route_cache_size", "0",
+               "--drain_timeout", "1", "--status_path", "/_status"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root_dir = tempfile.mkdtemp()
+        os.mkfifo(os.path.join(cls.root_dir, "fifo"))
+        with open(os.path.join(cls.root_dir, "page.html"), "w") as f:
+            f.write("<html></html>\n")
+        cls.options = cls.options + ["-r", cls.root_dir]
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.root_dir)
+
+    def release_fifo(self):
+        """Let the worker blocked on the FIFO read EOF"""
+        deadline = time.time() + 5
+        while True:
+            try:
+                os.close(os.open(os.path.join(self.root_dir, "fifo"), os.O_WRONLY | os.O_NONBLOCK))
+                return
+            except OSError:
+                # воркер еще не открыл FIFO
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.02)
+
+    def wait_pool(self, name, value):
+        """Wait until the status page shows the thread pool gauge with this value"""
+        line = ("httpd_thread_pool_%s %d" % (name, value)).encode()
+        deadline = time.time() + 5
+        while True:
+            conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+            conn.request("GET", "/_status")
+            data = conn.getresponse().read()
+            conn.close()
+            if line in data.split(b"\n"):
+                return
+            self.assertLess(time.time(), deadline, "thread pool never reached %s %d" % (name, value))
+            time.sleep(0.02)
+
+    def test_overload_shedding(self):
+        """full task queue returns 503 with Retry-After"""
+        busy = []
+        for name, value in (("idle", 0), ("queued", 1)):
+            s = self.connect()
+            s.sendall(b"GET /fifo HTTP/1.1\r\nConnection: close\r\n\r\n")
+            busy.append(s)
+            self.wait_pool(name, value)
+
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+        self.addCleanup(conn.close)
+        conn.request("GET", "/page.html")
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 503)
+        self.assertIsNotNone(r.getheader("Retry-After"))
+
+        for s in busy:
+            self.release_fifo()
+            self.assertTrue(read_until_closed(s).startswith(b"HTTP/1.1 "))
+
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+        self.addCleanup(conn.close)
+        conn.request("GET", "/page.html")
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(int(r.status), 200)
+
+
+@unittest.skipIf(h2 is None, "h2 is not installed")
+class Http2(StartedServer):
+    options = ["--http2"]
+
+    def h2_connection(self):
+        return h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding="utf-8"))
+
+    def read_streams(self, s, conn, stream_ids, data=b""):
+        """Feed server frames to the h2 connection until the given streams end"""
+        streams = {}
+        ended = set()
+        while True:
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.ResponseReceived):
+                    streams[event.stream_id] = [dict(event.headers), b""]
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1] += event.data
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    ended.add(event.stream_id)
+            s.sendall(conn.data_to_send())
+            if ended >= set(stream_ids):
+                return streams
+            data = s.recv(65536)
+            self.assertNotEqual(data, b"", "connection closed before streams ended")
+
+    def test_prior_knowledge(self):
+        """HTTP/2 with prior knowledge serves concurrent streams"""
+        s = self.connect()
+        conn = self.h2_connection()
+        conn.initiate_connection()
+        for stream_id, path in ((1, "/httptest/dir2/page.html"), (3, "/httptest/notexist.html")):
+            conn.send_headers(stream_id, [(":method", "GET"), (":path", path), (":scheme", "http"),
+                                          (":authority", self.host)], end_stream=True)
+        s.sendall(conn.data_to_send())
+        streams = self.read_streams(s, conn, (1, 3))
+        self.assertEqual(streams[1][0][":status"], "200")
+        self.assertIn(b"Page Sample", streams[1][1])
+        self.assertEqual(streams[3][0][":status"], "404")
+
+    def request_page(self):
+        s = self.connect()
+        conn = self.h2_connection()
+        conn.initiate_connection()
+        conn.send_headers(1, [(":method", "GET"), (":path", "/httptest/dir2/page.html"), (":scheme", "http"),
+                              (":authority", self.host)], end_stream=True)
+        s.sendall(conn.data_to_send())
+        return self.read_streams(s, conn, (1,))[1]
+
+    def test_goaway_while_sending(self):
+        """GOAWAY during a window-blocked body closes only that connection"""
+        s = self.connect()
+        conn = self.h2_connection()
+        conn.local_settings = h2.settings.Settings(
+            client=True, initial_values={h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: 1024}
+        )
+        conn.initiate_connection()
+        conn.send_headers(1, [(":method", "GET"), (":path", "/httptest/wikipedia_russia.html"), (":scheme", "http"),
+                              (":authority", self.host)], end_stream=True)
+        s.sendall(conn.data_to_send())
+        while True:
+            data = s.recv(65536)
+            self.assertNotEqual(data, b"", "connection closed before the body")
+            if any(isinstance(event, h2.events.DataReceived) for event in conn.receive_data(data)):
+                break
+        # окно открывается в том же пакете, что и GOAWAY
+        frames = []
+        for stream_id in (1, 0):
+            frame = hyperframe.frame.WindowUpdateFrame(stream_id)
+            frame.window_increment = 65535
+            frames.append(frame.serialize())
+        goaway = hyperframe.frame.GoAwayFrame(0)
+        frames.append(goaway.serialize())
+        s.sendall(b"".join(frames))
+        read_until_closed(s)
+        headers, body = self.request_page()
+        self.assertEqual(headers[":status"], "200")
+
+    def test_upgrade(self):
+        """Upgrade: h2c switches protocols and answers the request on stream 1"""
+        s = self.connect()
+        conn = self.h2_connection()
+        settings = conn.initiate_upgrade_connection()
+        s.sendall(b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\n"
+                  b"Connection: Upgrade, HTTP2-Settings\r\nUpgrade: h2c\r\n"
+                  b"HTTP2-Settings: " + settings + b"\r\n\r\n")
+        data = b""
+        while b"\r\n\r\n" not in data:
+            buf = s.recv(65536)
+            self.assertNotEqual(buf, b"", "connection closed before 101")
+            data += buf
+        head, rest = data.split(b"\r\n\r\n", 1)
+        self.assertTrue(head.startswith(b"HTTP/1.1 101 "))
+        s.sendall(conn.data_to_send())
+        streams = self.read_streams(s, conn, (1,), rest)
+        self.assertEqual(streams[1][0][":status"], "200")
+        self.assertIn(b"Page Sample", streams[1][1])
+
+    def test_upgrade_bad_settings(self):
+        """malformed HTTP2-Settings keeps the connection on HTTP/1.1"""
+        for settings in (b"A", b"\xe9", b"AAIAAAAC"):
+            s = self.connect()
+            s.sendall(b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+                      b"Upgrade: h2c\r\nHTTP2-Settings: " + settings + b"\r\n\r\n")
+            data = read_until_closed(s)
+            self.assertTrue(data.startswith(b"HTTP/1.1 200 "), settings)
+            self.assertIn(b"Page Sample", data)
+
+
+@unittest.skipUnless(os.path.isdir("/proc"), "needs /proc to find server processes")
+class Reload(StartedServer):
+    """Prefork master: SIGHUP hands listeners to a new master, crashed workers are restarted"""
+    options = ["--processes", "2"]
+
+    @classmethod
+    def server_processes(cls):
+        """pid -> parent pid of every httpd.py process serving our port"""
+        processes = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open("/proc/%s/cmdline" % name, "rb") as f:
+                    cmdline = f.read().split(b"\0")
+                with open("/proc/%s/stat" % name) as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            if HTTPD.encode() in cmdline and str(cls.port).encode() in cmdline:
+                processes[int(name)] = ppid
+        return processes
+
+    @classmethod
+    def masters(cls):
+        """Processes with workers, including a new master started by the old one, or without a server parent"""
+        processes = cls.server_processes()
+        parents = set(processes.values())
+        return [pid for pid, ppid in processes.items() if pid in parents or ppid not in processes]
+
+    @classmethod
+    def tearDownClass(cls):
+        super(Reload, cls).tearDownClass()
+        # после перезагрузки работает новый мастер, его запускали не мы
+        deadline = time.time() + 10
+        while cls.server_processes():
+            for pid in cls.masters():
+                os.kill(pid, SIGKILL if time.time() > deadline else SIGTERM)
+            time.sleep(0.2)
+
+    def setUp(self):
+        # предыдущий тест мог оставить старый мастер доделывать соединения
+        self.wait_for(lambda: len(self.masters()) == 1 and len(self.workers(self.masters()[0])) == 2)
+
+    def workers(self, master):
+        processes = self.server_processes()
+        parents = set(processes.values())
+        return [pid for pid, ppid in processes.items() if ppid == master and pid not in parents]
+
+    def request_page(self):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=10)
+        try:
+            conn.request("GET", "/httptest/dir2/page.html")
+            r = conn.getresponse()
+            r.read()
+            return int(r.status)
+        finally:
+            conn.close()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 15
+        while not condition():
+            self.assertLess(time.time(), deadline, "timed out")
+            time.sleep(0.1)
+
+    def test_reload_under_load(self):
+        """no request fails while SIGHUP replaces the master and its workers"""
+        old_master, = self.masters()
+        old_workers = self.workers(old_master)
+        self.assertEqual(len(old_workers), 2)
+        stop = threading.Event()
+        statuses = []
+        failures = []
+
+        def load():
+            while not stop.is_set():
+                try:
+                    statuses.append(self.request_page())
+                except (OSError, httplib.HTTPException) as e:
+                    failures.append(repr(e))
+
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for t in threads:
+            t.start()
+        try:
+            time.sleep(0.3)
+            os.kill(old_master, SIGHUP)
+            self.wait_for(lambda: not any(pid in self.server_processes() for pid in [old_master] + old_workers))
+            time.sleep(0.3)
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        self.assertEqual(failures, [])
+        self.assertEqual(set(statuses), {200})
+        new_master, = self.masters()
+        self.assertNotEqual(new_master, old_master)
+        self.assertEqual(len(self.workers(new_master)), 2)
+
+    def test_reload_keeps_queued_connections(self):
+        """connections opened before SIGHUP are served after the new master takes over"""
+        old_master, = self.masters()
+        sockets = [self.connect() for _ in range(20)]
+        os.kill(old_master, SIGHUP)
+        self.wait_for(lambda: any(len(self.workers(pid)) == 2 for pid in self.masters() if pid != old_master))
+        for s in sockets:
+            s.sendall(b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        for s in sockets:
+            self.assertTrue(read_until_closed(s).startswith(b"HTTP/1.1 200 "))
+
+    def test_worker_restarted(self):
+        """a killed worker is replaced and the port keeps serving"""
+        master, = self.masters()
+        killed = self.workers(master)[0]
+        os.kill(killed, SIGKILL)
+        self.wait_for(lambda: killed not in self.workers(master) and len(self.workers(master)) == 2)
+        for _ in range(10):
+            self.assertEqual(self.request_page(), 200)
+
+
+class Options(unittest.TestCase):
+    """Command line checks that do not need a running server"""
+
+    def test_asyncio_rejects_selectors_options(self):
+        """--engine asyncio refuses options it would otherwise ignore"""
+        result = subprocess.run(
+            [sys.executable, HTTPD, "-p", "0", "--engine", "asyncio", "--status_path", "/_status",
+             "--header_timeout", "1"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10
+        )
+        self.assertEqual(result.returncode, 2)
+        self.assertIn(b"--header_timeout, --status_path", result.stderr)
+
+
 loader = unittest.TestLoader()
 suite = unittest.TestSuite()
 a = loader.loadTestsFromTestCase(HttpServer)
 suite.addTest(a)
+if v3:
+    for case in (Timeouts, RateLimit, Overload, Http2, Reload, Options):
+        suite.addTest(loader.loadTestsFromTestCase(case))
 
 
 class NewResult(unittest.TextTestResult):
@@ -0,0 +1,224 @@
+import logging
+import mimetypes
+import os
+import stat
+import sys
+import time
+from pathlib import Path
+from threading import Lock
+from urllib.parse import quote
+from response import make_etag
+from routecache import under
+
+
+PRELOAD_MAX_FILE_SIZE = 256 * 1024
+PRELOAD_MAX_SIZE = 32 * 1024 * 1024
+
+
+class ManifestRecord:
+    """
+    Описание файла в манифесте; offset - начало содержимого в общем буфере или -1
+    """
+    __slots__ = ('size', 'mtime_ns', 'inode', 'content_type', 'etag', 'offset')
+
+    def __init__(self, st, content_type, offset=-1):
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.inode = st.st_ino
+        self.content_type = content_type
+        self.etag = make_etag(st)
+        self.offset = offset
+
+    def stat(self):
+        """
+        Восстанавливаем stat_result с полями, которые нужны для ответа
+        """
+        mtime = self.mtime_ns / 1e9
+        return os.stat_result(
+            (stat.S_IFREG | 0o644, self.inode, 0, 1, 0, 0, self.size, mtime, mtime, mtime),
+            {'st_mtime_ns': self.mtime_ns, 'st_mtime': mtime}
+        )
+
+
+class Manifest:
+    """
+    Индекс документов корня, построенный одним обходом при старте: путь -> размер, mtime,
+    MIME-тип и ETag. Файлы не больше max_file_size (в сумме не больше max_size) читаются
+    в один непрерывный буфер и отдаются срезами memoryview без копирования.
+    warm() заполняет этими данными кеш маршрутов и кеш файлов, а update() по событиям
+    inotify обновляет только измененные пути, не пересканируя корень
+    """
+    def __init__(self, root_dir, max_file_size=PRELOAD_MAX_FILE_SIZE, max_size=PRELOAD_MAX_SIZE):
+        self.root_dir = str(Path(root_dir).resolve())
+        self.max_file_size = max_file_size
+        self.max_size = max_size
+        self.records = {}
+        self.buffer = memoryview(b'')
+        self.lock = Lock()
+        self.route_cache = None
+        self.file_cache = None
+
+    def build(self):
+        started = time.perf_counter()
+        preload = []
+        total = 0
+        for path, st in self.scan(self.root_dir):
+            record = ManifestRecord(st, mimetypes.guess_type(path)[0])
+            self.records[path] = record
+            if st.st_size <= self.max_file_size and total + st.st_size <= self.max_size:
+                record.offset = total
+                total += st.st_size
+                preload.append((path, record))
+
+        buffer = bytearray(total)
+        view = memoryview(buffer)
+        for path, record in preload:
+            try:
+                with open(path, 'rb') as f:
+                    loaded = f.readinto(view[record.offset:record.offset + record.size])
+            except OSError:
+                loaded = -1
+            if loaded != record.size:
+                # файл изменился во время обхода, его отдадим с диска
+                record.offset = -1
+        self.buffer = view.toreadonly()
+
+        elapsed = time.perf_counter() - started
+        logging.info(
+            f'манифест {self.root_dir}: {len(self.records)} файлов, '
+            f'{len(preload)} загружено в буфер {total} байт, '
+            f'записи занимают {self.footprint()} байт, построен за {elapsed:.3f} с'
+        )
+        return self
+
+    @staticmethod
+    def scan(root):
+        """
+        Обходим дерево без перехода по символическим ссылкам,
+        скрытые каталоги (.git и т.п.) не индексируем
+        """
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    # пустые файлы сервер отдает как 404, в манифесте они не нужны
+                    if st.st_size:
+                        yield entry.path, st
+
+    def body(self, record):
+        if record.offset < 0:
+            return None
+        return self.buffer[record.offset:record.offset + record.size]
+
+    def footprint(self):
+        size = sys.getsizeof(self.records)
+        for path, record in self.records.items():
+            size += sys.getsizeof(path) + sys.getsizeof(record) + sys.getsizeof(record.etag)
+        return size
+
+    def target(self, path):
+        return quote(path[len(self.root_dir):])
+
+    def warm(self, route_cache=None, file_cache=None):
+        """
+        Заполняем кеши из манифеста и подписываемся на изменения файлов
+        """
+        self.route_cache = route_cache
+        self.file_cache = file_cache
+        with self.lock:
+            records = list(self.records.items())
+        for path, record in records:
+            self.warm_path(path, record)
+        if route_cache is not None and route_cache.watching:
+            route_cache.add_listener(self.update)
+
+    def seed_routes(self, path, record):
+        if self.route_cache is None:
+            return
+        st = record.stat()
+        target = self.target(path)
+        self.route_cache.seed(target, path, record.content_type, st)
+        if target.endswith('/index.html'):
+            self.route_cache.seed(target[:-len('index.html')], path, record.content_type, st)
+
+    def warm_path(self, path, record):
+        self.seed_routes(path, record)
+        if self.file_cache is not None:
+            body = self.body(record)
+            if body is not None:
+                self.file_cache.store(path, body, record.stat(), record.content_type)
+            elif record.size <= self.max_file_size:
+                # измененный файл сразу читаем в кеш, чтобы первый запрос не шел на диск
+                self.file_cache.forget(path)
+                try:
+                    self.file_cache.lookup(path, record.content_type)
+                except OSError:
+                    pass
+
+    def update(self, paths):
+        """
+        Вызывается после сброса маршрутов измененных путей: обновляем их записи
+        и заново заполняем сброшенные маршруты, None - изменения неизвестны, пересканируем все
+        """
+        with self.lock:
+            if paths is None:
+                changed = self.rescan(self.root_dir)
+            else:
+                changed = []
+                for path in paths:
+                    if path.startswith(self.root_dir):
+                        changed.extend(self.rescan(path))
+            records = list(self.records.items())
+        changed = set(changed)
+        for path, record in records:
+            if path in changed:
+                self.warm_path(path, record)
+            elif paths is None or under(path, paths):
+                self.seed_routes(path, record)
+
+    def rescan(self, path):
+        """
+        Перестраиваем записи для файла или поддерева, возвращаем пути обновленных файлов
+        """
+        prefix = path + os.sep
+        old = {p: self.records.pop(p) for p in list(self.records) if p == path or p.startswith(prefix)}
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return []
+        if stat.S_ISDIR(st.st_mode):
+            found = list(self.scan(path))
+        elif stat.S_ISREG(st.st_mode) and st.st_size:
+            found = [(path, st)]
+        else:
+            return []
+        changed = []
+        for found_path, found_st in found:
+            record = old.get(found_path)
+            if record is not None and (record.mtime_ns, record.size, record.inode) == (
+                    found_st.st_mtime_ns, found_st.st_size, found_st.st_ino):
+                # файл не менялся, сохраняем запись вместе с содержимым в буфере
+                self.records[found_path] = record
+                continue
+            self.records[found_path] = ManifestRecord(found_st, mimetypes.guess_type(found_path)[0])
+            changed.append(found_path)
+        return changed
+
+    def stats(self):
+        return {
+            'files': len(self.records),
+            'buffer_size': len(self.buffer),
+            'footprint': self.footprint(),
+        }
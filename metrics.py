@@ -0,0 +1,173 @@
+import json
+from bisect import bisect_left
+from threading import Lock, local
+
+
+# верхние границы корзин гистограммы времени в секундах
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами: число наблюдений не больше каждой границы,
+    последняя корзина - все, что больше самой верхней границы
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Оценка квантиля по верхней границе корзины, в которую он попал
+        """
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        return {
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], counts)),
+            'count': count,
+            'sum': total,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class MetricsShard:
+    """
+    Счетчики и гистограммы одного потока: пишет в них только свой поток,
+    поэтому обновление не требует блокировок
+    """
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        # имя -> список счетчиков по корзинам LATENCY_BUCKETS, последним элементом сумма
+        self.histograms = {}
+
+
+class Metrics:
+    """
+    Метрики сервера. Каждый поток пишет в свой MetricsShard, а при запросе статистики
+    шарды всех потоков складываются. Ключ счетчика - имя и кортеж пар (метка, значение).
+    Гейджи (размер очереди, число соединений...) вычисляются функциями в момент сбора
+    """
+    def __init__(self):
+        self.local = local()
+        self.shards = []
+        self.lock = Lock()
+        self.gauges = {}
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        histograms = self.shard().histograms
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        counts[-1] += value
+
+    def add_gauge(self, name, func):
+        self.gauges[name] = func
+
+    def collect(self):
+        """
+        Складываем шарды всех потоков; копирование dict и list атомарно под GIL,
+        поэтому потоки, продолжающие писать в свои шарды, не мешают сбору
+        """
+        counters = {}
+        histograms = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key, value in dict(shard.counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in dict(shard.histograms).items():
+                counts = list(counts)
+                total = histograms.get(key)
+                histograms[key] = counts if total is None else [a + b for a, b in zip(total, counts)]
+        gauges = {name: func() for name, func in self.gauges.items()}
+        return counters, histograms, gauges
+
+    def render_json(self):
+        counters, histograms, gauges = self.collect()
+        result = {'gauges': gauges, 'counters': {}, 'histograms': {}}
+        for (name, labels), value in sorted(counters.items(), key=str):
+            result['counters'][format_key(name, labels)] = value
+        for (name, labels), counts in sorted(histograms.items(), key=str):
+            result['histograms'][format_key(name, labels)] = {
+                'buckets': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], counts[:-1])),
+                'count': sum(counts[:-1]),
+                'sum': counts[-1],
+            }
+        return json.dumps(result, indent=2, default=str).encode()
+
+    def render_prometheus(self, prefix='httpd_'):
+        counters, histograms, gauges = self.collect()
+        lines = []
+        for name, value in sorted(gauges.items()):
+            if isinstance(value, dict):
+                for key, item in sorted(value.items()):
+                    if isinstance(item, (int, float)):
+                        lines.append(f'{prefix}{name}_{key} {item}')
+            else:
+                lines.append(f'{prefix}{name} {value}')
+        for (name, labels), value in sorted(counters.items(), key=str):
+            lines.append(f'{prefix}{format_key(name, labels)} {value}')
+        for (name, labels), counts in sorted(histograms.items(), key=str):
+            cumulative = 0
+            for bound, count in zip([*map(str, LATENCY_BUCKETS), '+Inf'], counts[:-1]):
+                cumulative += count
+                lines.append(f'{prefix}{format_key(name + "_bucket", labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{prefix}{format_key(name + "_sum", labels)} {counts[-1]}')
+            lines.append(f'{prefix}{format_key(name + "_count", labels)} {cumulative}')
+        return ('\n'.join(lines) + '\n').encode()
+
+
+def format_key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
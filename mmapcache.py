@@ -0,0 +1,122 @@
+import logging
+import mmap
+from threading import Lock
+from routecache import under
+
+
+# сколько байт файлов может быть отображено в память одновременно
+MMAP_BUDGET = 256 * 1024 * 1024
+
+
+class Mapping:
+    """
+    Отображение файла в память, общее для всех одновременных запросов к этой версии файла
+    """
+    def __init__(self, cache, path, key, mm):
+        self.cache = cache
+        self.path = path
+        self.key = key
+        self.mmap = mm
+        self.view = memoryview(mm)
+        self.size = len(mm)
+        self.refs = 0
+
+
+class MmapCache:
+    """
+    Общие отображения больших файлов со счетчиком ссылок: пока файл отдается хотя бы
+    одному клиенту, остальные получают срезы того же mmap, после последнего - отображение
+    снимается. Если суммарный объем отображений превысил бы budget, файл не отображается
+    и отдается обычным способом. Отображение измененного файла новым запросам не раздается
+    """
+    def __init__(self, budget=MMAP_BUDGET):
+        self.budget = budget
+        self.mappings = {}
+        self.mapped_bytes = 0
+        self.lock = Lock()
+        self.maps = 0
+        self.reuses = 0
+        self.rejected = 0
+        self.invalidations = 0
+
+    def acquire(self, path, st):
+        """
+        Возвращаем Mapping с увеличенным счетчиком ссылок или None, если бюджет исчерпан
+        """
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            mapping = self.mappings.get(path)
+            if mapping is not None and mapping.key == key:
+                mapping.refs += 1
+                self.reuses += 1
+                return mapping
+            if self.mapped_bytes + st.st_size > self.budget:
+                self.rejected += 1
+                return None
+            # место резервируем до отображения, чтобы параллельные запросы не превысили бюджет
+            self.mapped_bytes += st.st_size
+
+        try:
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            with self.lock:
+                self.mapped_bytes -= st.st_size
+            logging.error(f'не удалось отобразить {path} в память: {e}')
+            return None
+        if len(mm) != st.st_size:
+            # файл меняется прямо сейчас
+            mm.close()
+            with self.lock:
+                self.mapped_bytes -= st.st_size
+            return None
+
+        mapping = Mapping(self, path, key, mm)
+        mapping.refs = 1
+        with self.lock:
+            self.maps += 1
+            old = self.mappings.get(path)
+            if old is None or old.refs == 0 or old.key != key:
+                # устаревшее отображение остается у своих пользователей до их завершения
+                self.mappings[path] = mapping
+        return mapping
+
+    def retain(self, mapping):
+        with self.lock:
+            mapping.refs += 1
+
+    def release(self, mapping):
+        with self.lock:
+            mapping.refs -= 1
+            if mapping.refs > 0:
+                return
+            if self.mappings.get(mapping.path) is mapping:
+                del self.mappings[mapping.path]
+            self.mapped_bytes -= mapping.size
+        mapping.view.release()
+        try:
+            mapping.mmap.close()
+        except BufferError:
+            # срез еще где-то жив, отображение закроется вместе с последним из них
+            pass
+
+    def invalidate(self, paths=None):
+        """
+        Файлы paths изменились (None - неизвестно какие): их отображения убираем из кеша,
+        а запросы, которые их уже отдают, дорабатывают со своими ссылками
+        """
+        with self.lock:
+            stale = [path for path in self.mappings if paths is None or under(path, paths)]
+            for path in stale:
+                del self.mappings[path]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        return {
+            'mappings': len(self.mappings),
+            'mapped_bytes': self.mapped_bytes,
+            'maps': self.maps,
+            'reuses': self.reuses,
+            'rejected': self.rejected,
+            'invalidations': self.invalidations,
+        }
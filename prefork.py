@@ -0,0 +1,205 @@
+import logging
+import os
+import select
+import signal
+import time
+import handoff
+
+
+# если процесс умирает быстрее, перезапуск откладывается, чтобы не крутить fork
+MIN_CHILD_LIFETIME = 1.0
+
+
+class Master:
+    """
+    Мастер-процесс: запускает processes дочерних серверов, перезапускает упавшие
+    и пересылает им SIGTERM для плавной остановки. По SIGHUP запускает новый мастер
+    на тех же слушающих сокетах listeners и, когда тот готов, плавно останавливает своих.
+    Сокеты открывает мастер: либо один общий для всех процессов (shared), либо по сокету
+    SO_REUSEPORT на процесс, и тогда процесс number слушает listeners[number::processes].
+    Так очереди соединений сокетов переживают и перезапуск процесса, и перезагрузку.
+    Обработчики сигналов только ставят флаги и будят основной цикл через wakeup-канал
+    """
+    def __init__(self, processes, server_factory, listeners=(), shared=True):
+        self.processes = processes
+        self.server_factory = server_factory
+        self.listeners = list(listeners)
+        self.shared = shared
+        self.children = {}
+        # номера процессов, ждущих перезапуска, и когда их запускать
+        self.restarts = {}
+        self.stopping = False
+        self.stop_requested = False
+        self.reload_requested = False
+        self.successor = None
+        self.wakeup_r = None
+        self.wakeup_w = None
+
+    def run(self):
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        # обработчик нужен только для того, чтобы завершение процесса будило цикл
+        signal.signal(signal.SIGCHLD, self.handle_child)
+        for number in range(self.processes):
+            self.spawn(number)
+        handoff.notify_ready()
+
+        while self.children or self.restarts and not self.stopping:
+            fds = [self.wakeup_r]
+            if self.successor is not None:
+                fds.append(self.successor.ready_fd)
+            readable, _, _ = select.select(fds, [], [], self.timeout())
+            if self.wakeup_r in readable:
+                self.drain_wakeup()
+            self.reap()
+            if self.stop_requested and not self.stopping:
+                self.stop()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.start_reload()
+            if self.successor is not None:
+                self.check_successor()
+            self.restart_due()
+        logging.info('все воркер-процессы остановлены')
+
+    def listeners_for(self, number):
+        if self.shared:
+            return self.listeners
+        return self.listeners[number::self.processes]
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (number, time.monotonic())
+            logging.info(f'запущен воркер-процесс {number} pid {pid}')
+            return
+
+        # дочерний процесс: остановкой управляет мастер через SIGTERM
+        status = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self.server_factory(self.listeners_for(number)).serve_forever()
+            status = 0
+        except Exception as e:
+            logging.error(f'воркер-процесс {os.getpid()} упал: {e}')
+        finally:
+            os._exit(status)
+
+    def timeout(self):
+        """
+        Сколько можно спать в select: до ближайшего перезапуска или срока готовности нового мастера
+        """
+        deadlines = list(self.restarts.values())
+        if self.successor is not None:
+            deadlines.append(self.successor.deadline)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def reap(self):
+        """
+        Забираем завершившиеся дочерние процессы. Ждем только своих, а не любой процесс:
+        новый мастер при перезагрузке тоже наш потомок, его ждет handoff.Successor
+        """
+        for pid in list(self.children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done, status = pid, 0
+            if done:
+                self.child_exited(pid, status)
+
+    def child_exited(self, pid, status):
+        number, started = self.children.pop(pid)
+        if self.stopping:
+            logging.info(f'воркер-процесс {pid} завершился')
+            return
+        logging.error(f'воркер-процесс {pid} завершился со статусом {status}, перезапускаем')
+        now = time.monotonic()
+        self.restarts[number] = now + MIN_CHILD_LIFETIME if now - started < MIN_CHILD_LIFETIME else now
+
+    def restart_due(self):
+        if self.stopping:
+            self.restarts.clear()
+            return
+        now = time.monotonic()
+        for number, due in list(self.restarts.items()):
+            if due <= now:
+                del self.restarts[number]
+                self.spawn(number)
+
+    def handle_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def handle_child(self, signum, frame):
+        pass
+
+    def stop(self):
+        """
+        Пересылаем сигнал остановки дочерним процессам
+        """
+        self.stopping = True
+        logging.info('останавливаем воркер-процессы')
+        self.restarts.clear()
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if self.successor is not None:
+            # новый мастер не успел стать готовым, не оставляем его работать вместо нас
+            self.successor.abort()
+            self.successor = None
+
+    def start_reload(self):
+        """
+        Запускаем новый мастер: дочерние процессы тем временем продолжают обслуживать
+        соединения, упавшие перезапускаются, а после готовности нового мастера плавно
+        останавливаемся. Он наследует те же слушающие сокеты вместе с их очередями
+        """
+        if self.stopping or self.successor is not None:
+            return
+        logging.info('получен SIGHUP, перезапускаемся')
+        try:
+            self.successor = handoff.Successor(self.listeners)
+        except OSError as e:
+            logging.error(f'Не удалось запустить новый мастер: {e}')
+
+    def check_successor(self):
+        ready = self.successor.check()
+        if ready is None:
+            if time.monotonic() < self.successor.deadline:
+                return
+            logging.error(f'новый мастер {self.successor.process.pid} не готов вовремя, останавливаем его')
+            self.successor.abort()
+            self.successor = None
+            return
+        self.successor.close()
+        if ready:
+            logging.info(f'новый мастер {self.successor.process.pid} готов, останавливаем воркер-процессы')
+            self.successor = None
+            self.stop()
+        else:
+            logging.error('новый мастер не запустился, продолжаем работу')
+            self.successor = None
@@ -0,0 +1,140 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+SLOW_REQUEST_THRESHOLD = 1.0
+SAMPLE_INTERVAL = 0.005
+PROFILE_SECONDS = 10
+PROFILE_MAX_SECONDS = 60
+# кадры, в которых поток ждет работы: такие стеки по умолчанию не попадают в профиль
+# (у потока наблюдения за корнем это select на дескрипторе inotify)
+IDLE_FRAMES = {
+    ('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'), ('routecache.py', 'run'),
+}
+
+
+class RequestTimings:
+    """
+    Длительности фаз одного запроса по монотонным часам: каждая отметка mark(phase)
+    относит к фазе время, прошедшее с предыдущей отметки. Фазы идут по очереди:
+    parse (цикл), queue (ожидание воркера), route, load, render (воркер),
+    wait (ожидание цикла и предыдущих ответов конвейера), send (отправка)
+    """
+    __slots__ = ('last', 'phases')
+
+    def __init__(self, started):
+        self.last = started
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return sum(duration for _, duration in self.phases)
+
+    def format(self):
+        return ' '.join(f'{phase}={duration * 1000:.2f}ms' for phase, duration in self.phases)
+
+
+class Profiler:
+    """
+    Точки инструментирования запросов: сервер заводит RequestTimings на каждый запрос,
+    только пока есть хоть один хук, а после отправки ответа вызывает хуки
+    hook(slot, timings) в цикле событий. Встроенный хук - журнал медленных запросов
+    """
+    def __init__(self, slow_threshold=SLOW_REQUEST_THRESHOLD):
+        self.slow_threshold = slow_threshold
+        self.hooks = []
+        self.slow_requests = 0
+        if slow_threshold is not None:
+            self.add_hook(self.log_slow)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @staticmethod
+    def timings(started):
+        return RequestTimings(started)
+
+    def finish(self, slot):
+        """
+        Ответ отправлен: отдаем замеры хукам
+        """
+        timings = slot.timings
+        slot.timings = None
+        for hook in self.hooks:
+            try:
+                hook(slot, timings)
+            except Exception as e:
+                logging.error(f'Ошибка хука профилирования {hook}: {e}')
+
+    def log_slow(self, slot, timings):
+        total = timings.total()
+        if total < self.slow_threshold:
+            return
+        self.slow_requests += 1
+        request_line = slot.request.request_line if slot.request is not None else '-'
+        logging.warning(
+            f'медленный запрос {total * 1000:.1f}ms {request_line} {slot.status.value} {timings.format()}'
+        )
+
+    def stats(self):
+        return {'slow_requests': self.slow_requests}
+
+
+class StackSampler(threading.Thread):
+    """
+    Семплирующий профилировщик: каждые interval секунд снимает стеки всех потоков
+    (цикла событий и воркеров) через sys._current_frames и считает одинаковые стеки.
+    Результат - collapsed stacks для flamegraph.pl и speedscope: "поток;кадр;...;кадр число".
+    Пока профилировщик не запущен, он ничего не стоит
+    """
+    def __init__(self, seconds, on_done, interval=SAMPLE_INTERVAL, include_idle=False):
+        threading.Thread.__init__(self, name='stack-sampler', daemon=True)
+        self.seconds = seconds
+        self.on_done = on_done
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self):
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                self.sample()
+                time.sleep(self.interval)
+        finally:
+            self.on_done(self)
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if not self.include_idle and is_idle(frame):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        lines = [f'{stack} {count}' for stack, count in self.stacks.most_common()]
+        return ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+
+
+def is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
@@ -0,0 +1,115 @@
+import socket
+import time
+from collections import OrderedDict
+
+
+# сколько клиентов без открытых соединений помним, самые давно подключавшиеся вытесняются
+LIMIT_TABLE_SIZE = 65536
+
+
+class ClientBucket:
+    """
+    Состояние клиента (адреса или подсети): ведро токенов на запросы и число открытых соединений
+    """
+    __slots__ = ('key', 'tokens', 'updated', 'connections')
+
+    def __init__(self, key, tokens, now):
+        self.key = key
+        self.tokens = tokens
+        self.updated = now
+        self.connections = 0
+
+
+class RateLimiter:
+    """
+    Ограничения на клиента: не больше rate запросов в секунду с запасом burst
+    и не больше max_connections одновременных соединений. Клиенты группируются
+    по префиксу адреса (32 и 128 - каждый адрес отдельно). Клиенты с открытыми соединениями
+    не вытесняются, иначе новое соединение получило бы чистое ведро и нулевой счетчик,
+    а клиенты без соединений хранятся в LRU не больше max_clients записей.
+    Все операции O(1) и вызываются только из цикла событий, поэтому блокировки не нужны
+    """
+    def __init__(
+            self,
+            rate=0,
+            burst=None,
+            max_connections=0,
+            ipv4_prefix=32,
+            ipv6_prefix=128,
+            max_clients=LIMIT_TABLE_SIZE
+    ):
+        self.rate = rate
+        self.burst = max(1, burst or rate)
+        self.max_connections = max_connections
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.max_clients = max_clients
+        self.active = {}
+        self.idle = OrderedDict()
+        self.rejected_connections = 0
+        self.rejected_requests = 0
+        self.evictions = 0
+
+    def client_key(self, host):
+        if self.ipv4_prefix >= 32 and self.ipv6_prefix >= 128:
+            return host
+        try:
+            packed, prefix = socket.inet_pton(socket.AF_INET, host), self.ipv4_prefix
+        except OSError:
+            try:
+                packed, prefix = socket.inet_pton(socket.AF_INET6, host), self.ipv6_prefix
+            except OSError:
+                return host
+        bits = len(packed) * 8
+        return bits, int.from_bytes(packed, 'big') >> (bits - prefix)
+
+    def connect(self, host):
+        """
+        Учитываем новое соединение, None - у клиента уже max_connections соединений
+        """
+        key = self.client_key(host)
+        client = self.active.get(key)
+        if client is None:
+            client = self.idle.pop(key, None)
+            if client is None:
+                client = ClientBucket(key, self.burst, time.monotonic())
+            self.active[key] = client
+        if self.max_connections and client.connections >= self.max_connections:
+            self.rejected_connections += 1
+            return None
+        client.connections += 1
+        return client
+
+    def disconnect(self, client):
+        client.connections -= 1
+        if client.connections:
+            return
+        # последнее соединение закрыто: клиент переходит в LRU, откуда может быть вытеснен
+        del self.active[client.key]
+        self.idle[client.key] = client
+        if len(self.idle) > self.max_clients:
+            self.idle.popitem(last=False)
+            self.evictions += 1
+
+    def take(self, client):
+        """
+        Забираем токен на запрос: 0 - запрос разрешен, иначе через сколько секунд появится токен
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        client.tokens = min(self.burst, client.tokens + (now - client.updated) * self.rate)
+        client.updated = now
+        if client.tokens >= 1:
+            client.tokens -= 1
+            return 0
+        self.rejected_requests += 1
+        return (1 - client.tokens) / self.rate
+
+    def stats(self):
+        return {
+            'clients': len(self.active) + len(self.idle),
+            'evictions': self.evictions,
+            'rejected_connections': self.rejected_connections,
+            'rejected_requests': self.rejected_requests,
+        }
@@ -1,109 +1,782 @@
 import logging
 import mimetypes
-from time import strftime
+import os
+import secrets
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
+from time import time, perf_counter
 from urllib.parse import unquote
-from constants import DEFAULT_HTTP_PROTOCOL
+from constants import DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL
 from http import HTTPStatus
 from pathlib import Path
 
 
-class Response:
+# больше диапазонов в одном запросе не отдаем, а отвечаем файлом целиком
+MAX_RANGES = 16
+LAST_CHUNK = b'0\r\n\r\n'
+# заголовки соединения HTTP/1, которые в HTTP/2 не передаются
+CONNECTION_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'upgrade', 'proxy-connection'}
+# статусы, начала ответов для которых кодируются заранее
+TEMPLATE_STATUSES = (
+    HTTPStatus.OK, HTTPStatus.PARTIAL_CONTENT, HTTPStatus.NOT_MODIFIED, HTTPStatus.FORBIDDEN,
+    HTTPStatus.NOT_FOUND, HTTPStatus.METHOD_NOT_ALLOWED,
+)
+
+
+class DateClock:
+    """
+    Значение заголовка Date в формате RFC 7231, пересчитывается не чаще раза в секунду:
+    цикл событий вызывает tick(), а ответы берут уже закодированную строку
+    """
+    __slots__ = ('second', 'value', 'header')
+
+    def __init__(self):
+        self.second = None
+        self.value = ''
+        self.header = b''
+        self.tick()
+
+    def tick(self, now=None):
+        second = int(time() if now is None else now)
+        if second != self.second:
+            self.value = http_date(second)
+            self.header = f'Date: {self.value}\r\n'.encode('ascii')
+            self.second = second
+
+
+class ResponseSettings:
+    """
+    Общие для всех ответов сервера настройки и кеши, создаются один раз на сервер
+    вместе с заранее закодированными началами ответов (строка статуса, Server и Connection)
+    """
+    __slots__ = (
+        'protocol', 'server_name', 'allowed_methods', 'allowed_http_protocols', 'root_dir', 'keep_alive',
+        'file_cache', 'compressor', 'route_cache', 'mmap_cache', 'mmap_min_size', 'mmap_max_size',
+        'autoindex', 'async_streams', 'templates'
+    )
+
     def __init__(
             self,
             protocol=DEFAULT_HTTP_PROTOCOL,
             server_name=None,
             allowed_methods=None,
             allowed_http_protocols=None,
-            root_dir=None
+            root_dir=None,
+            keep_alive=True,
+            file_cache=None,
+            compressor=None,
+            route_cache=None,
+            mmap_cache=None,
+            mmap_min_size=0,
+            mmap_max_size=0,
+            autoindex=None,
+            async_streams=False
     ):
-        self.status: HTTPStatus = None
-        self.headers = {
-            'Server': server_name,
-            'Date': strftime('%c'),
-            'Connection': 'keep-alive',
-            'Content-Type': None,
-            'Content-Length': 0,
-        }
-        self.body = b''
         self.protocol = protocol
-
+        self.server_name = server_name
         self.allowed_methods = allowed_methods
         self.allowed_http_protocols = allowed_http_protocols
         self.root_dir = root_dir
+        # разрешено ли серверу держать соединение
+        self.keep_alive = keep_alive
+        self.file_cache = file_cache
+        self.compressor = compressor
+        self.route_cache = route_cache
+        # файлы от mmap_min_size до mmap_max_size отдаются срезами общего mmap, большие - через sendfile
+        self.mmap_cache = mmap_cache
+        self.mmap_min_size = mmap_min_size
+        self.mmap_max_size = mmap_max_size
+        self.autoindex = autoindex
+        # асинхронные итераторы тела умеет отдавать только сервер со своим циклом asyncio
+        self.async_streams = async_streams
+        self.templates = {}
+        for status in TEMPLATE_STATUSES:
+            for keep_alive in (True, False):
+                self.template(status, keep_alive)
+
+    def template(self, status, keep_alive):
+        """
+        Начало ответа до Date, для редких статусов строится при первом обращении
+        """
+        template = self.templates.get((status, keep_alive))
+        if template is None:
+            template = (
+                f'{self.protocol} {status.value} {status.phrase}\r\n'
+                f'Server: {self.server_name}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+            ).encode('iso-8859-1')
+            self.templates[(status, keep_alive)] = template
+        return template
+
+
+class RequestSlot:
+    """
+    Запрос в очереди соединения (или потоке HTTP/2) и место для ответа на него:
+    воркер выставляет status и keep_alive, а resp - последним, когда ответ готов.
+    started и timings нужны метрикам и профилированию, stream_id - номер потока HTTP/2,
+    его выставляет только Http2Session: по нему, а не по версии из строки запроса, ответ
+    рендерится для HTTP/2
+    """
+    __slots__ = ('request', 'resp', 'keep_alive', 'status', 'started', 'timings', 'stream_id')
+
+    def __init__(self, request, started=None, stream_id=None):
+        self.request = request
+        self.resp = None
+        self.keep_alive = False
+        self.status = None
+        self.started = perf_counter() if started is None else started
+        self.timings = None
+        self.stream_id = stream_id
+
+    @property
+    def http2(self):
+        return self.stream_id is not None
+
+
+class Response:
+    """
+    Ответ на один запрос: все общее берется из settings, а сам ответ хранит
+    только статус, Content-Type, Content-Length, остальные заголовки и части тела.
+    После finish объект больше не нужен и после reset годится для следующего запроса
+    """
+    __slots__ = (
+        'settings', 'status', 'content_type', 'content_length', 'headers',
+        'body', 'body_parts', 'raw_headers', 'keep_alive'
+    )
+
+    def __init__(self, settings):
+        self.settings = settings
+        # остальные заголовки парами (имя, значение)
+        self.headers = []
+        # сегменты тела после заголовков: байты, memoryview, FileBody, MappedBody или StreamBody
+        self.body_parts = []
+        self.reset()
+
+    def reset(self):
+        """
+        Готовим объект к следующему запросу. Списки очищаем, а не создаем заново:
+        render копирует их в ответ, поэтому после finish на них никто не ссылается
+        """
+        self.status: HTTPStatus = None
+        # None - заголовок не отправляется
+        self.content_type = None
+        self.content_length = 0
+        self.headers.clear()
+        self.body = b''
+        self.body_parts.clear()
+        # заранее отрендеренные заголовки из кеша файлов
+        self.raw_headers = b''
+        # решение о keep-alive для текущего запроса
+        self.keep_alive = False
 
     def form_response_no_return(self, sock_data):
-        data = sock_data.inb
+        request = sock_data.request
+        settings = self.settings
         try:
             # в запросе нет тела, т.к. это get и head запросы
-            # вроде как рекомендуется серверам уметь работать
-            # с запросами в которых перенос реализован через один \n
-            method_url_protocol = data.decode('iso-8859-1').replace('\r\n', '\n').split('\n')[0]
-
-            method = method_url_protocol.split(' ')[0]
-            if method not in self.allowed_methods:
+            method = request.method
+            if method not in settings.allowed_methods:
+                # тело неподдерживаемого запроса не читаем, поэтому соединение закрываем
                 self.status = HTTPStatus.METHOD_NOT_ALLOWED
-                sock_data.resp = self.render()
+                self.finish(sock_data)
                 return
 
-            protocol = method_url_protocol[-len(self.protocol):]
-            if protocol not in self.allowed_http_protocols:
-                raise ValueError(f'Сервер работает только с протоколами {self.allowed_http_protocols}')
-
-            # +1 и -1  нужны т.к. там пробелы по краям
-            url = self.prepare_url(method_url_protocol[len(method) + 1: - len(protocol) - 1])
+            if request.version not in settings.allowed_http_protocols and not sock_data.http2:
+                raise ValueError(f'Сервер работает только с протоколами {settings.allowed_http_protocols}')
+            self.keep_alive = settings.keep_alive and request.wants_keep_alive()
 
-            if method == 'HEAD':
-                self.headers['Content-Length'] = Path(url).stat().st_size
+            st = None
+            if settings.route_cache is not None:
+                route = settings.route_cache.lookup(request.target)
+                if route.stat is None:
+                    raise FileNotFoundError(request.target)
+                url, st = route.path, route.stat
+                self.content_type = route.content_type
             else:
-                self.body = load(url)
-                logging.info(f'тело ответа {self.body} успешно прочитано из файла')
+                url = self.prepare_url(request.target)
+            timings = sock_data.timings
+            if timings is not None:
+                timings.mark('route')
 
-                self.headers['Content-Length'] = len(self.body.decode("iso-8859-1"))
-
-            if not self.headers['Content-Length']:
+            entry = settings.file_cache.lookup(url, self.content_type, st) if settings.file_cache else None
+            if entry is not None:
+                st = entry.stat
+            elif st is None:
+                st = os.stat(url)
+            if not stat.S_ISREG(st.st_mode):
+                if stat.S_ISDIR(st.st_mode) and self.redirect_to_directory(request):
+                    self.finish(sock_data)
+                    return
+                raise IsADirectoryError(url)
+            if not st.st_size:
                 self.status = HTTPStatus.NOT_FOUND
-                sock_data.resp = self.render()
+                self.finish(sock_data)
                 return
 
-            self.status = HTTPStatus.OK
+            etag = make_etag(st)
+            variant = None
+            if settings.compressor is not None and settings.compressor.compressible(self.content_type):
+                self.headers.append(('Vary', 'Accept-Encoding'))
+                # диапазоны отдаем только из несжатого файла
+                if not request.get('Range'):
+                    variant = settings.compressor.select(request, url, st, self.content_type, etag, entry)
+                    if variant is not None:
+                        etag = variant.etag
+
+            if self.not_modified(request, etag, st.st_mtime):
+                # 304 отдаем по данным stat, не открывая файл
+                self.content_type = None
+                self.content_length = None
+                self.headers.append(('ETag', etag))
+                self.headers.append(('Last-Modified', http_date(st.st_mtime)))
+                self.status = HTTPStatus.NOT_MODIFIED
+                self.finish(sock_data)
+                return
+
+            ranges = None
+            if method == 'GET' and request.get('Range') and self.if_range_matches(request, etag, st.st_mtime):
+                ranges = parse_ranges(request.get('Range'), st.st_size)
+
+            if ranges == []:
+                self.headers.append(('Content-Range', f'bytes */{st.st_size}'))
+                self.status = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+            elif ranges:
+                self.use_ranges(url, entry, ranges, st, etag, sock_data)
+                self.status = HTTPStatus.PARTIAL_CONTENT
+            elif variant is not None:
+                self.use_variant(variant, st, method)
+                self.status = HTTPStatus.OK
+            elif entry is not None:
+                self.use_cache_entry(entry, method)
+                self.status = HTTPStatus.OK
+            else:
+                self.set_validators(st, etag)
+                self.content_length = st.st_size
+                mapping = self.acquire_mapping(url, st, sock_data) if method == 'GET' else None
+                if mapping is not None:
+                    self.body_parts.append(MappedBody(mapping, 0, st.st_size))
+                elif method == 'GET':
+                    # тело не читаем в память, а отдаем сервером через sendfile
+                    file_body = open_file_body(url)
+                    self.content_length = file_body.length
+                    self.body_parts.append(file_body)
+                self.status = HTTPStatus.OK
 
         except (FileNotFoundError, NotADirectoryError):
-            logging.error('файл не найден')
-            self.status = HTTPStatus.NOT_FOUND
+            if not self.use_autoindex(request):
+                # 404 учитывается в метриках и журнале доступа, в журнал сервера - только при отладке
+                logging.debug('файл не найден: %s', request.target)
+                self.status = HTTPStatus.NOT_FOUND
 
         except Exception as e:
-            logging.error(f'Ошибка парсинга: {e} - {data}')
+            logging.error(f'Ошибка обработки запроса: {e} - {request.request_line}')
+            self.close_body_parts()
+            self.keep_alive = False
             self.status = HTTPStatus.FORBIDDEN
 
-        sock_data.resp = self.render()
+        self.finish(sock_data)
+
+    def in_memory(self, request):
+        """
+        Можно ли сформировать ответ без обращения к диску: маршрут и файл уже есть в кешах
+        и не требуют перепроверки, а сжатый вариант искать не нужно
+        """
+        settings = self.settings
+        if request.method not in settings.allowed_methods or request.version not in settings.allowed_http_protocols:
+            return True
+        if settings.route_cache is None or settings.file_cache is None:
+            return False
+        route = settings.route_cache.peek(request.target)
+        if route is None:
+            return False
+        if route.stat is None:
+            # для 404 autoindex проверяет, не каталог ли это
+            return settings.autoindex is None
+        if settings.file_cache.peek(route.path) is None:
+            return False
+        compressor = settings.compressor
+        if compressor is None or request.get('Range'):
+            return True
+        return not compressor.applies(request, route.content_type, route.stat)
+
+    def form_error_response(self, sock_data, status, headers=None, keep_alive=False):
+        """
+        Ответ на запрос, который не удалось разобрать или принять в обработку,
+        после него соединение закрывается, если не разрешено keep_alive
+        """
+        self.status = status
+        if headers:
+            self.headers.extend(headers.items())
+        self.keep_alive = keep_alive and self.settings.keep_alive and sock_data.request.wants_keep_alive()
+        self.finish(sock_data)
+
+    def form_content_response(self, sock_data, body, content_type):
+        """
+        Ответ с готовым телом из памяти, например служебная страница сервера
+        """
+        request = sock_data.request
+        self.keep_alive = self.settings.keep_alive and request.wants_keep_alive()
+        self.content_type = content_type
+        self.content_length = len(body)
+        self.headers.append(('Cache-Control', 'no-store'))
+        if request.method == 'GET':
+            self.body = body
+        self.status = HTTPStatus.OK
+        self.finish(sock_data)
+
+    def form_stream_response(self, sock_data, chunks, content_type):
+        """
+        Ответ с телом, которое генерируется по частям во время отправки
+        """
+        request = sock_data.request
+        self.keep_alive = self.settings.keep_alive and request.wants_keep_alive()
+        self.content_type = content_type
+        self.use_stream(chunks, request)
+        self.status = HTTPStatus.OK
+        self.finish(sock_data)
+
+    def use_stream(self, chunks, request):
+        """
+        Длина тела заранее неизвестна: клиентам HTTP/1.1 отдаем его с Transfer-Encoding: chunked,
+        клиентам HTTP/1.0 - до закрытия соединения, а в HTTP/2 конец тела обозначает сам поток.
+        Асинхронный итератор без поддержки сервера отвергаем TypeError до отправки заголовков
+        """
+        if hasattr(chunks, '__aiter__') and not self.settings.async_streams:
+            raise TypeError('асинхронный итератор тела ответа поддерживает только движок asyncio')
+        self.content_length = None
+        chunked = request.version == DEFAULT_HTTP_PROTOCOL
+        if chunked:
+            self.headers.append(('Transfer-Encoding', 'chunked'))
+        elif request.version == OLD_HTTP_PROTOCOL:
+            self.keep_alive = False
+        body = StreamBody(chunks, chunked)
+        if request.method == 'HEAD':
+            body.close()
+        else:
+            self.body_parts.append(body)
+
+    def finish(self, sock_data):
+        """
+        Отдаем готовый ответ соединению, resp выставляется последним,
+        т.к. по нему сервер понимает, что ответ готов
+        """
+        sock_data.keep_alive = self.keep_alive
+        sock_data.status = self.status
+        timings = sock_data.timings
+        if timings is not None:
+            timings.mark('load')
+        if sock_data.http2:
+            resp = self.render_http2()
+        else:
+            resp = self.render()
+        if timings is not None:
+            timings.mark('render')
+        sock_data.resp = resp
 
     def prepare_url(self, url):
         url = unquote(url.split('?')[0])
 
         url = url + 'index.html' if url[-1] == '/' else url
-        url = Path(self.root_dir + url).resolve()
+        url = Path(self.settings.root_dir + url).resolve()
 
-        if not url.is_relative_to(self.root_dir):
+        if not url.is_relative_to(self.settings.root_dir):
             raise FileNotFoundError()
 
         url = str(url)
         content_type = mimetypes.guess_type(url)
-        self.headers['Content-Type'] = content_type[0]
+        self.content_type = content_type[0]
 
         return url
 
-    def render(self):
-        status_line = f'{self.protocol} {self.status.value} {self.status.name}\r\n'
+    @staticmethod
+    def not_modified(request, etag, mtime):
+        """
+        Проверяем If-None-Match, а если его нет - If-Modified-Since
+        """
+        if_none_match = [tag.strip() for value in request.get_all('If-None-Match') for tag in value.split(',')]
+        if if_none_match:
+            return '*' in if_none_match or etag in [tag.removeprefix('W/') for tag in if_none_match]
+        since = parse_http_date(request.get('If-Modified-Since'))
+        return since is not None and int(mtime) <= since
+
+    @staticmethod
+    def if_range_matches(request, etag, mtime):
+        """
+        Range выполняется, только если If-Range (ETag или дата) совпадает с текущей версией файла
+        """
+        if_range = request.get('If-Range')
+        if if_range is None:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag
+        return parse_http_date(if_range) == int(mtime)
+
+    def set_validators(self, st, etag):
+        self.headers.append(('Last-Modified', http_date(st.st_mtime)))
+        self.headers.append(('ETag', etag))
+        self.headers.append(('Accept-Ranges', 'bytes'))
+
+    def use_cache_entry(self, entry, method):
+        """
+        Отвечаем из кеша: Content-Type, Content-Length и валидаторы уже отрендерены в записи
+        """
+        self.content_type = None
+        self.content_length = None
+        self.raw_headers = entry.headers
+        if method != 'HEAD':
+            self.body = entry.body
+
+    def use_variant(self, variant, st, method):
+        """
+        Отвечаем сжатым вариантом: из кеша сжатых тел или из соседнего .gz/.br файла
+        """
+        self.headers.append(('Content-Encoding', variant.encoding))
+        self.content_length = variant.size
+        self.headers.append(('Last-Modified', http_date(st.st_mtime)))
+        self.headers.append(('ETag', variant.etag))
+        if method != 'GET':
+            return
+        if variant.body is not None:
+            self.body_parts.append(variant.body)
+        else:
+            file_body = open_file_body(variant.path)
+            self.content_length = file_body.length
+            self.body_parts.append(file_body)
+
+    def use_ranges(self, url, entry, ranges, st, etag, sock_data):
+        """
+        Ответ 206: один диапазон отдается как есть, несколько - как multipart/byteranges.
+        Части берутся срезами тела из кеша или кусками одного открытого файла
+        """
+        self.set_validators(st, etag)
+        size = st.st_size
+        mapping = None
+        if entry is None:
+            mapping = self.acquire_mapping(url, st, sock_data)
+        if entry is not None:
+            view = memoryview(entry.body)
+            parts = [view[start:end + 1] for start, end in ranges]
+        elif mapping is not None:
+            # каждая часть держит свою ссылку на отображение
+            for _ in ranges[1:]:
+                self.settings.mmap_cache.retain(mapping)
+            parts = [MappedBody(mapping, start, end - start + 1) for start, end in ranges]
+        else:
+            file_body = open_file_body(url)
+            # файл общий для всех частей, закрывает его только последняя
+            parts = [FileBody(file_body.file, start, end - start + 1, close_file=False) for start, end in ranges]
+            parts[-1].close_file = True
 
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+            self.content_length = end - start + 1
+            self.body_parts = parts
+            return
+
+        boundary = secrets.token_hex(16)
+        content_type = self.content_type
+        self.content_type = f'multipart/byteranges; boundary={boundary}'
+        length = 0
+        for (start, end), part in zip(ranges, parts):
+            part_head = (
+                f'\r\n--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+            ).encode('iso-8859-1')
+            self.body_parts += [part_head, part]
+            length += len(part_head) + end - start + 1
+        tail = f'\r\n--{boundary}--\r\n'.encode('iso-8859-1')
+        self.body_parts.append(tail)
+        self.content_length = length + len(tail)
+
+    def redirect_to_directory(self, request):
+        """
+        Листинг отдается только по адресу каталога со слешем на конце, иначе относительные
+        ссылки в нем вели бы в родительский каталог: перенаправляем туда, сохраняя строку запроса
+        """
+        url, sep, query = request.target.partition('?')
+        if self.settings.autoindex is None or url.endswith('/'):
+            return False
+        self.headers.append(('Location', f'{url}/{sep}{query}'))
+        self.status = HTTPStatus.MOVED_PERMANENTLY
+        return True
+
+    def use_autoindex(self, request):
+        """
+        Вместо 404 на каталог без index.html отдаем его листинг, если он включен
+        """
+        url = request.target.partition('?')[0]
+        if self.settings.autoindex is None or not url.endswith('/'):
+            return False
+        try:
+            path = Path(self.settings.root_dir + unquote(url)).resolve()
+            if not path.is_relative_to(self.settings.root_dir):
+                return False
+            st = os.stat(path)
+            if not stat.S_ISDIR(st.st_mode):
+                return False
+            body, content_type = self.settings.autoindex.listing(str(path), st, request.target, request.get('Accept', ''))
+        except OSError as e:
+            logging.error(f'не удалось прочитать каталог {url}: {e}')
+            return False
+        self.content_type = content_type
+        self.headers.append(('Cache-Control', 'no-cache'))
+        if isinstance(body, bytes):
+            self.content_length = len(body)
+            if request.method == 'GET':
+                self.body = body
+        else:
+            self.use_stream(body, request)
+        self.status = HTTPStatus.OK
+        return True
+
+    def acquire_mapping(self, path, st, sock_data):
+        """
+        Кадры HTTP/2 копируют тело в память процесса, и чтение отображения укороченного файла
+        убило бы его SIGBUS, поэтому потокам HTTP/2 файлы отдаются без mmap
+        """
+        settings = self.settings
+        if settings.mmap_cache is None or sock_data.http2:
+            return None
+        if not settings.mmap_min_size <= st.st_size <= settings.mmap_max_size:
+            return None
+        return settings.mmap_cache.acquire(path, st)
+
+    def close_body_parts(self):
+        for part in self.body_parts:
+            if isinstance(part, (FileBody, MappedBody, StreamBody)):
+                part.close()
+        self.body_parts = []
+
+    def render(self):
+        """
+        Возвращает список сегментов ответа: байты заголовков (вместе с телом из памяти)
+        и следующие за ними части тела, в том числе FileBody
+        """
         header_line = ''
-        if self.headers:
-            for key, value in self.headers.items():
-                header_line += f'{key}: {value}\r\n'
+        if self.content_type is not None:
+            header_line = f'Content-Type: {self.content_type}\r\n'
+        if self.content_length is not None:
+            header_line += f'Content-Length: {self.content_length}\r\n'
+        for key, value in self.headers:
+            header_line += f'{key}: {value}\r\n'
+
+        head = b''.join((
+            self.settings.template(self.status, self.keep_alive),
+            clock.header,
+            header_line.encode('iso-8859-1'),
+            self.raw_headers,
+            b'\r\n'
+        ))
+        # тело не склеиваем с заголовками, сервер отправит их одним sendmsg
+        if self.body:
+            return [head, self.body] + self.body_parts
+        return [head] + self.body_parts
+
+    def render_http2(self):
+        """
+        Для HTTP/2 заголовки отдаются списком пар (их кодирует HPACK), а за ними части тела
+        """
+        headers = [(':status', str(self.status.value)), ('server', str(self.settings.server_name)),
+                   ('date', clock.value)]
+        if self.content_type is not None:
+            headers.append(('content-type', self.content_type))
+        if self.content_length is not None:
+            headers.append(('content-length', str(self.content_length)))
+        for key, value in self.headers:
+            key = key.lower()
+            if key not in CONNECTION_HEADERS:
+                headers.append((key, str(value)))
+        if self.raw_headers:
+            for line in self.raw_headers.decode('iso-8859-1').split('\r\n'):
+                key, sep, value = line.partition(': ')
+                if sep:
+                    headers.append((key.lower(), value))
+        if self.body:
+            return [headers, self.body] + self.body_parts
+        return [headers] + self.body_parts
+
+
+class FileTruncatedError(ConnectionError):
+    """
+    Файл стал короче, чем объявленная длина ответа: досылать нечего, соединение закрываем
+    """
+    pass
+
+
+class FileBody:
+    """
+    Тело ответа в виде открытого файла: дескриптор, смещение и длина оставшейся части
+    """
+    def __init__(self, file, offset, length, close_file=True):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.close_file = close_file
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size):
+        """
+        Читаем очередной кусок файла для отправки без sendfile
+        """
+        self.file.seek(self.offset)
+        return self.file.read(min(size, self.length))
+
+    def advance(self, sent):
+        self.offset += sent
+        self.length -= sent
+
+    def close(self):
+        if self.close_file:
+            self.file.close()
+
+
+class MappedBody:
+    """
+    Тело ответа - срез общего отображения файла в память. Сервер отправляет view,
+    а close() отпускает ссылку на отображение
+    """
+    def __init__(self, mapping, offset, length):
+        self.mapping = mapping
+        self.view = mapping.view[offset:offset + length]
+
+    def __len__(self):
+        return len(self.view)
+
+    def close(self):
+        if self.mapping is None:
+            return
+        self.view.release()
+        mapping, self.mapping = self.mapping, None
+        mapping.cache.release(mapping)
 
-        return (status_line + header_line + '\r\n').encode('iso-8859-1') + self.body
+
+class StreamBody:
+    """
+    Тело ответа из итератора (или, в движке asyncio, асинхронного итератора) кусков байт.
+    Сервер забирает следующий кусок, только когда предыдущий отправлен, поэтому в памяти
+    на ответ находится не больше одного куска. При chunked куски оборачиваются в chunked-кодирование
+    """
+    def __init__(self, chunks, chunked=True):
+        self.is_async = hasattr(chunks, '__aiter__')
+        self.iterator = chunks.__aiter__() if self.is_async else iter(chunks)
+        self.chunked = chunked
+        self.finished = False
+
+    def frame(self, chunk):
+        if not self.chunked:
+            return [chunk]
+        return [b'%x\r\n' % len(chunk), chunk, b'\r\n']
+
+    def end(self):
+        self.finished = True
+        return [LAST_CHUNK] if self.chunked else []
+
+    def next_segments(self):
+        """
+        Сегменты для отправки следующего куска, после последнего выставляется finished
+        """
+        for chunk in self.iterator:
+            # пустой кусок в chunked означает конец тела, поэтому пропускаем их
+            if chunk:
+                return self.frame(chunk)
+        return self.end()
+
+    async def anext_segments(self):
+        async for chunk in self.iterator:
+            if chunk:
+                return self.frame(chunk)
+        return self.end()
+
+    def close(self):
+        if not self.is_async and hasattr(self.iterator, 'close'):
+            self.iterator.close()
+
+    async def aclose(self):
+        if self.is_async and hasattr(self.iterator, 'aclose'):
+            await self.iterator.aclose()
+        else:
+            self.close()
+
+
+def open_file_body(path: str) -> FileBody:
+    logging.debug('открываем для отправки %s', path)
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+    except OSError:
+        f.close()
+        raise
+    return FileBody(f, 0, size)
+
+
+def make_etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+@lru_cache(maxsize=4096)
+def http_date(timestamp):
+    # Last-Modified одних и тех же файлов форматируется много раз
+    return formatdate(timestamp, usegmt=True)
+
+
+# общие часы всех ответов процесса, их обновляет цикл событий
+clock = DateClock()
+
+
+def parse_http_date(value):
+    """
+    Дата из заголовка в unix-время или None, если разобрать не удалось
+    """
+    if not value:
+        return None
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def parse_ranges(value, size):
+    """
+    Разбираем Range: bytes=... в список (начало, конец) включительно.
+    None - заголовок некорректный и его надо игнорировать, [] - ни один диапазон не выполним
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(0, size - suffix), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+                if start >= size:
+                    continue
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+    return ranges if len(ranges) <= MAX_RANGES else None
 
 
 def load(path: str) -> bytes:
-    logging.info(f'пытаемся прочитать {path}')
+    logging.debug('пытаемся прочитать %s', path)
     with open(path, 'rb') as f:
         return f.read()
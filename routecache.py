@@ -0,0 +1,310 @@
+import ctypes
+import ctypes.util
+import logging
+import mimetypes
+import os
+import select
+import struct
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Thread, Lock, Event
+from urllib.parse import unquote
+
+
+ROUTE_CACHE_SIZE = 10000
+# без inotify записи считаются устаревшими через столько секунд
+ROUTE_POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Route:
+    """
+    Результат разбора цели запроса: разрешенный путь, MIME-тип и stat файла.
+    stat равен None для отрицательного результата - файла нет или путь вне корня
+    """
+    __slots__ = ('path', 'content_type', 'stat', 'checked_at')
+
+    def __init__(self, path, content_type, st, checked_at):
+        self.path = path
+        self.content_type = content_type
+        self.stat = st
+        self.checked_at = checked_at
+
+
+class RouteCache:
+    """
+    LRU-кеш разбора целей запросов: unquote, resolve, проверка выхода за корень,
+    stat и MIME-тип выполняются один раз на цель, в том числе для несуществующих файлов.
+    Изменения в корне отслеживаются через inotify и сбрасывают маршруты измененных путей,
+    а там, где inotify нет, записи перепроверяются не чаще раза в poll_interval.
+    Изменения файлов из ignore (журналов сервера в корне) кеш не сбрасывают
+    """
+    def __init__(self, root_dir, max_entries=ROUTE_CACHE_SIZE, poll_interval=ROUTE_POLL_INTERVAL, ignore=()):
+        self.root_dir = root_dir
+        self.max_entries = max_entries
+        self.poll_interval = poll_interval
+        self.routes = OrderedDict()
+        self.lock = Lock()
+        # увеличивается при каждом сбросе, чтобы не положить в кеш результат,
+        # вычисленный до изменения файлов
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # вызываются после сброса кеша со списком измененных путей
+        self.listeners = []
+        self.watcher = None
+        if root_dir:
+            self.watcher = InotifyWatcher.create(root_dir, self.invalidate, ignore)
+        if self.watcher is None:
+            logging.info('inotify недоступен, кеш маршрутов перепроверяется по таймауту')
+
+    def lookup(self, target):
+        key = target.partition('?')[0]
+        now = time.monotonic()
+        with self.lock:
+            route = self.routes.get(key)
+            if route is not None and (self.watching or now - route.checked_at < self.poll_interval):
+                self.routes.move_to_end(key)
+                self.hits += 1
+                return route
+            self.misses += 1
+            generation = self.generation
+
+        route = self.resolve(key, now)
+        with self.lock:
+            if generation == self.generation:
+                self.routes[key] = route
+                self.routes.move_to_end(key)
+                if len(self.routes) > self.max_entries:
+                    self.routes.popitem(last=False)
+        return route
+
+    def peek(self, target):
+        """
+        Маршрут из кеша, если его не надо перепроверять, иначе None. Без обращения к диску
+        """
+        with self.lock:
+            route = self.routes.get(target.partition('?')[0])
+        if route is not None and (self.watching or time.monotonic() - route.checked_at < self.poll_interval):
+            return route
+        return None
+
+    def resolve(self, url, now):
+        url = unquote(url)
+        url = url + 'index.html' if url[-1] == '/' else url
+        path = Path(self.root_dir + url).resolve()
+        if not path.is_relative_to(self.root_dir):
+            return Route(None, None, None, now)
+        path = str(path)
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        return Route(path, mimetypes.guess_type(path)[0], st, now)
+
+    def invalidate(self, paths=None):
+        """
+        Сбрасываем маршруты, затронутые изменениями paths, None - неизвестно, что изменилось, сбрасываем все
+        """
+        with self.lock:
+            if paths is None:
+                self.routes.clear()
+            else:
+                stale = [key for key, route in self.routes.items() if self.affected(key, route, paths)]
+                for key in stale:
+                    del self.routes[key]
+            self.generation += 1
+            self.invalidations += 1
+        for listener in self.listeners:
+            listener(paths)
+
+    def affected(self, key, route, paths):
+        """
+        Изменился файл маршрута или каталог на пути к нему. Кроме разрешенного пути проверяем
+        путь из цели как есть: он отличается, если по дороге есть симлинк, и симлинк могли заменить
+        """
+        if route.path is not None and under(route.path, paths):
+            return True
+        return under(os.path.normpath(self.root_dir + unquote(key)), paths)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    @property
+    def watching(self):
+        return self.watcher is not None and self.watcher.active
+
+    def seed(self, target, path, content_type, st):
+        """
+        Заранее кладем в кеш маршрут, известный без разбора цели (например, из манифеста)
+        """
+        with self.lock:
+            self.routes[target] = Route(path, content_type, st, time.monotonic())
+            if len(self.routes) > self.max_entries:
+                self.routes.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.routes),
+            'invalidations': self.invalidations,
+            'inotify': self.watching,
+        }
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+class InotifyWatcher:
+    """
+    Наблюдение за деревом каталогов через inotify (вызовы libc через ctypes):
+    при любом изменении вызывается on_change с множеством измененных путей
+    (None - неизвестно, что изменилось), новые подкаталоги добавляются в наблюдение.
+    Файлы из ignore и их ротированные копии (path.1, path.2...) не отслеживаются
+    """
+    def __init__(self, libc, fd, root_dir, on_change, ignore=()):
+        self.libc = libc
+        self.fd = fd
+        self.on_change = on_change
+        self.ignore = {os.path.realpath(path) for path in ignore}
+        self.stop_event = Event()
+        # сбрасывается, если наблюдение сломалось и кеш должен перейти на перепроверку
+        self.active = True
+        self.directories = {}
+        self.add_tree(root_dir)
+        self.thread = Thread(target=self.run, name='route-watcher', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def create(cls, root_dir, on_change, ignore=()):
+        """
+        Возвращаем наблюдатель или None, если inotify недоступен или не хватает лимита наблюдений
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init = libc.inotify_init1
+        except (OSError, AttributeError):
+            return None
+        fd = init(os.O_CLOEXEC | os.O_NONBLOCK)
+        if fd < 0:
+            return None
+        try:
+            return cls(libc, fd, root_dir, on_change, ignore)
+        except OSError as e:
+            logging.error(f'не удалось включить inotify для {root_dir}: {e}')
+            os.close(fd)
+            return None
+
+    def add_tree(self, root):
+        for directory, _, _ in os.walk(root):
+            self.add_watch(directory)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+    def run(self):
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 1.0)
+            if not ready:
+                continue
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                self.fail(e)
+                return
+            try:
+                paths = self.handle_events(buffer)
+            except OSError as e:
+                # новый каталог не удалось добавить в наблюдение
+                self.fail(e)
+                return
+            if paths is None or paths:
+                self.on_change(paths)
+
+    def fail(self, error):
+        logging.error(f'inotify: {error}, кеш маршрутов переходит на перепроверку по таймауту')
+        self.active = False
+        self.on_change(None)
+
+    def handle_events(self, buffer):
+        paths = set()
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # часть событий потеряна
+                paths = None
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            if self.ignored(path):
+                continue
+            if paths is not None:
+                paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+        return paths
+
+    def ignored(self, path):
+        if path in self.ignore:
+            return True
+        base, dot, suffix = path.rpartition('.')
+        return bool(dot) and suffix.isdigit() and base in self.ignore
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        os.close(self.fd)
+
+
+def under(path, paths):
+    """
+    Путь совпадает с одним из paths или лежит внутри одного из них
+    """
+    while path not in paths:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return True
+
+
+def log_files(*paths):
+    """
+    Файлы журналов сервера: файлы обработчиков корневого логгера и переданные пути
+    (например, журнал доступа). Если они лежат в корне, запись в них не должна сбрасывать кеш
+    """
+    handlers = logging.getLogger().handlers
+    files = [handler.baseFilename for handler in handlers if isinstance(handler, logging.FileHandler)]
+    return files + [os.path.abspath(path) for path in paths if path]
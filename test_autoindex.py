@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from http import HTTPStatus
+
+from autoindex import AutoIndex
+from constants import DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL
+from httpparser import Request
+from response import Response, ResponseSettings, RequestSlot
+
+
+class AutoIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root_dir)
+        self.autoindex = AutoIndex()
+
+    def make_file(self, name, size, mtime):
+        path = os.path.join(self.root_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(path, (mtime, mtime))
+
+    def listing(self, target='/', accept=''):
+        body, content_type = self.autoindex.listing(self.root_dir, os.stat(self.root_dir), target, accept)
+        if not isinstance(body, bytes):
+            body = b''.join(body)
+        return body.decode('utf-8'), content_type
+
+    def names(self, query):
+        body, _ = self.listing('/?format=json&' + query)
+        return [entry['name'] for entry in json.loads(body)['entries']]
+
+    def test_html_listing(self):
+        """html listing links every entry, marks directories and skips hidden files"""
+        self.make_file('page.html', 10, 1000000000)
+        self.make_file('.hidden', 1, 1000000000)
+        os.mkdir(os.path.join(self.root_dir, 'sub'))
+        body, content_type = self.listing('/dir/')
+        self.assertEqual(content_type, 'text/html; charset=utf-8')
+        self.assertIn('<title>Index of /dir/</title>', body)
+        self.assertIn('<tr><td><a href="page.html">page.html</a></td><td>10</td><td>2001-09-09 01:46</td></tr>', body)
+        self.assertIn('<a href="sub/">sub/</a></td><td>-</td>', body)
+        self.assertIn('<a href="../">../</a>', body)
+        self.assertNotIn('hidden', body)
+
+    def test_escaping(self):
+        """names with markup characters are escaped in text and percent-encoded in links"""
+        self.make_file('a<b>&"q\'.txt', 1, 1000000000)
+        body, _ = self.listing('/<x>/')
+        self.assertIn('<a href="a%3Cb%3E%26%22q%27.txt">a&lt;b&gt;&amp;&quot;q&#x27;.txt</a>', body)
+        self.assertIn('<title>Index of /&lt;x&gt;/</title>', body)
+        self.assertNotIn('<b>', body)
+
+    def test_json_listing(self):
+        """json listing is chosen by Accept and keeps raw names"""
+        self.make_file('a&b.txt', 3, 1000000000)
+        body, content_type = self.listing('/', 'application/json')
+        self.assertEqual(content_type, 'application/json')
+        self.assertEqual(json.loads(body), {
+            'path': '/', 'page': 1, 'per_page': 100, 'next_page': None,
+            'entries': [{'name': 'a&b.txt', 'type': 'file', 'size': 3, 'mtime': 1000000000}],
+        })
+
+    def test_sorting(self):
+        """entries sort by name with directories first, by size or mtime, in either order"""
+        self.make_file('b', 30, 1000000300)
+        self.make_file('a', 20, 1000000100)
+        self.make_file('c', 10, 1000000200)
+        os.mkdir(os.path.join(self.root_dir, 'z'))
+        os.utime(os.path.join(self.root_dir, 'z'), (1000000000, 1000000000))
+        self.assertEqual(self.names('sort=name'), ['z', 'a', 'b', 'c'])
+        self.assertEqual(self.names('sort=name&order=desc'), ['c', 'b', 'a', 'z'])
+        self.assertEqual(self.names('sort=size'), ['z', 'c', 'a', 'b'])
+        self.assertEqual(self.names('sort=mtime&order=desc'), ['b', 'c', 'a', 'z'])
+        self.assertEqual(sorted(self.names('sort=none')), ['a', 'b', 'c', 'z'])
+
+    def test_pagination(self):
+        """pages follow the sort order and the last one has no next page"""
+        for number in range(5):
+            self.make_file(f'f{number}', 1, 1000000000)
+        first = json.loads(self.listing('/?format=json&per_page=2')[0])
+        last = json.loads(self.listing('/?format=json&per_page=2&page=3')[0])
+        self.assertEqual([entry['name'] for entry in first['entries']], ['f0', 'f1'])
+        self.assertEqual(first['next_page'], 2)
+        self.assertEqual([entry['name'] for entry in last['entries']], ['f4'])
+        self.assertIsNone(last['next_page'])
+        html_page, _ = self.listing('/?per_page=2&page=2')
+        self.assertIn('&larr; prev', html_page)
+        self.assertIn('next &rarr;', html_page)
+
+    def test_cached_until_directory_changes(self):
+        """a listing sent in full is cached by the directory mtime"""
+        self.make_file('a', 1, 1000000000)
+        first, _ = self.listing()
+        body, _ = self.autoindex.listing(self.root_dir, os.stat(self.root_dir), '/')
+        self.assertEqual(body, first.encode('utf-8'))
+        self.assertEqual(self.autoindex.stats()['hits'], 1)
+        self.make_file('b', 1, 1000000000)
+        os.utime(self.root_dir, ns=(0, os.stat(self.root_dir).st_mtime_ns + 10 ** 9))
+        self.assertIn('href="b"', self.listing()[0])
+
+
+class DirectoryResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root_dir)
+        os.mkdir(os.path.join(self.root_dir, 'sub'))
+
+    def respond(self, target, autoindex=True):
+        settings = ResponseSettings(
+            server_name='test', allowed_methods=['GET', 'HEAD'],
+            allowed_http_protocols=[DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL], root_dir=self.root_dir,
+            autoindex=AutoIndex() if autoindex else None
+        )
+        slot = RequestSlot(Request('GET', target, DEFAULT_HTTP_PROTOCOL, {}))
+        Response(settings).form_response_no_return(slot)
+        return slot
+
+    def test_trailing_slash_redirect(self):
+        """a directory without the trailing slash is redirected, keeping the query"""
+        slot = self.respond('/sub?sort=size')
+        self.assertEqual(slot.status, HTTPStatus.MOVED_PERMANENTLY)
+        self.assertIn(b'\r\nLocation: /sub/?sort=size\r\n', slot.resp[0])
+
+    def test_listing_with_slash(self):
+        """a directory with the trailing slash gets its listing"""
+        slot = self.respond('/sub/')
+        self.assertEqual(slot.status, HTTPStatus.OK)
+        self.assertIn(b'Content-Type: text/html; charset=utf-8\r\n', slot.resp[0])
+
+    def test_no_redirect_without_autoindex(self):
+        """without autoindex a directory is not redirected to a listing that would not exist"""
+        slot = self.respond('/sub', autoindex=False)
+        self.assertNotEqual(slot.status, HTTPStatus.MOVED_PERMANENTLY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from compression import Compressor, ENTRY_OVERHEAD
+from constants import DEFAULT_HTTP_PROTOCOL
+from httpparser import Request
+
+
+def gzip_request():
+    return Request('GET', '/', DEFAULT_HTTP_PROTOCOL, {'accept-encoding': ['gzip']})
+
+
+class CompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.root_dir)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.root_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.addCleanup(self.remove, path)
+        return path
+
+    @staticmethod
+    def remove(path):
+        # тест мог удалить файл сам
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def select(self, compressor, path):
+        return compressor.select(gzip_request(), path, os.stat(path), 'text/plain', '"etag"')
+
+    def test_compressed_once(self):
+        """a file version is compressed once and then served from the cache"""
+        compressor = Compressor(min_size=1)
+        path = self.make_file('a.txt', b'abc' * 1000)
+        variant = self.select(compressor, path)
+        self.assertEqual(variant.encoding, 'gzip')
+        self.assertEqual(variant.etag, '"etag-gzip"')
+        self.assertIs(self.select(compressor, path), variant)
+        self.assertEqual(compressor.stats()['entries'], 1)
+
+    def test_no_gain_entries_are_bounded(self):
+        """results that compression did not shrink are remembered but count against the cache size"""
+        compressor = Compressor(min_size=1, cache_size=3 * ENTRY_OVERHEAD)
+        for number in range(5):
+            path = self.make_file(f'{number}.txt', os.urandom(2048))
+            self.assertIsNone(self.select(compressor, path))
+            self.assertIsNone(self.select(compressor, path))
+        stats = compressor.stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['size'], 3 * ENTRY_OVERHEAD)
+
+    def test_sibling_stat_cached(self):
+        """the sibling .gz is looked up once per source version, invalidate forgets it"""
+        compressor = Compressor(min_size=1)
+        path = self.make_file('a.txt', b'abc' * 1000)
+        sibling = self.make_file('a.txt.gz', b'compressed')
+        variant = self.select(compressor, path)
+        self.assertEqual((variant.path, variant.size), (sibling, 10))
+        os.unlink(sibling)
+        self.assertEqual(self.select(compressor, path).path, sibling)
+        compressor.invalidate([sibling])
+        self.assertIsNone(self.select(compressor, path).path)
+        self.assertEqual(compressor.stats()['siblings'], 1)
+
+    def test_sibling_rechecked_for_new_version(self):
+        """a changed source file is not paired with a sibling remembered for the old version"""
+        compressor = Compressor(min_size=1)
+        path = self.make_file('a.txt', b'abc' * 1000)
+        sibling = self.make_file('a.txt.gz', b'compressed')
+        self.assertEqual(self.select(compressor, path).path, sibling)
+        st = os.stat(sibling)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(self.select(compressor, path).path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from http import HTTPStatus
+
+from httpparser import RequestParser, ParseError
+
+
+class RequestParserTest(unittest.TestCase):
+
+    def test_request_line_too_long(self):
+        """request line over the limit returns 414"""
+        parser = RequestParser(max_request_line=100)
+        parser.feed(b'GET /' + b'a' * 200)
+        with self.assertRaises(ParseError) as error:
+            parser.next_request()
+        self.assertEqual(error.exception.status, HTTPStatus.REQUEST_URI_TOO_LONG)
+
+    def test_headers_too_large(self):
+        """header block over the limit returns 431 even after a short request line"""
+        parser = RequestParser(max_request_line=8190, max_headers_size=16384)
+        parser.feed(b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * 20000 + b'\r\n\r\n')
+        with self.assertRaises(ParseError) as error:
+            parser.next_request()
+        self.assertEqual(error.exception.status, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    def test_headers_too_large_before_terminator(self):
+        """incomplete header block over the limit is rejected without waiting for its end"""
+        parser = RequestParser(max_headers_size=1000)
+        parser.feed(b'GET / HTTP/1.1\r\nX-Big: ' + b'a' * 2000)
+        with self.assertRaises(ParseError) as error:
+            parser.next_request()
+        self.assertEqual(error.exception.status, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    def test_headers_within_limit(self):
+        """header block at the limit is accepted"""
+        header = b'X-Big: ' + b'a' * 90 + b'\r\n'
+        parser = RequestParser(max_request_line=20, max_headers_size=len(header) + 2)
+        parser.feed(b'GET / HTTP/1.1\r\n' + header + b'\r\n')
+        request = parser.next_request()
+        self.assertEqual(request.get('X-Big'), 'a' * 90)
+
+    def test_terminator_split_across_reads(self):
+        """end of headers split between reads"""
+        parser = RequestParser()
+        parser.feed(b'GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r')
+        self.assertIsNone(parser.next_request())
+        parser.feed(b'\n')
+        request = parser.next_request()
+        self.assertEqual(request.target, '/index.html')
+        self.assertEqual(request.get('Host'), 'localhost')
+
+    def test_byte_by_byte(self):
+        """request fed one byte at a time"""
+        data = b'HEAD /a%20b.txt HTTP/1.0\nConnection: keep-alive\n\n'
+        parser = RequestParser()
+        requests = []
+        for i in range(len(data)):
+            parser.feed(data[i:i + 1])
+            request = parser.next_request()
+            if request is not None:
+                requests.append(request)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0].method, 'HEAD')
+        self.assertTrue(requests[0].wants_keep_alive())
+
+    def test_pipelined_requests(self):
+        """several requests in one buffer are returned in order"""
+        parser = RequestParser()
+        parser.feed(b'GET /1 HTTP/1.1\r\n\r\nGET /2 HTTP/1.1\r\nConnection: close\r\n\r\nGET /3 HTTP/1.1\r\n')
+        first = parser.next_request()
+        second = parser.next_request()
+        self.assertEqual(first.target, '/1')
+        self.assertEqual(second.target, '/2')
+        self.assertFalse(second.wants_keep_alive())
+        self.assertIsNone(parser.next_request())
+        parser.feed(b'\r\n')
+        self.assertEqual(parser.next_request().target, '/3')
+        self.assertEqual(len(parser), 0)
+
+    def test_bad_request_line(self):
+        """malformed request line returns 400"""
+        parser = RequestParser()
+        parser.feed(b'GARBAGE\r\n\r\n')
+        with self.assertRaises(ParseError) as error:
+            parser.next_request()
+        self.assertEqual(error.exception.status, HTTPStatus.BAD_REQUEST)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+from mmapcache import MmapCache
+
+
+class MmapCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.root_dir)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.root_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_shared_mapping(self):
+        """requests for one file version share a mapping until the last release"""
+        cache = MmapCache()
+        path = self.make_file('a', 100)
+        first = cache.acquire(path, os.stat(path))
+        second = cache.acquire(path, os.stat(path))
+        self.assertIs(first, second)
+        self.assertEqual(first.refs, 2)
+        self.assertEqual(cache.stats()['reuses'], 1)
+        cache.release(first)
+        self.assertEqual(cache.stats()['mapped_bytes'], 100)
+        cache.release(second)
+        self.assertTrue(first.mmap.closed)
+        self.assertEqual(cache.stats()['mappings'], 0)
+        self.assertEqual(cache.stats()['mapped_bytes'], 0)
+
+    def test_budget(self):
+        """mappings over the budget are refused and the budget is freed on release"""
+        cache = MmapCache(budget=150)
+        first = self.make_file('a', 100)
+        second = self.make_file('b', 100)
+        mapping = cache.acquire(first, os.stat(first))
+        self.assertIsNone(cache.acquire(second, os.stat(second)))
+        self.assertEqual(cache.stats()['rejected'], 1)
+        cache.release(mapping)
+        mapping = cache.acquire(second, os.stat(second))
+        self.assertIsNotNone(mapping)
+        cache.release(mapping)
+
+    def test_changed_file(self):
+        """a new file version gets its own mapping while the old one stays with its holder"""
+        cache = MmapCache()
+        path = self.make_file('a', 100)
+        old = cache.acquire(path, os.stat(path))
+        with open(path, 'ab') as f:
+            f.write(b'y' * 10)
+        new = cache.acquire(path, os.stat(path))
+        self.assertIsNot(old, new)
+        self.assertEqual(new.size, 110)
+        self.assertEqual(bytes(old.view[:1]), b'x')
+        cache.release(old)
+        self.assertEqual(cache.stats()['mappings'], 1)
+        cache.release(new)
+        self.assertEqual(cache.stats()['mapped_bytes'], 0)
+
+    def test_invalidate(self):
+        """changed paths are not reused, but current holders keep their mapping"""
+        cache = MmapCache()
+        path = self.make_file('a', 100)
+        other = self.make_file('b', 100)
+        mapping = cache.acquire(path, os.stat(path))
+        kept = cache.acquire(other, os.stat(other))
+        cache.invalidate([self.root_dir + '/a'])
+        self.assertEqual(cache.stats()['invalidations'], 1)
+        again = cache.acquire(path, os.stat(path))
+        self.assertIsNot(again, mapping)
+        self.assertIs(cache.acquire(other, os.stat(other)), kept)
+        cache.release(mapping)
+        self.assertTrue(mapping.mmap.closed)
+        self.assertEqual(cache.stats()['mapped_bytes'], 200)
+        cache.invalidate()
+        self.assertEqual(cache.stats()['mappings'], 0)
+        for held in (again, kept, kept):
+            cache.release(held)
+        self.assertEqual(cache.stats()['mapped_bytes'], 0)
+
+    def test_truncated_while_mapping(self):
+        """a file whose size differs from its stat is not mapped"""
+        cache = MmapCache()
+        path = self.make_file('a', 100)
+        st = os.stat(path)
+        os.truncate(path, 50)
+        self.assertIsNone(cache.acquire(path, st))
+        self.assertEqual(cache.stats()['mapped_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from ratelimit import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_connection_limit(self):
+        """connections over the limit are rejected until one is closed"""
+        limiter = RateLimiter(max_connections=2)
+        first = limiter.connect('10.0.0.1')
+        self.assertIsNotNone(limiter.connect('10.0.0.1'))
+        self.assertIsNone(limiter.connect('10.0.0.1'))
+        limiter.disconnect(first)
+        self.assertIsNotNone(limiter.connect('10.0.0.1'))
+
+    def test_active_clients_not_evicted(self):
+        """clients with open connections survive eviction and keep their limits"""
+        limiter = RateLimiter(rate=1, max_connections=1, max_clients=1)
+        client = limiter.connect('10.0.0.1')
+        self.assertEqual(limiter.take(client), 0)
+        for number in range(2, 10):
+            limiter.disconnect(limiter.connect(f'10.0.0.{number}'))
+        self.assertIsNone(limiter.connect('10.0.0.1'))
+        self.assertGreater(limiter.take(client), 0)
+        self.assertEqual(limiter.stats()['clients'], 2)
+
+    def test_idle_clients_evicted(self):
+        """clients without connections are kept in a bounded LRU"""
+        limiter = RateLimiter(rate=1, max_clients=2)
+        for number in range(5):
+            limiter.disconnect(limiter.connect(f'10.0.0.{number}'))
+        stats = limiter.stats()
+        self.assertEqual(stats['clients'], 2)
+        self.assertEqual(stats['evictions'], 3)
+
+    def test_subnet_grouping(self):
+        """addresses in one subnet share a bucket"""
+        limiter = RateLimiter(rate=1, ipv4_prefix=24)
+        self.assertEqual(limiter.take(limiter.connect('10.0.0.1')), 0)
+        self.assertGreater(limiter.take(limiter.connect('10.0.0.2')), 0)
+        self.assertEqual(limiter.take(limiter.connect('10.0.1.1')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
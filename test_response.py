@@ -0,0 +1,121 @@
+import asyncio
+import unittest
+
+from constants import DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL
+from httpparser import Request
+from response import Response, ResponseSettings, RequestSlot, StreamBody
+
+
+def make_settings(**options):
+    return ResponseSettings(
+        server_name='test', allowed_methods=['GET', 'HEAD'],
+        allowed_http_protocols=[DEFAULT_HTTP_PROTOCOL, OLD_HTTP_PROTOCOL], **options
+    )
+
+
+def make_slot(method='GET', version=DEFAULT_HTTP_PROTOCOL):
+    return RequestSlot(Request(method, '/', version, {}))
+
+
+def chunks():
+    yield b'abc'
+    yield b''
+    yield b'defg'
+
+
+async def async_chunks():
+    for chunk in chunks():
+        await asyncio.sleep(0)
+        yield chunk
+
+
+class StreamResponseTest(unittest.TestCase):
+
+    def test_chunked_body(self):
+        """iterator body is sent with chunked encoding"""
+        slot = make_slot()
+        Response(make_settings()).form_stream_response(slot, chunks(), 'text/plain')
+        head, body = slot.resp
+        self.assertIn(b'Transfer-Encoding: chunked\r\n', head)
+        self.assertNotIn(b'Content-Length', head)
+        segments = []
+        while not body.finished:
+            segments += body.next_segments()
+        self.assertEqual(b''.join(segments), b'3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n')
+
+    def test_http10_body(self):
+        """HTTP/1.0 client gets the raw body and the connection is closed"""
+        slot = make_slot(version=OLD_HTTP_PROTOCOL)
+        Response(make_settings()).form_stream_response(slot, chunks(), 'text/plain')
+        head, body = slot.resp
+        self.assertNotIn(b'Transfer-Encoding', head)
+        self.assertFalse(slot.keep_alive)
+        segments = []
+        while not body.finished:
+            segments += body.next_segments()
+        self.assertEqual(b''.join(segments), b'abcdefg')
+
+    def test_async_body(self):
+        """async iterator body is driven by the asyncio engine"""
+        slot = make_slot()
+        Response(make_settings(async_streams=True)).form_stream_response(slot, async_chunks(), 'text/plain')
+        body = slot.resp[1]
+        self.assertIsInstance(body, StreamBody)
+        self.assertTrue(body.is_async)
+
+        async def drain():
+            segments = []
+            while not body.finished:
+                segments += await body.anext_segments()
+            await body.aclose()
+            return segments
+
+        self.assertEqual(b''.join(asyncio.run(drain())), b'3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n')
+
+    def test_async_body_rejected(self):
+        """async iterator body is rejected before headers are formed without asyncio"""
+        slot = make_slot()
+        body = async_chunks()
+        with self.assertRaises(TypeError):
+            Response(make_settings()).form_stream_response(slot, body, 'text/plain')
+        self.assertIsNone(slot.resp)
+        asyncio.run(body.aclose())
+
+    def test_head_closes_body(self):
+        """HEAD response has no body and closes the iterator"""
+        closed = []
+
+        def tracked():
+            try:
+                yield b'abc'
+            finally:
+                closed.append(True)
+
+        body = tracked()
+        next(body)
+        slot = make_slot(method='HEAD')
+        Response(make_settings()).form_stream_response(slot, body, 'text/plain')
+        self.assertEqual(len(slot.resp), 1)
+        self.assertEqual(closed, [True])
+
+
+class ResponseReuseTest(unittest.TestCase):
+
+    def test_reset_between_requests(self):
+        """a reset response keeps nothing from the previous request and does not touch its output"""
+        resp = Response(make_settings())
+        first = make_slot()
+        resp.form_stream_response(first, chunks(), 'text/plain')
+        head, body = first.resp
+        resp.reset()
+        second = make_slot()
+        resp.form_content_response(second, b'hello', 'text/html')
+        self.assertEqual(first.resp, [head, body])
+        self.assertIn(b'Transfer-Encoding: chunked\r\n', head)
+        self.assertNotIn(b'Transfer-Encoding', second.resp[0])
+        self.assertIn(b'Content-Type: text/html\r\nContent-Length: 5\r\n', second.resp[0])
+        self.assertEqual(b''.join(second.resp).rpartition(b'\r\n\r\n')[2], b'hello')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from routecache import RouteCache
+
+
+class InotifyInvalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root_dir)
+        self.log_path = os.path.join(self.root_dir, 'server.log')
+        self.cache = RouteCache(self.root_dir, ignore=[self.log_path])
+        self.addCleanup(self.cache.close)
+        if not self.cache.watching:
+            self.skipTest('inotify is not available')
+        self.changes = []
+        self.cache.add_listener(self.changes.append)
+
+    def path(self, name):
+        return os.path.join(self.root_dir, name)
+
+    def write(self, name, data=b'abc', mode='wb'):
+        with open(self.path(name), mode) as f:
+            f.write(data)
+
+    def settle(self):
+        # события приходят по порядку: дождавшись метки, знаем, что подготовка теста уже обработана
+        marker = self.path('marker-%d' % len(self.changes))
+        open(marker, 'wb').close()
+        deadline = time.monotonic() + 5
+        while not any(marker in paths for paths in self.changes if paths):
+            self.assertLess(time.monotonic(), deadline, 'watcher did not report changes')
+            time.sleep(0.01)
+
+    def wait_invalidated(self, *targets):
+        deadline = time.monotonic() + 5
+        while any(target in self.cache.routes for target in targets):
+            self.assertLess(time.monotonic(), deadline, f'{targets} were not invalidated')
+            time.sleep(0.01)
+
+    def test_cached_while_unchanged(self):
+        """a watched route is served from the cache without a new stat"""
+        self.write('a.html')
+        self.settle()
+        route = self.cache.lookup('/a.html')
+        self.assertIs(self.cache.lookup('/a.html?x=1'), route)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_modified(self):
+        """writing to a file drops its route and the next lookup sees the new size"""
+        self.write('a.html')
+        self.settle()
+        self.assertEqual(self.cache.lookup('/a.html').stat.st_size, 3)
+        self.write('a.html', b'defg', mode='ab')
+        self.wait_invalidated('/a.html')
+        self.assertEqual(self.cache.lookup('/a.html').stat.st_size, 7)
+        self.assertTrue(any(self.path('a.html') in paths for paths in self.changes if paths))
+
+    def test_deleted(self):
+        """a deleted file becomes a negative route"""
+        self.write('a.html')
+        self.settle()
+        self.assertIsNotNone(self.cache.lookup('/a.html').stat)
+        os.unlink(self.path('a.html'))
+        self.wait_invalidated('/a.html')
+        self.assertIsNone(self.cache.lookup('/a.html').stat)
+
+    def test_renamed(self):
+        """rename drops both the old route and the cached miss for the new name"""
+        self.write('a.html')
+        self.settle()
+        self.assertIsNotNone(self.cache.lookup('/a.html').stat)
+        self.assertIsNone(self.cache.lookup('/b.html').stat)
+        os.rename(self.path('a.html'), self.path('b.html'))
+        self.wait_invalidated('/a.html', '/b.html')
+        self.assertIsNone(self.cache.lookup('/a.html').stat)
+        self.assertIsNotNone(self.cache.lookup('/b.html').stat)
+
+    def test_directory_renamed(self):
+        """renaming a directory drops the routes of files inside it"""
+        os.mkdir(self.path('sub'))
+        self.write('sub/x.html')
+        self.write('other.html')
+        self.settle()
+        self.assertIsNotNone(self.cache.lookup('/sub/x.html').stat)
+        other = self.cache.lookup('/other.html')
+        os.rename(self.path('sub'), self.path('moved'))
+        self.wait_invalidated('/sub/x.html')
+        self.assertIsNone(self.cache.lookup('/sub/x.html').stat)
+        self.assertIsNotNone(self.cache.lookup('/moved/x.html').stat)
+        self.assertIs(self.cache.lookup('/other.html'), other)
+
+    def test_new_directory_watched(self):
+        """a directory created after start is watched too"""
+        os.mkdir(self.path('new'))
+        deadline = time.monotonic() + 5
+        while self.path('new') not in self.cache.watcher.directories.values():
+            self.assertLess(time.monotonic(), deadline, 'new directory is not watched')
+            time.sleep(0.01)
+        self.assertIsNone(self.cache.lookup('/new/y.html').stat)
+        self.write('new/y.html')
+        self.wait_invalidated('/new/y.html')
+        self.assertIsNotNone(self.cache.lookup('/new/y.html').stat)
+
+    def test_ignored_log(self):
+        """writes to the server log do not invalidate routes"""
+        self.write('a.html')
+        self.settle()
+        route = self.cache.lookup('/a.html')
+        del self.changes[:]
+        self.write('server.log', b'line\n', mode='ab')
+        self.write('b.html')
+        deadline = time.monotonic() + 5
+        while not self.changes:
+            self.assertLess(time.monotonic(), deadline, 'no change reported')
+            time.sleep(0.01)
+        for paths in self.changes:
+            self.assertNotIn(self.log_path, paths)
+        self.assertIs(self.cache.lookup('/a.html'), route)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,46 +1,129 @@
-from queue import Queue
-from threading import Thread
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
 import logging
+import time
+from metrics import Histogram
+
+
+QUEUE_SIZE = 256
+# если задача ждала в очереди дольше, а свободных воркеров нет - добавляем воркер
+GROW_LATENCY = 0.05
+# воркер сверх минимума, простоявший столько без задач, завершается
+IDLE_TIMEOUT = 30.0
 
 
 class Worker(Thread):
     """
     Поток исполняющий задачи из очереди задач
     """
-    def __init__(self, tasks):
+    def __init__(self, pool):
         Thread.__init__(self)
-        self.tasks = tasks
+        self.pool = pool
         self.daemon = True
         self.start()
         logging.info(f'Воркер {self.name} запущен')
 
     def run(self):
+        pool = self.pool
         while True:
-            func, args, kargs = self.tasks.get()
+            try:
+                func, args, kargs, queued = pool.next_task()
+            except Empty:
+                if pool.retire():
+                    logging.info(f'Воркер {self.name} остановлен за ненадобностью')
+                    return
+                continue
+            started = time.monotonic()
+            pool.observe_wait(started - queued)
             try:
                 func(*args, **kargs)
-                logging.info(f'Задача выполнена воркером {self.name}')
+                logging.debug('Задача выполнена воркером %s', self.name)
             except Exception as e:
                 logging.error(f'Выполнение задачи воркером {self.name} завершилась с ошибкой: {e}')
             finally:
-                self.tasks.task_done()
+                pool.task_time.observe(time.monotonic() - started)
+                pool.tasks.task_done()
 
 
 class ThreadPool:
     """
-    Пул потоков в которые отправляются задачи из очереди
+    Пул потоков в которые отправляются задачи из ограниченной очереди.
+    Добавление задачи никогда не блокирует: при полной очереди выбрасывается queue.Full.
+    Число воркеров меняется от num_threads до max_threads: пул растет, когда задачи
+    ждут в очереди дольше grow_latency, и сжимается, когда лишние воркеры простаивают
     """
-    def __init__(self, num_threads):
-        self.tasks = Queue(num_threads)
+    def __init__(
+            self,
+            num_threads,
+            max_threads=None,
+            queue_size=QUEUE_SIZE,
+            grow_latency=GROW_LATENCY,
+            idle_timeout=IDLE_TIMEOUT
+    ):
+        self.min_threads = num_threads
+        self.max_threads = max(num_threads, max_threads or num_threads)
+        self.grow_latency = grow_latency
+        self.idle_timeout = idle_timeout
+        self.tasks = Queue(queue_size)
+        self.lock = Lock()
+        self.num_workers = 0
+        self.idle = 0
+        self.last_wait = 0.0
+        self.rejected = 0
+        self.wait_time = Histogram()
+        self.task_time = Histogram()
         for _ in range(num_threads):
-            Worker(self.tasks)
+            self.spawn()
         logging.info(f'Создано {num_threads} воркеров')
 
+    def spawn(self):
+        with self.lock:
+            if self.num_workers >= self.max_threads:
+                return
+            self.num_workers += 1
+        Worker(self)
+
     def add_task(self, func, *args, **kargs):
         """
-        Добавляем задачу в очередь
+        Добавляем задачу в очередь, если она заполнена - выбрасываем queue.Full
+        """
+        try:
+            self.tasks.put_nowait((func, args, kargs, time.monotonic()))
+        except Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+        if self.num_workers < self.max_threads and not self.idle and (
+                self.last_wait > self.grow_latency or self.tasks.qsize() > self.num_workers
+        ):
+            self.spawn()
+
+    def next_task(self):
+        with self.lock:
+            self.idle += 1
+        try:
+            if self.num_workers > self.min_threads:
+                return self.tasks.get(timeout=self.idle_timeout)
+            return self.tasks.get()
+        finally:
+            with self.lock:
+                self.idle -= 1
+
+    def retire(self):
+        """
+        Воркер простоял idle_timeout: завершаем его, если воркеров больше минимума
         """
-        self.tasks.put((func, args, kargs), block=True)
+        with self.lock:
+            if self.num_workers > self.min_threads:
+                self.num_workers -= 1
+                return True
+            return False
+
+    def observe_wait(self, wait):
+        self.wait_time.observe(wait)
+        self.last_wait = wait
+        if wait > self.grow_latency and not self.idle and self.tasks.qsize():
+            self.spawn()
 
     def map(self, func, args_list):
         """
@@ -49,8 +132,23 @@ class ThreadPool:
         for args in args_list:
             self.add_task(func, args)
 
-    def wait_completion(self):
+    def wait_completion(self, timeout=None):
         """
-        Ждем завершения всех задач в очереди
+        Ждем завершения всех задач в очереди, но не дольше timeout.
+        Возвращаем False, если задачи остались
         """
-        self.tasks.join()
+        if timeout is None:
+            self.tasks.join()
+            return True
+        with self.tasks.all_tasks_done:
+            return self.tasks.all_tasks_done.wait_for(lambda: not self.tasks.unfinished_tasks, timeout)
+
+    def stats(self):
+        return {
+            'workers': self.num_workers,
+            'idle': self.idle,
+            'queued': self.tasks.qsize(),
+            'rejected': self.rejected,
+            'wait': self.wait_time.snapshot(),
+            'duration': self.task_time.snapshot(),
+        }
@@ -0,0 +1,74 @@
+import os
+import ssl
+from response import FileTruncatedError
+
+
+# файлы под TLS читаются в общий буфер цикла такого размера: os.sendfile отдал бы открытый текст
+TLS_FILE_BUFFER_SIZE = 64 * 1024
+# сколько билетов TLS 1.3 выдается клиенту после полного рукопожатия
+TLS_TICKETS = 2
+# мелкие сегменты ответа склеиваются в записи TLS не больше этой
+TLS_RECORD_SIZE = 16 * 1024
+ALPN_HTTP1 = 'http/1.1'
+ALPN_HTTP2 = 'h2'
+# исключения неблокирующего SSL-сокета, после которых надо дождаться готовности сокета
+WANT_IO = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+def make_server_context(certfile, keyfile=None, tickets=TLS_TICKETS):
+    """
+    Серверный контекст TLS 1.2+. Возобновление сессий работает и по кешу сессий OpenSSL,
+    и по билетам: ключи билетов создаются вместе с контекстом, поэтому контекст
+    надо создавать до запуска процессов, чтобы билет принимал любой из них
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    if hasattr(context, 'num_tickets'):
+        context.num_tickets = tickets
+    set_alpn(context)
+    return context
+
+
+def set_alpn(context, http2=False):
+    """
+    HTTP/2 предлагаем через ALPN, только если сервер его обслуживает
+    """
+    context.set_alpn_protocols([ALPN_HTTP2, ALPN_HTTP1] if http2 else [ALPN_HTTP1])
+
+
+def coalesce(buffers, limit=TLS_RECORD_SIZE):
+    """
+    Подряд идущие мелкие сегменты (заголовки и небольшое тело) склеиваем, чтобы они ушли
+    одной записью TLS и одним вызовом SSL_write. Если SSL попросит повторить отправку,
+    при повторе склейка начнется с тех же сегментов и будет не короче
+    """
+    total = 0
+    count = 0
+    for buffer in buffers:
+        if total + len(buffer) > limit:
+            break
+        total += len(buffer)
+        count += 1
+    if count < 2:
+        return buffers[0]
+    return b''.join(buffers[:count])
+
+
+class FileSender:
+    """
+    Отправка файлов через SSL-сокет кусками через один переиспользуемый буфер.
+    Если SSL не смог отправить кусок, при повторе он читается заново с того же смещения
+    той же длины, поэтому буфер можно делить между всеми соединениями цикла
+    """
+    def __init__(self, size=TLS_FILE_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def send(self, sock, body):
+        size = min(body.length, len(self.view))
+        read = os.preadv(body.fileno(), [self.view[:size]], body.offset)
+        if not read:
+            raise FileTruncatedError('файл укоротился во время отправки')
+        return sock.send(self.view[:read])